@@ -2,3 +2,4 @@ from app.api.v1 import user
 from app.api.v1 import auth
 from app.api.v1 import chat
 from app.api.v1 import group
+from app.api.v1 import sync
@@ -3,6 +3,7 @@ from flask import Blueprint
 from werkzeug.security import check_password_hash
 from app.extensions import jwt, logger
 from app.models import User, Token
+from app.tracing import tracer
 from app.utils import parse_req, FieldString, send_result, send_error, get_datetime_now
 from flask_jwt_extended import (
     jwt_required, create_access_token,
@@ -117,4 +118,5 @@ def logout():
 @jwt.token_in_blacklist_loader
 def check_if_token_is_revoked(decrypted_token):
     # return False
-    return Token.is_token_revoked(decrypted_token)
+    with tracer.span('jwt.revocation_check'):
+        return Token.is_token_revoked(decrypted_token)
@@ -1,11 +1,14 @@
-import uuid
-
-from flask import Blueprint, request
+from flask import Blueprint, request, current_app
 from flask_jwt_extended import jwt_required, get_jwt_identity
-from app.extensions import logger, db, sio
-from app.models import Message, User, Friend
-from app.socket_handler import online_users
-from app.utils import send_result, send_error, get_datetime_now, get_timestamp_now, generate_id
+from app.archive import ArchivedMessage
+from app.decorators import read_replica
+from app.extensions import logger, db
+from app.ids import new_id
+from app.models import Message, User, Friend, PendingDelivery, Change
+from app.presence import get_user_sessions
+from app.tracing import tracer
+from app.utils import send_result, send_error, get_datetime_now, get_timestamp_now, generate_id, send_ndjson, \
+    parse_cursor
 
 api = Blueprint('chats', __name__)
 
@@ -22,7 +25,8 @@ def chat_private(receiver_id):
         Examples::
     """
 
-    check_receiver = User.get_by_id(receiver_id)
+    with tracer.span('chat.check_receiver', receiver_id=receiver_id):
+        check_receiver = User.get_by_id(receiver_id)
     if check_receiver is None:
         return send_error(message="Not found receiver")
 
@@ -34,26 +38,33 @@ def chat_private(receiver_id):
         return send_error(message="Parameters error: " + str(ex))
 
     created_date = get_timestamp_now()
-    _id = str(uuid.uuid1())
+    _id = new_id()
     current_user_id = get_jwt_identity()
     group_id = generate_id(current_user_id, receiver_id)
 
-    friend = Friend.get_by_id(group_id)
-    if friend is None:
-        add_query = Friend(id=group_id, user_id_1=get_jwt_identity(), user_id_2=receiver_id)
-        db.session.add(add_query)
-        db.session.commit()
+    with tracer.span('chat.check_friend', group_id=group_id):
+        friend = Friend.get_by_id(group_id)
+        if friend is None:
+            add_query = Friend(id=group_id, user_id_1=get_jwt_identity(), user_id_2=receiver_id)
+            db.session.add(add_query)
+            db.session.commit()
 
-    new_values = Message(id=_id, message=message, sender_id=current_user_id, group_id=group_id,
-                         created_date=created_date)
-    db.session.add(new_values)
-    db.session.commit()
+    receivers_session_id = get_user_sessions(receiver_id)
+    with tracer.span('chat.store_message', group_id=group_id):
+        new_values = Message(id=_id, message=message, sender_id=current_user_id, group_id=group_id,
+                             created_date=created_date)
+        db.session.add(new_values)
+        if not receivers_session_id:
+            db.session.add(PendingDelivery(user_id=receiver_id, message_id=_id, group_id=group_id,
+                                           created_date=created_date))
+        Change.record([current_user_id, receiver_id], Change.PRIVATE, Change.NEW, _id, group_id)
+        db.session.commit()
 
     data = new_values.to_json()
 
-    receivers_session_id = [key for key, value in online_users.items() if value == receiver_id]
-    for session_id in receivers_session_id:
-        sio.emit('new_private_msg', data, room=session_id)
+    with tracer.span('chat.deliver', receiver_id=receiver_id):
+        for session_id in receivers_session_id:
+            tracer.emit('new_private_msg', data, room=session_id)
 
     return send_result(data=data)
 
@@ -62,6 +73,11 @@ def chat_private(receiver_id):
 @jwt_required
 def get(partner_id):
     """ This api for .
+    Not read_replica: the page marks messages seen and clears the pending deliveries of the conversation, it has to
+    see the messages already committed on the primary.
+
+        Query: page and page_size, or before=<created_date>:<id> of the oldest message read (empty for the
+        newest page) to page by cursor
 
         Returns:
 
@@ -70,6 +86,7 @@ def get(partner_id):
     """
     page = request.args.get('page', 1, type=int)
     page_size = request.args.get('page_size', 10, type=int)
+    before = request.args.get('before')
 
     partner = User.get_by_id(partner_id)
     if partner is None:
@@ -78,13 +95,27 @@ def get(partner_id):
     current_user_id = get_jwt_identity()
     group_id = generate_id(current_user_id, partner_id)
 
-    messages = Message.get_messages(group_id=group_id, page=page, page_size=page_size)
-    unseen_messages = [message for message in messages if message.sender_id == partner_id and message.seen is False]
-    for msg in unseen_messages:
-        msg.seen = True
+    if before is not None:
+        before = parse_cursor(before)
+        page = 1 if before is None else 0
+        messages = Message.get_messages_before(group_id=group_id, before=before, page_size=page_size)
+    else:
+        messages = Message.get_messages(group_id=group_id, page=page, page_size=page_size)
+    # archived messages are read-only
+    unseen_id = [message.id for message in messages if not isinstance(message, ArchivedMessage) and
+                 message.sender_id == partner_id and not message.seen]
+    Message.mark_seen(group_id, unseen_id)
+    Change.record_many(Change.PRIVATE, Change.SEEN, group_id,
+                       [(user_id, _id) for _id in unseen_id for user_id in {current_user_id, partner_id}])
+    if page == 1:
+        # the client has the latest messages of this conversation, nothing to deliver on its next login
+        PendingDelivery.query.filter_by(user_id=current_user_id, group_id=group_id).delete()
     db.session.commit()
 
     messages = Message.many_to_json(messages)
+    for item in messages:
+        if item['id'] in unseen_id:
+            item['seen'] = True
     return send_result(data=messages)
 
 
@@ -93,14 +124,68 @@ def get(partner_id):
 def delete(message_id):
     """ This is api for .
 
+        Requests Params:
+
+            partner_id: string, partner of the conversation, needed to delete an archived message
+
         Returns:
 
         Examples::
     """
 
-    Message.query.filter_by(id=message_id).delete()
+    message = Message.get_by_id(message_id)
+    archive = current_app.extensions.get('message_archive')
+    if message is not None:
+        group_id = message.group_id
+        Message.delete_by_id(message_id, group_id)
+    elif archive is None:
+        return send_result()
+    else:
+        partner_id = request.args.get('partner_id')
+        if partner_id is None:
+            return send_error(message="Not found message, partner_id is needed to delete an archived message")
+        group_id = generate_id(get_jwt_identity(), partner_id)
+        message = archive.delete(group_id, message_id)
+        if message is None:
+            return send_error(message="Not found message")
+
+    friend = Friend.get_by_id(group_id)
+    users_id = [friend.user_id_1, friend.user_id_2] if friend else [message.sender_id]
+    Change.record(users_id, Change.PRIVATE, Change.DELETED, message_id, group_id)
+    PendingDelivery.query.filter_by(message_id=message_id).delete()
+    db.session.commit()
     return send_result()
 
+
+@api.route('/<string:partner_id>/export', methods=['GET'])
+@jwt_required
+@read_replica
+def export(partner_id):
+    """ This api streams the whole conversation with a partner as NDJSON, from the oldest message.
+
+        Requests Params:
+
+            after: string, cursor of the last received line to resume an interrupted export
+            gzip: 1 to gzip the stream
+
+        Returns:
+
+            one message json per line, with its cursor
+
+        Examples::
+
+            GET /api/v1/chats/<partner_id>/export?gzip=1
+    """
+    partner = User.get_by_id(partner_id)
+    if partner is None:
+        return send_error(message="Not found partner")
+
+    group_id = generate_id(get_jwt_identity(), partner_id)
+    after = parse_cursor(request.args.get('after'))
+    rows = Message.stream_messages(group_id, after=after)
+    return send_ndjson(rows, Message.many_to_json, compress=request.args.get('gzip', 0, type=int) == 1)
+
+
 # @api.route('/<string:group_id>', methods=['POST'])
 # @jwt_required
 # def chat(group_id):
@@ -188,5 +273,5 @@ def delete(message_id):
 #         Examples::
 #     """
 #
-#     Message.query.filter_by(id=message_id).delete()
+#     Message.delete_by_id(message_id, message.group_id)
 #     return send_result()
@@ -1,11 +1,16 @@
 import uuid
 
-from flask import Blueprint, request
-from flask_jwt_extended import jwt_required
+from flask import Blueprint, request, current_app
+from flask_jwt_extended import jwt_required, get_jwt_identity
+from jsonschema import validate
 
+from app.decorators import read_replica
 from app.extensions import logger, db
-from app.models import User, GroupUser, Group
-from app.utils import send_result, send_error, get_datetime_now, get_timestamp_now
+from app.group_send import send_group_copies
+from app.model_cache import model_cache
+from app.models import User, GroupUser, Group, GroupMessage, Change
+from app.schema.schema_validator import group_messages_validator
+from app.utils import send_result, send_error, get_datetime_now, get_timestamp_now, send_ndjson, parse_cursor
 
 api = Blueprint('groups', __name__)
 
@@ -45,11 +50,14 @@ def create_group():
     new_group = Group(id=group_id, group_name=group_name, created_date=created_date)
     db.session.add(new_group)
     # insert new values to table group_user
+    members_id = []
     for user_id in users_id:
         user = User.get_by_id(user_id)
         if user:
             new_obj = GroupUser(user_id=user_id, group_id=group_id)
             db.session.add(new_obj)
+            members_id.append(user_id)
+    Change.record(members_id, Change.GROUP_INFO, Change.NEW, None, group_id)
 
     db.session.commit()
 
@@ -81,6 +89,7 @@ def update_group(group_id):
 
     group.group_name = group_name
     group.modified_date = get_datetime_now()
+    Change.record(GroupUser.get_members_id(group_id), Change.GROUP_INFO, Change.EDITED, None, group_id)
     db.session.commit()
 
     return send_result()
@@ -109,14 +118,19 @@ def update_member(group_id):
         logger.error('{} Parameters error: '.format(get_datetime_now().strftime('%Y-%b-%d %H:%M:%S')) + str(ex))
         return send_error(message="Parameters error: " + str(ex))
 
-    check = GroupUser.query.filter_by(user_id=user_id, group_id=group_id).first()
-    if status == "add" and check is None:
+    members_id = GroupUser.get_members_id(group_id)
+    if status == "add" and user_id not in members_id:
         new_obj = GroupUser(user_id=user_id, group_id=group_id)
         db.session.add(new_obj)
+        Change.record([user_id], Change.GROUP_INFO, Change.NEW, None, group_id)
+        Change.record(members_id, Change.GROUP_INFO, Change.EDITED, None, group_id)
         db.session.commit()
         return send_result()
 
-    GroupUser.query.filter_by(user_id=user_id, group_id=group_id).delete()
+    if status != "add" and user_id in members_id:
+        GroupUser.query.filter_by(user_id=user_id, group_id=group_id).delete()
+        Change.record([user_id], Change.GROUP_INFO, Change.DELETED, None, group_id)
+        Change.record(members_id - {user_id}, Change.GROUP_INFO, Change.EDITED, None, group_id)
     db.session.commit()
 
     return send_result()
@@ -124,6 +138,7 @@ def update_member(group_id):
 
 @api.route('', methods=['GET'])
 @jwt_required
+@read_replica
 def get_all():
     """ This is api for .
 
@@ -145,6 +160,7 @@ def get_all():
 
 @api.route('/<string:group_id>', methods=['GET'])
 @jwt_required
+@read_replica
 def get_by_id(group_id):
     """ This is api for .
 
@@ -164,10 +180,74 @@ def get_by_id(group_id):
     return send_result(data=group)
 
 
+@api.route('/<string:group_id>/messages', methods=['POST'])
+@jwt_required
+def send_messages(group_id):
+    """ This api sends a message of an end-to-end encrypted group: one ciphertext per member, encrypted with the
+    pub_key of the member, in one request. Every receiver gets its copy on new_group_cipher.
+
+        Request Body:
+
+            messages: list of {receiver_id, message}, at most one per member
+
+        Returns:
+
+            messages: the stored copies
+            missing: members without a copy
+
+        Examples::
+
+            POST /api/v1/groups/<group_id>/messages
+            {"messages": [{"receiver_id": "<user_id>", "message": "<ciphertext>"}, ...]}
+    """
+    try:
+        json_data = request.get_json()
+        validate(instance=json_data, schema=group_messages_validator)
+        copies = json_data['messages']
+    except Exception as ex:
+        logger.error('{} Parameters error: '.format(get_datetime_now().strftime('%Y-%b-%d %H:%M:%S')) + str(ex))
+        return send_error(message="Parameters error: " + str(ex))
+
+    try:
+        result = send_group_copies(get_jwt_identity(), group_id, copies)
+    except ValueError as ex:
+        return send_error(message=str(ex))
+
+    return send_result(data=result)
+
+
+@api.route('/<string:group_id>/export', methods=['GET'])
+@jwt_required
+@read_replica
+def export(group_id):
+    """ This api streams all messages of a group as NDJSON, from the oldest message.
+
+        Requests Params:
+
+            after: string, cursor of the last received line to resume an interrupted export
+            gzip: 1 to gzip the stream
+
+        Returns:
+
+            one message json per line, with its cursor
+
+        Examples::
+
+            GET /api/v1/groups/<group_id>/export?after=1614600000:457c17c8-7a74-11eb-9439-0242ac130002
+    """
+    member = GroupUser.query.filter_by(user_id=get_jwt_identity(), group_id=group_id).first()
+    if member is None:
+        return send_error(message="Not found error!")
+
+    after = parse_cursor(request.args.get('after'))
+    rows = GroupMessage.stream_messages(group_id, after=after, receiver_id=get_jwt_identity())
+    return send_ndjson(rows, GroupMessage.many_to_json, compress=request.args.get('gzip', 0, type=int) == 1)
+
+
 @api.route('/<string:group_id>', methods=['DELETE'])
 @jwt_required
 def delete(group_id):
-    """ This is api for .
+    """ This api deletes a group with its members and messages, for the members of the group only.
 
         Request Body:
 
@@ -176,5 +256,18 @@ def delete(group_id):
         Examples::
     """
 
+    member = GroupUser.query.filter_by(user_id=get_jwt_identity(), group_id=group_id).first()
+    if member is None:
+        return send_error(message="Not found error!")
+
+    Change.record(GroupUser.get_members_id(group_id), Change.GROUP_INFO, Change.DELETED, None, group_id)
+    # bulk deletes skip the cascade of Group.group_user, the rows referencing the group go first
+    GroupMessage.query.filter_by(group_id=group_id).delete()
+    GroupUser.query.filter_by(group_id=group_id).delete()
     Group.query.filter_by(id=group_id).delete()
+    model_cache.invalidate(Group, group_id)
+    cache = current_app.extensions.get('recent_messages')
+    if cache is not None:
+        cache.discard(group_id)
+    db.session.commit()
     return send_result()
@@ -0,0 +1,115 @@
+import json
+
+from flask import Blueprint, request, Response, stream_with_context, current_app
+from flask_jwt_extended import jwt_required, get_jwt_identity
+
+from app.models import Change, Message, GroupMessage, Group, GroupUser
+from app.utils import get_version
+
+api = Blueprint('sync', __name__)
+
+
+@api.route('', methods=['GET'])
+@jwt_required
+def sync():
+    """ This api returns every change of the private and group conversations and of the groups of the current user
+    since a cursor, a device coming back online catches up in one request instead of one history request per
+    conversation.
+
+    Requests Params:
+
+        since: int, the cursor returned by the previous sync, 0 for the first sync
+        limit: int, max number of changes, has_more is true when there are more changes to fetch
+
+    Returns:
+
+        changes: list of {seq, kind, action, message_id, group_id, created_date, message}
+        message is the current message for new and edited changes, null if it has been deleted
+        group_info changes (group created, renamed, members changed, left or deleted) have group instead of
+        message: {id, group_name, created_date, modified_date, members_id}, null if the group has been deleted
+        cursor: int, since of the next sync
+
+    Examples::
+
+        GET /api/v1/sync?since=1024
+
+    """
+    since = request.args.get('since', 0, type=int)
+    max_changes = current_app.config.get('SYNC_MAX_CHANGES', 5000)
+    limit = min(request.args.get('limit', max_changes, type=int), max_changes)
+    chunk_size = current_app.config.get('SYNC_CHUNK_SIZE', 500)
+    current_user_id = get_jwt_identity()
+
+    def generate():
+        # same envelope as send_result, streamed chunk by chunk
+        yield '{"jsonrpc": "2.0", "status": true, "code": 200, "message": "OK", "data": {"changes": ['
+        cursor = since
+        sent = 0
+        has_more = False
+        while sent < limit:
+            changes = Change.get_since(current_user_id, since=cursor, limit=min(chunk_size, limit - sent) + 1)
+            has_more = len(changes) > min(chunk_size, limit - sent)
+            changes = changes[:min(chunk_size, limit - sent)]
+            if not changes:
+                break
+            messages = _get_messages(changes)
+            groups = _get_groups(changes)
+            items = []
+            for change in changes:
+                item = change.to_json()
+                if change.kind == Change.GROUP_INFO:
+                    item["group"] = groups.get(change.group_id) if change.action != Change.DELETED else None
+                else:
+                    item["message"] = messages.get((change.kind, change.message_id)) \
+                        if change.action in (Change.NEW, Change.EDITED) else None
+                items.append(json.dumps(item))
+            yield (',' if sent else '') + ','.join(items)
+            sent += len(changes)
+            cursor = changes[-1].seq
+            if not has_more:
+                break
+        yield '], "cursor": {}, "has_more": {}}}, "version": {}}}'.format(cursor, json.dumps(has_more),
+                                                                           json.dumps(get_version(1)))
+
+    return Response(stream_with_context(generate()), mimetype='application/json')
+
+
+def _get_messages(changes):
+    """
+    Load the messages of a chunk of changes with one query per kind
+    Returns:
+        dict (kind, message id) -> message json
+    """
+    messages = {}
+    for kind, model in ((Change.PRIVATE, Message), (Change.GROUP, GroupMessage)):
+        loaded = [change for change in changes
+                  if change.kind == kind and change.action in (Change.NEW, Change.EDITED)]
+        if not loaded:
+            continue
+        ids = [change.message_id for change in loaded]
+        if model is Message:
+            objects = Message.get_many(ids, [change.group_id for change in loaded])
+        else:
+            objects = model.query.filter(model.id.in_(ids)).all()
+        for item in model.many_to_json(objects):
+            messages[(kind, item["id"])] = item
+    return messages
+
+
+def _get_groups(changes):
+    """
+    Load the groups of the group_info changes of a chunk with their members, two queries
+    Returns:
+        dict group id -> group json with members_id
+    """
+    groups_id = {change.group_id for change in changes
+                 if change.kind == Change.GROUP_INFO and change.action != Change.DELETED}
+    if not groups_id:
+        return {}
+    groups = {group.id: dict(group.to_json(), members_id=[])
+              for group in Group.query.filter(Group.id.in_(groups_id))}
+    for user_id, group_id in GroupUser.query.with_entities(GroupUser.user_id, GroupUser.group_id).filter(
+            GroupUser.group_id.in_(groups_id)):
+        if group_id in groups:
+            groups[group_id]["members_id"].append(user_id)
+    return groups
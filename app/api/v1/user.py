@@ -7,12 +7,14 @@ from jsonschema import validate
 from werkzeug.security import check_password_hash, safe_str_cmp
 from werkzeug.utils import secure_filename
 
+from app.decorators import read_replica, user_fields
 from app.enums import AVATAR_PATH, AVATAR_PATH_SEVER, DEFAULT_AVATAR
+from app.model_cache import model_cache
 from app.models import User, Token, GroupUser, Group, Message, Friend
 from app.schema.schema_validator import user_validator, password_validator
-from app.socket_handler import online_users
+from app.presence import get_user_sessions
 from app.utils import send_result, send_error, hash_password, get_datetime_now, is_password_contain_space, \
-    get_timestamp_now, allowed_file_img, generate_id
+    get_timestamp_now, allowed_file_img, generate_id, conversation_ids
 from app.extensions import logger, db
 
 api = Blueprint('users', __name__)
@@ -103,6 +105,7 @@ def update_user(user_id):
 
 @api.route('/profile', methods=['PUT'])
 @jwt_required
+@user_fields('id')
 def update_info():
     """ This is api for all user edit their profile.
 
@@ -141,6 +144,7 @@ def update_info():
 
 @api.route('/change_password', methods=['PUT'])
 @jwt_required
+@user_fields('id', 'password_hash')
 def change_password():
     """ This api for all user change their password.
 
@@ -192,6 +196,7 @@ def delete_user(user_id):
 
     """
     User.query.filter_by(id=user_id).delete()
+    model_cache.invalidate(User, user_id)
     # revoke all token of reset user  from database
     Token.revoke_all_token(user_id)
 
@@ -200,6 +205,7 @@ def delete_user(user_id):
 
 @api.route('', methods=['GET'])
 @jwt_required
+@read_replica
 def get_all_users():
     """ This api gets all users.
 
@@ -219,6 +225,7 @@ def get_all_users():
 
 @api.route('/<user_id>', methods=['GET'])
 @jwt_required
+@read_replica
 def get_user_by_id(user_id):
     """ This api get information of a user.
 
@@ -232,12 +239,15 @@ def get_user_by_id(user_id):
     if not user:
         return send_error(message="User not found.")
     user = user.to_json()
-    user["online"] = True if online_users.get(user_id) else False,
+    user["online"] = True if get_user_sessions(user_id) else False
     return send_result(data=user)
 
 
 @api.route('/profile', methods=['GET'])
 @jwt_required
+@read_replica
+@user_fields('id', 'username', 'display_name', 'gender', 'force_change_password', 'created_date', 'avatar_path',
+             'pub_key', 'last_seen')
 def get_profile():
     """ This api for the user get their information.
 
@@ -254,6 +264,7 @@ def get_profile():
 
 @api.route('/chats', methods=['GET'])
 @jwt_required
+@read_replica
 def get_chats():
     """ This api for the user get their list chats.
 
@@ -270,12 +281,13 @@ def get_chats():
 
     friends = Friend.get_friends(current_user_id, page=page, page_size=page_size)
 
-    for friend in friends:
-        group_id = generate_id(current_user_id, friend["id"])
-        message = Message.query.filter_by(group_id=group_id).order_by(Message.created_date.desc()).first()
+    groups_id = conversation_ids(current_user_id, [friend["id"] for friend in friends])
+    for friend, group_id in zip(friends, groups_id):
+        message = Message.get_latest(group_id)
         friend["latest_message"] = None
         if message:
-            friend["latest_message"] = message.to_json()
+            # a row, or a tuple of the recent messages cache or of the archive
+            friend["latest_message"] = Message.many_to_json([message])[0]
 
     return send_result(data=friends)
 
@@ -325,6 +337,7 @@ def delete_friend(user_id):
         return send_error(message="Not found friend")
     Friend.query.filter_by(user_id_1=current_user_id, user_id_2=user_id).delete()
     Friend.query.filter_by(user_id_1=user_id, user_id_2=current_user_id).delete()
+    model_cache.invalidate(Friend, generate_id(current_user_id, user_id))
     db.session.commit()
 
     return send_result()
@@ -332,6 +345,7 @@ def delete_friend(user_id):
 
 @api.route('/friends', methods=['GET'])
 @jwt_required
+@read_replica
 def get_friends():
     """ This api for .
 
@@ -351,6 +365,7 @@ def get_friends():
 
 @api.route('/avatar', methods=['PUT'])
 @jwt_required
+@user_fields('id', 'avatar_path')
 def change_avatar():
     """ This api for all user change their avatar.
 
@@ -5,6 +5,19 @@ from time import strftime
 from flask import Flask, request
 from flask_cors import CORS
 from app.extensions import jwt, logger, db, ma, sio
+from app.archive import message_archive
+from app.broadcast import broadcaster
+from app.cpu_profiler import cpu_profiler
+from app.metrics import metrics
+from app.model_cache import model_cache
+from app.outbound import outbound
+from app.presence import presence
+from app.query_profiler import query_profiler
+from app.recent_messages import recent_messages
+from app.replicas import replica_router
+from app.socket_auth import socket_auth
+from app.tracing import tracer
+from app.transport import transport_policy, server_options
 from .api import v1 as api_v1
 from .settings import ProdConfig
 
@@ -35,7 +48,20 @@ def register_extensions(app):
     db.init_app(app)  # SQLAlchemy
     ma.init_app(app)  # Marshmallow json parser and validator
     jwt.init_app(app)
-    sio.init_app(app)
+    sio.init_app(app, **server_options(app.config))
+    transport_policy.init_app(app)  # SOCKETIO_TRANSPORTS
+    metrics.init_app(app)  # latency histograms, exposed on /metrics
+    query_profiler.init_app(app)  # opt-in, SQL_PROFILER_ENABLED
+    cpu_profiler.init_app(app)  # opt-in, PROFILER_TOKEN or PROFILER_SAMPLE_RATE
+    tracer.init_app(app)  # opt-in, TRACING_ENABLED
+    presence.init_app(app)
+    socket_auth.init_app(app)  # SOCKET_AUTH_ON_CONNECT
+    broadcaster.init_app(app)  # BROADCAST_TICK
+    outbound.init_app(app)  # OUTBOUND_HIGH_WATER
+    replica_router.init_app(app)  # opt-in, SQLALCHEMY_REPLICAS
+    message_archive.init_app(app)  # ARCHIVE_ENABLED
+    recent_messages.init_app(app)  # RECENT_CACHE_ENABLED
+    model_cache.init_app(app)  # MODEL_CACHE_ENABLED
 
     @sio.on_error()  # Handles the default namespace
     def error_handler(e):
@@ -91,4 +117,5 @@ def register_blueprints(app):
     app.register_blueprint(api_v1.user.api, url_prefix='/api/v1/users')
     app.register_blueprint(api_v1.chat.api, url_prefix='/api/v1/chats')
     app.register_blueprint(api_v1.group.api, url_prefix='/api/v1/groups')
+    app.register_blueprint(api_v1.sync.api, url_prefix='/api/v1/sync')
 
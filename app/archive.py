@@ -0,0 +1,272 @@
+import gzip
+import json
+import threading
+from collections import namedtuple, OrderedDict
+
+from app.extensions import db
+from app.metrics import metrics
+from app.models import Message, ArchiveSegment
+from app.utils import get_timestamp_now
+
+ArchivedMessage = namedtuple('ArchivedMessage', ['id', 'message', 'sender_id', 'created_date', 'seen'])
+
+
+def encode(messages):
+    """
+    Segment data: one JSON list per message, gzip compressed
+    Args:
+        messages: list of ArchivedMessage ordered by (created_date, id)
+    """
+    return gzip.compress('\n'.join(json.dumps(list(message)) for message in messages).encode(), compresslevel=6)
+
+
+def decode(data):
+    return [ArchivedMessage(*json.loads(line)) for line in gzip.decompress(data).decode().split('\n') if line]
+
+
+class MessageArchive(object):
+    """
+    Cold tier of the private messages. migrate/archive_messages.py moves the messages older than ARCHIVE_AFTER_DAYS
+    into compressed segments of ARCHIVE_SEGMENT_SIZE messages per conversation (ArchiveSegment), the messages table
+    and its index_get index keep the recent messages only.
+    Message.get_messages, Message.get_messages_before and Message.stream_messages continue here when a client
+    reads past the hot messages. The boundaries of the segments are read first, a segment is loaded and
+    decoded only when one of its messages is needed, the last ARCHIVE_CACHE_SEGMENTS decoded segments are kept.
+    Sync and pending deliveries find archived messages by id (find), a deleted message is removed from its
+    segment (delete).
+    """
+
+    def __init__(self):
+        self.app = None
+        self.after_days = 90
+        self.segment_size = 1000
+        self.cache_segments = 64
+        self._cache = OrderedDict()  # (segment id, count) -> list of ArchivedMessage
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        """
+        Init the archive, do nothing if ARCHIVE_ENABLED is False
+        :param app:
+        :return:
+        """
+        self.app = None
+        self._cache.clear()
+        if not app.config.get('ARCHIVE_ENABLED'):
+            return
+        self.app = app
+        self.after_days = app.config.get('ARCHIVE_AFTER_DAYS', 90)
+        self.segment_size = app.config.get('ARCHIVE_SEGMENT_SIZE', 1000)
+        self.cache_segments = app.config.get('ARCHIVE_CACHE_SEGMENTS', 64)
+        app.extensions['message_archive'] = self
+
+        metrics.describe('archive_reads_total', 'counter', 'Message reads continued in the archive')
+        metrics.describe('archive_segment_loads_total', 'counter', 'Archive segments needed, from the cache or not')
+
+    def load(self, segment):
+        """
+        Decoded messages of a segment, oldest first
+        """
+        key = (segment.id, segment.count, segment.last_id)  # a rewritten segment gets a new count or last id
+        with self._lock:
+            messages = self._cache.get(key)
+            if messages is not None:
+                self._cache.move_to_end(key)
+        if messages is not None:
+            metrics.inc('archive_segment_loads_total', (('result', 'hit'),))
+            return messages
+
+        metrics.inc('archive_segment_loads_total', (('result', 'miss'),))
+        messages = decode(ArchiveSegment.get_data(segment.id))
+        with self._lock:
+            self._cache[key] = messages
+            while len(self._cache) > self.cache_segments:
+                self._cache.popitem(last=False)
+        return messages
+
+    def get_page(self, group_id, offset=0, limit=10):
+        """
+        Archived messages of a conversation, newest first
+        Args:
+            group_id:
+            offset: number of archived messages to skip
+            limit:
+
+        Returns:
+            list of ArchivedMessage
+        """
+        metrics.inc('archive_reads_total', (('kind', 'page'),))
+        messages = []
+        for segment in ArchiveSegment.get_segments(group_id):
+            if len(messages) >= limit:
+                break
+            if offset >= segment.count:
+                # skip the whole segment without loading it
+                offset -= segment.count
+                continue
+            newest_first = self.load(segment)[::-1]
+            messages.extend(newest_first[offset:offset + limit - len(messages)])
+            offset = 0
+        return messages
+
+    def get_before(self, group_id, before=None, limit=10):
+        """
+        Archived messages of a conversation older than a cursor, newest first
+        Args:
+            group_id:
+            before: (created_date, id), None for the newest archived messages
+            limit:
+
+        Returns:
+            list of ArchivedMessage
+        """
+        metrics.inc('archive_reads_total', (('kind', 'cursor'),))
+        messages = []
+        for segment in ArchiveSegment.get_segments(group_id):
+            if len(messages) >= limit:
+                break
+            if before is not None and (segment.first_date, segment.first_id) >= tuple(before):
+                continue
+            for message in reversed(self.load(segment)):
+                if before is None or (message.created_date, message.id) < tuple(before):
+                    messages.append(message)
+                    if len(messages) >= limit:
+                        break
+        return messages
+
+    def stream(self, group_id, after=None):
+        """
+        Archived messages of a conversation, oldest first
+        Args:
+            group_id:
+            after: (created_date, id) of the last message already read
+
+        Returns:
+            iterator of ArchivedMessage
+        """
+        metrics.inc('archive_reads_total', (('kind', 'stream'),))
+        for segment in reversed(ArchiveSegment.get_segments(group_id)):
+            if after is not None and (segment.last_date, segment.last_id) <= tuple(after):
+                continue
+            for message in self.load(segment):
+                if after is None or (message.created_date, message.id) > tuple(after):
+                    yield message
+
+    def find(self, group_id, messages_id):
+        """
+        Archived messages of a conversation by id, the segments are read newest first until all are found
+        Args:
+            group_id:
+            messages_id: list of message id
+
+        Returns:
+            dict id -> ArchivedMessage
+        """
+        metrics.inc('archive_reads_total', (('kind', 'id'),))
+        wanted = set(messages_id)
+        found = {}
+        for segment in ArchiveSegment.get_segments(group_id):
+            if not wanted:
+                break
+            for message in self.load(segment):
+                if message.id in wanted:
+                    found[message.id] = message
+                    wanted.discard(message.id)
+        return found
+
+    def delete(self, group_id, message_id):
+        """
+        Remove an archived message from its segment, the segment is rewritten (or deleted with its last message)
+        in the transaction of the session
+        Args:
+            group_id:
+            message_id:
+
+        Returns:
+            the deleted ArchivedMessage, None if the conversation has no such archived message
+        """
+        for segment in ArchiveSegment.get_segments(group_id):
+            if all(message.id != message_id for message in self.load(segment)):
+                continue
+            # locked and read again, the archive job may be filling this segment
+            segment = ArchiveSegment.query.filter_by(id=segment.id).with_for_update().populate_existing().first()
+            if segment is None:
+                return None
+            messages = decode(ArchiveSegment.get_data(segment.id))
+            deleted = next((message for message in messages if message.id == message_id), None)
+            messages = [message for message in messages if message.id != message_id]
+            if not messages:
+                db.session.delete(segment)
+            else:
+                segment.first_date, segment.first_id = messages[0].created_date, messages[0].id
+                segment.last_date, segment.last_id = messages[-1].created_date, messages[-1].id
+                segment.count = len(messages)
+                segment.data = encode(messages)
+            cache = self.app.extensions.get('recent_messages')
+            if cache is not None:
+                cache.discard(group_id)
+            return deleted
+        return None
+
+    def archive_conversation(self, group_id, before):
+        """
+        Move the messages of a conversation older than a timestamp to its segments, one transaction per segment.
+        The last segment is filled up before a new one is started
+        Args:
+            group_id:
+            before: timestamp, older messages are archived
+
+        Returns:
+            number of archived messages
+        """
+        count = 0
+        while True:
+            segments = ArchiveSegment.get_segments(group_id)
+            last = segments[0] if segments and segments[0].count < self.segment_size else None
+            limit = self.segment_size - (last.count if last else 0)
+            # locked until the commit, a message deleted or seen meanwhile is not archived in its old state
+            rows = Message.query.filter(Message.group_id == group_id, Message.created_date < before).order_by(
+                Message.created_date, Message.id).limit(limit).with_for_update().all()
+            if not rows:
+                db.session.rollback()
+                return count
+
+            messages = [ArchivedMessage(row.id, row.message, row.sender_id, row.created_date, bool(row.seen))
+                        for row in rows]
+            if last is not None:
+                messages = self.load(last) + messages
+                segment = last
+            else:
+                segment = ArchiveSegment(group_id=group_id, created_date=get_timestamp_now())
+                db.session.add(segment)
+            segment.first_date, segment.first_id = messages[0].created_date, messages[0].id
+            segment.last_date, segment.last_id = messages[-1].created_date, messages[-1].id
+            segment.count = len(messages)
+            segment.data = encode(messages)
+            Message.query.filter(Message.id.in_([row.id for row in rows])).delete(synchronize_session=False)
+            cache = self.app.extensions.get('recent_messages')
+            if cache is not None:
+                cache.discard(group_id)
+            db.session.commit()
+            count += len(rows)
+
+    def archive(self, before=None, dry_run=False):
+        """
+        Archive every conversation
+        Args:
+            before: timestamp, default ARCHIVE_AFTER_DAYS ago
+            dry_run: only count the messages to archive
+
+        Returns:
+            dict group_id -> number of archived messages
+        """
+        if before is None:
+            before = get_timestamp_now() - self.after_days * 24 * 3600
+        counts = dict(db.session.query(Message.group_id, db.func.count()).filter(
+            Message.created_date < before).group_by(Message.group_id).all())
+        if dry_run:
+            return counts
+        return {group_id: self.archive_conversation(group_id, before) for group_id in counts}
+
+
+message_archive = MessageArchive()
@@ -0,0 +1,123 @@
+import threading
+
+from socketio import packet
+
+from app.extensions import sio, logger
+from app.metrics import metrics
+
+
+class EncodedPacket(packet.Packet):
+    """
+    Socket.IO packet encoded once, the same frame is written to every member of a room
+    """
+
+    def __init__(self, namespace, data):
+        super(EncodedPacket, self).__init__(packet.EVENT, data=data, namespace=namespace)
+        self._encoded = super(EncodedPacket, self).encode()
+
+    def encode(self):
+        return self._encoded
+
+
+class RoomBroadcaster(object):
+    """
+    Room emits encoded once: sio.emit encodes the packet again for every member of the room, here the frame is
+    encoded once and written to the queue of every member (through the outbound queues).
+    With BROADCAST_TICK, the events of the rooms of at least BROADCAST_MIN_MEMBERS members are gathered during
+    the tick and sent as one room_batch event {room, events: [{event, data}]}, a tick with a single event sends it
+    as is. Smaller rooms and BROADCAST_TICK = 0 send at once.
+    """
+
+    def __init__(self):
+        self.app = None
+        self.tick = 0
+        self.min_members = 50
+        self.max_batch = 100
+        self._pending = {}  # (namespace, room) -> list of [event, data], in emit order
+        self._lock = threading.Lock()
+        self._task = None
+
+    def init_app(self, app):
+        """
+        Init the scheduler of the room broadcasts
+        :param app:
+        :return:
+        """
+        self.app = app
+        self.tick = app.config.get('BROADCAST_TICK', 0)
+        self.min_members = app.config.get('BROADCAST_MIN_MEMBERS', 50)
+        self.max_batch = app.config.get('BROADCAST_MAX_BATCH', 100)
+        with self._lock:
+            self._pending.clear()
+
+        metrics.describe('broadcast_events_total', 'counter', 'Room events emitted, sent at once or batched')
+        metrics.describe('broadcast_frames_total', 'counter', 'Room frames encoded')
+        metrics.describe('broadcast_deliveries_total', 'counter', 'Room frames written to a connection')
+
+    def members(self, room, namespace='/'):
+        return len(sio.server.manager.rooms.get(namespace, {}).get(room, {}))
+
+    def emit(self, event, data, room=None, namespace='/'):
+        """
+        Emit an event to every member of a room, like sio.emit
+        Args:
+            event: socket event
+            data: payload
+            room: room, None for every connection of the namespace
+            namespace:
+        """
+        key = (namespace, room)
+        batched = self.tick and (key in self._pending or self.members(room, namespace) >= self.min_members)
+        metrics.inc('broadcast_events_total', (('mode', 'batched' if batched else 'direct'),))
+        if not batched:
+            return self.write(namespace, room, [event, data])
+        with self._lock:
+            self._pending.setdefault(key, []).append([event, data])
+            start = self._task is None
+            self._task = True
+        # started outside the lock, under eventlet starting a task yields to the hub
+        if start:
+            self._task = sio.start_background_task(self._run)
+
+    def write(self, namespace, room, data):
+        """
+        Encode a frame once and write it to the members of the room
+        Returns:
+            number of connections the frame was written to
+        """
+        if namespace not in sio.server.manager.rooms or room not in sio.server.manager.rooms[namespace]:
+            return 0
+        pkt = EncodedPacket(namespace, data)
+        metrics.inc('broadcast_frames_total', ())
+        count = 0
+        for sid in sio.server.manager.get_participants(namespace, room):
+            sio.server._send_packet(sid, pkt)
+            count += 1
+        metrics.inc('broadcast_deliveries_total', (), count)
+        return count
+
+    def _run(self):
+        while True:
+            sio.sleep(self.tick)
+            try:
+                self.flush()
+            except Exception as ex:
+                logger.error('Room broadcast error: ' + str(ex))
+
+    def flush(self):
+        """
+        Send the events gathered during the tick, one frame per room and BROADCAST_MAX_BATCH events
+        """
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        for (namespace, room), events in pending.items():
+            if len(events) == 1:
+                self.write(namespace, room, events[0])
+                continue
+            for index in range(0, len(events), self.max_batch):
+                self.write(namespace, room, ['room_batch', {
+                    'room': room, 'events': [{'event': event, 'data': data}
+                                             for event, data in events[index:index + self.max_batch]]}])
+
+
+broadcaster = RoomBroadcaster()
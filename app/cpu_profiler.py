@@ -0,0 +1,222 @@
+import hmac
+import os
+import random
+import sys
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from time import monotonic, sleep, thread_time
+
+from flask import g, request
+
+try:
+    from greenlet import getcurrent
+except ImportError:
+    getcurrent = None
+
+from app.decorators import socket_event_hooks
+from app.metrics import metrics
+
+PROFILE_HEADER = 'X-Profile'
+
+
+class CpuProfiler(object):
+    """
+    Sampling CPU profiler switched on at runtime, for one request with the protected X-Profile header or
+    for a percentage of the requests and socket events (PROFILER_SAMPLE_RATE).
+    A background thread samples the call stack of the threads, or of the greenlets under eventlet, running a
+    profiled request every PROFILER_INTERVAL seconds, the stacks are aggregated per endpoint/event into
+    collapsed-stack files (PROFILER_OUTPUT_DIR/<endpoint>.collapsed) ready for flamegraph.pl or speedscope.
+    The CPU time spent by the sampler thread is exposed as profiler_overhead_seconds_total.
+    """
+
+    def __init__(self):
+        self.token = None
+        self.sample_rate = 0.0
+        self.interval = 0.01
+        self.max_depth = 64
+        self.output_dir = 'logs/profiles'
+        self.flush_interval = 10
+        self.samples = 0
+        self.overhead = 0.0
+        self._targets = {}  # task key -> (greenlet, thread ident, label of the profiled request or event)
+        self._stacks = {}  # label -> Counter of collapsed stacks
+        self._dirty = set()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def init_app(self, app):
+        """
+        Init the profiler, do nothing if neither PROFILER_TOKEN nor PROFILER_SAMPLE_RATE is set
+        :param app:
+        :return:
+        """
+        self.token = app.config.get('PROFILER_TOKEN')
+        self.sample_rate = app.config.get('PROFILER_SAMPLE_RATE', 0.0)
+        if not self.token and not self.sample_rate:
+            return
+        self.interval = app.config.get('PROFILER_INTERVAL', 0.01)
+        self.max_depth = app.config.get('PROFILER_MAX_DEPTH', 64)
+        self.output_dir = app.config.get('PROFILER_OUTPUT_DIR', 'logs/profiles')
+        self.flush_interval = app.config.get('PROFILER_FLUSH_INTERVAL', 10)
+
+        metrics.describe('profiler_samples_total', 'counter', 'Stacks sampled by the CPU profiler')
+        metrics.describe('profiler_overhead_seconds_total', 'counter', 'CPU time spent by the sampler thread')
+        metrics.describe('profiler_active', 'gauge', 'Requests and socket events being profiled')
+        metrics.add_collector(self.collect)
+
+        app.before_request(self._before_request)
+        app.teardown_request(self._teardown_request)
+        if self.track_event not in socket_event_hooks:
+            socket_event_hooks.append(self.track_event)
+
+    def is_profiled(self):
+        """
+        Profile the current request if it has the profiler token in the X-Profile header, or pick it randomly
+        with the probability PROFILER_SAMPLE_RATE
+        Returns:
+            True if the current request has to be profiled
+        """
+        header = request.headers.get(PROFILE_HEADER)
+        if header and self.token and hmac.compare_digest(header, self.token):
+            return True
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    @staticmethod
+    def _current_task():
+        """
+        The running greenlet and thread: the greenlets of eventlet share one thread, they are told apart by
+        id(greenlet), the plain threads have their own main greenlet
+        Returns:
+            (key, greenlet or None, thread ident)
+        """
+        ident = threading.get_ident()
+        if getcurrent is None:
+            return ident, None, ident
+        current = getcurrent()
+        return id(current), current, ident
+
+    def start(self, label):
+        """
+        Start sampling the current greenlet or thread
+        Args:
+            label: endpoint or socket event, the root frame of the collapsed stacks
+
+        Returns:
+            the label previously sampled on this greenlet
+        """
+        key, current, ident = self._current_task()
+        with self._lock:
+            previous = self._targets.get(key)
+            self._targets[key] = (current, ident, label)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='cpu-profiler', daemon=True)
+                self._thread.start()
+        self._wakeup.set()
+        return previous[2] if previous else None
+
+    def stop(self, previous=None):
+        """
+        Stop sampling the current greenlet or thread
+        Args:
+            previous: label returned by start, sampled again when nested profiles end
+        """
+        key, current, ident = self._current_task()
+        with self._lock:
+            if previous is None:
+                self._targets.pop(key, None)
+            else:
+                self._targets[key] = (current, ident, previous)
+
+    def _before_request(self):
+        if self.is_profiled():
+            g.cpu_profile = self.start(request.endpoint or 'unmatched') or ''
+
+    def _teardown_request(self, exc):
+        previous = g.pop('cpu_profile', None)
+        if previous is not None:
+            self.stop(previous or None)
+
+    @contextmanager
+    def track_event(self, event, namespace):
+        """
+        Hook of the socket_event decorator, profile a percentage of the socket events
+        Args:
+            event:
+            namespace:
+        """
+        if not (self.sample_rate > 0 and random.random() < self.sample_rate):
+            yield
+            return
+        previous = self.start('socket:' + event)
+        try:
+            yield
+        finally:
+            self.stop(previous)
+
+    def _run(self):
+        last_flush = monotonic()
+        while True:
+            self._wakeup.clear()
+            with self._lock:
+                targets = dict(self._targets)
+            if not targets:
+                self.flush()
+                self._wakeup.wait()
+                continue
+
+            cpu_start = thread_time()
+            frames = sys._current_frames()
+            for current, ident, label in targets.values():
+                # a suspended greenlet keeps its stack in gr_frame, a running one is the top of its thread
+                frame = current.gr_frame if current is not None else None
+                if frame is None and not (current is not None and current.dead):
+                    frame = frames.get(ident)
+                if frame is not None:
+                    self._add_sample(label, frame)
+            del frames
+            if monotonic() - last_flush >= self.flush_interval:
+                self.flush()
+                last_flush = monotonic()
+            self.overhead += thread_time() - cpu_start
+            sleep(self.interval)
+
+    def _add_sample(self, label, frame):
+        names = []
+        while frame is not None and len(names) < self.max_depth:
+            code = frame.f_code
+            names.append('{} ({}:{})'.format(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+            frame = frame.f_back
+        names.append(label)
+        stack = ';'.join(reversed(names))
+        self._stacks.setdefault(label, Counter())[stack] += 1
+        self._dirty.add(label)
+        self.samples += 1
+
+    def flush(self):
+        """
+        Write the collapsed stacks of the labels sampled since the last flush, one file per label
+        """
+        if not self._dirty:
+            return
+        os.makedirs(self.output_dir, exist_ok=True)
+        dirty, self._dirty = self._dirty, set()
+        for label in dirty:
+            filename = label.replace('/', '_').replace(':', '_') + '.collapsed'
+            with open(os.path.join(self.output_dir, filename), 'w') as file:
+                for stack, count in self._stacks[label].most_common():
+                    file.write('{} {}\n'.format(stack, count))
+
+    def collect(self):
+        """
+        Collector of the metrics endpoint
+        """
+        return [
+            ('profiler_samples_total', (), self.samples),
+            ('profiler_overhead_seconds_total', (), self.overhead),
+            ('profiler_active', (), len(self._targets)),
+        ]
+
+
+cpu_profiler = CpuProfiler()
@@ -1,8 +1,16 @@
+from contextlib import ExitStack
 from functools import wraps
 
+from flask import g
+from flask_jwt_extended import get_jwt_identity
+
+from app.extensions import sio
 from app.models import User
 from app.utils import send_error
 
+# Context manager factories called as hook(event, namespace) around every handler registered with socket_event
+socket_event_hooks = []
+
 
 def admin_required():
     """
@@ -17,6 +25,65 @@ def admin_required():
                 return send_error(message='You do not have permission')
             return func(*args, **kwargs)
 
+        inner.user_fields = tuple(set(getattr(func, 'user_fields', ('id',))) | {'is_active'})
         return inner
 
     return wrapper
+
+
+def read_replica(func):
+    """
+    Let the reads of a read-only view go to a replica, put it under jwt_required so the token checks
+    stay on the primary, see app.replicas
+    """
+
+    @wraps(func)
+    def inner(*args, **kwargs):
+        g.read_replica = True
+        g.replica_identity = get_jwt_identity()
+        return func(*args, **kwargs)
+
+    return inner
+
+
+def user_fields(*fields):
+    """
+    Columns of the current user read by a view, they are loaded with the token check in one query and
+    User.get_current_user returns them for the rest of the request. Put it under jwt_required
+    Args:
+        *fields: column names, id is always loaded
+    """
+
+    def wrapper(func):
+        func.user_fields = ('id',) + tuple(field for field in fields if field != 'id')
+        return func
+
+    return wrapper
+
+
+def socket_event(event, namespace=None):
+    """
+    Register a Socket.IO event handler, the handler runs inside all hooks of socket_event_hooks
+    (metrics, profilers...) the same way before_request/after_request wrap a blueprint view
+    Args:
+        event: name of the event
+        namespace: namespace of the event, default is '/'
+
+    Returns:
+
+    """
+    namespace = namespace or '/'
+
+    def wrapper(func):
+        @wraps(func)
+        def inner(*args, **kwargs):
+            if not socket_event_hooks:
+                return func(*args, **kwargs)
+            with ExitStack() as stack:
+                for hook in socket_event_hooks:
+                    stack.enter_context(hook(event, namespace))
+                return func(*args, **kwargs)
+
+        return sio.on(event, namespace=namespace)(inner)
+
+    return wrapper
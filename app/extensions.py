@@ -3,7 +3,8 @@ import os
 
 from flask_marshmallow import Marshmallow
 from flask_socketio import SocketIO
-from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import orm
 from webargs.flaskparser import FlaskParser
 from flask_jwt_extended import JWTManager
 from logging.handlers import RotatingFileHandler
@@ -12,8 +13,28 @@ from logging.handlers import RotatingFileHandler
 parser = FlaskParser()
 jwt = JWTManager()
 
+
+class RoutingSession(SignallingSession):
+    """
+    Session asking the replica router (app.replicas) for the bind of every statement, the primary by default.
+    """
+
+    def get_bind(self, mapper=None, clause=None):
+        router = self.app.extensions.get('replicas')
+        if router is not None and (mapper is None or not mapper.persist_selectable.info.get('bind_key')):
+            bind = router.get_bind(self, clause)
+            if bind is not None:
+                return bind
+        return SignallingSession.get_bind(self, mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
 # init SQLAlchemy
-db = SQLAlchemy()
+db = RoutingSQLAlchemy()
 ma = Marshmallow()
 
 # init flask_socket io
@@ -26,3 +47,9 @@ app_log_handler = RotatingFileHandler('logs/app.log', maxBytes=1000000, backupCo
 logger = logging.getLogger('api')
 logger.setLevel(logging.DEBUG)
 logger.addHandler(app_log_handler)
+
+# slow query log of the query profiler
+slow_query_log_handler = RotatingFileHandler('logs/slow_query.log', maxBytes=1000000, backupCount=30)
+slow_query_logger = logging.getLogger('slow_query')
+slow_query_logger.setLevel(logging.DEBUG)
+slow_query_logger.addHandler(slow_query_log_handler)
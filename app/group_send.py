@@ -0,0 +1,59 @@
+from flask import current_app
+
+from app.extensions import db
+from app.ids import new_id
+from app.models import GroupMessage, GroupUser, Change
+from app.presence import get_user_sessions
+from app.tracing import tracer
+from app.utils import get_timestamp_now
+
+
+def send_group_copies(sender_id, group_id, copies):
+    """
+    Send a message of an end-to-end encrypted group: the sender encrypted it once per member with the member's
+    pub_key. The members are checked with one query, the copies and their changes are inserted with one multi-row
+    INSERT each in one transaction, then every copy is emitted on new_group_cipher to the sessions of its receiver.
+    Offline receivers get their copy with the next sync, the other devices of the sender get the sent copies.
+    Args:
+        sender_id:
+        group_id:
+        copies: list of {"receiver_id", "message"}, at most one copy per member
+
+    Returns:
+        {"messages": list of the stored copies, "missing": members without a copy}
+
+    Raises:
+        ValueError: the sender or a receiver is not a member of the group, or a member has two copies
+    """
+    max_recipients = current_app.config.get('GROUP_SEND_MAX_RECIPIENTS', 500)
+    if len(copies) > max_recipients:
+        raise ValueError("Too many recipients, max {}".format(max_recipients))
+    receivers_id = [copy['receiver_id'] for copy in copies]
+    if len(set(receivers_id)) != len(receivers_id):
+        raise ValueError("Duplicate receivers")
+
+    with tracer.span('group.check_members', group_id=group_id):
+        members_id = GroupUser.get_members_id(group_id)
+    if sender_id not in members_id:
+        raise ValueError("Not found group")
+    not_members = [receiver_id for receiver_id in receivers_id if receiver_id not in members_id]
+    if not_members:
+        raise ValueError("Not group members: {}".format(', '.join(not_members)))
+
+    created_date = get_timestamp_now()
+    messages = [{"id": new_id(), "message": copy['message'], "sender_id": sender_id, "group_id": group_id,
+                 "receiver_id": copy['receiver_id'], "created_date": created_date} for copy in copies]
+    with tracer.span('group.store_copies', group_id=group_id, copies=len(messages)):
+        GroupMessage.insert_many(messages)
+        # the other devices of the sender sync the copies it sent, like the receivers sync their own copy
+        Change.record_many(Change.GROUP, Change.NEW, group_id,
+                           [(user_id, message["id"]) for message in messages
+                            for user_id in {message["receiver_id"], sender_id}])
+        db.session.commit()
+
+    with tracer.span('group.deliver', group_id=group_id):
+        for message in messages:
+            for session_id in get_user_sessions(message["receiver_id"]):
+                tracer.emit('new_group_cipher', message, room=session_id)
+
+    return {"messages": messages, "missing": sorted(members_id - set(receivers_id) - {sender_id})}
@@ -0,0 +1,65 @@
+import os
+import threading
+import uuid
+from time import time
+
+from sqlalchemy.types import TypeDecorator, BINARY
+
+_lock = threading.Lock()
+_last = [0, 0]  # millisecond and sequence of the last id of the process
+
+
+def new_id():
+    """
+    Time-ordered id, UUID version 7 layout: 48 bits of unix milliseconds, a 12 bits sequence in the millisecond,
+    62 random bits. Ids of the same process increase, ids of a conversation are stored in insert order.
+    Returns:
+        canonical uuid string
+    """
+    with _lock:
+        millis = int(time() * 1000)
+        if millis > _last[0]:
+            _last[0], _last[1] = millis, int.from_bytes(os.urandom(2), 'big') & 0x3ff
+        else:
+            # same millisecond or clock going back: keep increasing
+            _last[1] += 1
+            if _last[1] > 0xfff:
+                _last[0], _last[1] = _last[0] + 1, 0
+        millis, sequence = _last
+    value = (millis & 0xffffffffffff) << 80 | 0x7 << 76 | sequence << 64 | 0x2 << 62 | \
+        int.from_bytes(os.urandom(8), 'big') & 0x3fffffffffffffff
+    return str(uuid.UUID(int=value))
+
+
+def id_to_bytes(value):
+    """
+    16 bytes of an id string. Another string is kept as its utf-8 bytes: a lookup matches no row, an insert fails
+    on MySQL (too long for BINARY(16))
+    """
+    if isinstance(value, bytes):
+        return value
+    try:
+        return uuid.UUID(value).bytes
+    except ValueError:
+        return str(value).encode()
+
+
+def id_from_bytes(value):
+    if isinstance(value, str):
+        return value  # row not converted yet, SQLite keeps the text
+    value = bytes(value)
+    return str(uuid.UUID(bytes=value)) if len(value) == 16 else value.decode('latin-1')
+
+
+class BinaryId(TypeDecorator):
+    """
+    Id stored in a BINARY(16) column, the application reads and writes the canonical uuid string.
+    The byte order is the order of the strings, so ranges and keyset cursors on ids stay valid.
+    """
+    impl = BINARY(16)
+
+    def process_bind_param(self, value, dialect):
+        return None if value is None else id_to_bytes(value)
+
+    def process_result_value(self, value, dialect):
+        return None if value is None else id_from_bytes(value)
@@ -0,0 +1,232 @@
+import threading
+import weakref
+from bisect import bisect_left
+from contextlib import contextmanager
+from time import perf_counter
+
+from flask import Response, g, request
+
+from app.decorators import socket_event_hooks
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class Metrics(object):
+    """
+    Latency histograms, request counts and error counts of the blueprint endpoints and the socket events,
+    exposed in the Prometheus text format.
+    Every thread records into its own shard so observe()/inc() never take a lock, shards are merged on scrape.
+    The shard of a finished thread (or greenlet) is folded into the retired totals, the live shards stay one per
+    running thread.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._local = threading.local()
+        self._shards = []
+        self._retired = ({}, {})  # histograms, counters of the finished threads
+        self._lock = threading.RLock()  # guards the list of shards and the retired totals, a retire can run in gc
+        self._descriptions = {}
+        self._collectors = []
+
+    def init_app(self, app):
+        """
+        Init metrics for the app: time every request, add the metrics endpoint and time every socket event
+        :param app:
+        :return:
+        """
+        if not app.config.get('METRICS_ENABLED', True):
+            return
+
+        self.describe('http_request_duration_seconds', 'histogram', 'Latency of the blueprint endpoints')
+        self.describe('http_request_errors_total', 'counter', 'Responses with status code >= 400')
+        self.describe('socketio_event_duration_seconds', 'histogram', 'Latency of the socket event handlers')
+        self.describe('socketio_event_errors_total', 'counter', 'Socket event handlers raised an exception')
+
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+        app.add_url_rule(app.config.get('METRICS_PATH', '/metrics'), 'metrics', self.export)
+        if self.track_event not in socket_event_hooks:
+            socket_event_hooks.append(self.track_event)
+
+    def _shard(self):
+        holder = getattr(self._local, 'holder', None)
+        if holder is None:
+            holder = _ShardHolder(({}, {}))  # histograms, counters
+            with self._lock:
+                self._shards.append(holder.shard)
+            # the thread-local holder goes away with its thread, the shard is folded into the retired totals
+            weakref.finalize(holder, self._retire, holder.shard)
+            self._local.holder = holder
+        return holder.shard
+
+    def _retire(self, shard):
+        with self._lock:
+            try:
+                self._shards.remove(shard)
+            except ValueError:
+                return
+            _merge(self._retired, shard)
+
+    def describe(self, name, metric_type, description):
+        """
+        Set the TYPE and HELP lines of a metric
+        Args:
+            name: metric name
+            metric_type: counter, gauge or histogram
+            description:
+        """
+        self._descriptions[name] = (metric_type, description)
+
+    def add_collector(self, collector):
+        """
+        Add a function called on every scrape, it returns a list of (name, labels, value) gauges
+        Args:
+            collector:
+        """
+        if collector not in self._collectors:
+            self._collectors.append(collector)
+
+    def observe(self, name, labels, seconds):
+        """
+        Record a duration in the histogram name{labels}
+        Args:
+            name: metric name
+            labels: tuple of (label, value) pairs
+            seconds: observed duration
+        """
+        histograms = self._shard()[0]
+        key = (name, labels)
+        values = histograms.get(key)
+        if values is None:
+            # one slot per bucket, one for +Inf, then the sum
+            values = histograms[key] = [0] * (len(self.buckets) + 1) + [0.0]
+        values[bisect_left(self.buckets, seconds)] += 1
+        values[-1] += seconds
+
+    def inc(self, name, labels, value=1):
+        """
+        Increase the counter name{labels}
+        Args:
+            name: metric name
+            labels: tuple of (label, value) pairs
+            value:
+        """
+        counters = self._shard()[1]
+        key = (name, labels)
+        counters[key] = counters.get(key, 0) + value
+
+    def _before_request(self):
+        g.metrics_start = perf_counter()
+
+    def _after_request(self, response):
+        start = g.pop('metrics_start', None)
+        if start is None or request.endpoint == 'metrics':
+            return response
+        labels = (('endpoint', request.endpoint or 'unmatched'), ('method', request.method))
+        self.observe('http_request_duration_seconds', labels, perf_counter() - start)
+        if response.status_code >= 400:
+            self.inc('http_request_errors_total', labels + (('status', str(response.status_code)),))
+        return response
+
+    @contextmanager
+    def track_event(self, event, namespace):
+        """
+        Hook of the socket_event decorator, time one socket event
+        Args:
+            event:
+            namespace:
+        """
+        labels = (('event', event), ('namespace', namespace))
+        start = perf_counter()
+        try:
+            yield
+        except Exception:
+            self.inc('socketio_event_errors_total', labels)
+            raise
+        finally:
+            self.observe('socketio_event_duration_seconds', labels, perf_counter() - start)
+
+    def collect(self):
+        """
+        Merge the shards of all threads
+        Returns:
+            histograms, counters
+        """
+        totals = ({}, {})
+        with self._lock:
+            shards = list(self._shards)
+            _merge(totals, self._retired)
+        for shard in shards:
+            _merge(totals, shard)
+        return totals
+
+    def render(self):
+        """
+        Render all metrics in the Prometheus text format
+        Returns:
+            string
+        """
+        histograms, counters = self.collect()
+        families = {}
+        for (name, labels), values in histograms.items():
+            lines = families.setdefault(name, [])
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), values):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append('{}_bucket{} {}'.format(name, _format_labels(labels + (('le', le),)), cumulative))
+            lines.append('{}_sum{} {}'.format(name, _format_labels(labels), values[-1]))
+            lines.append('{}_count{} {}'.format(name, _format_labels(labels), cumulative))
+        for (name, labels), value in counters.items():
+            families.setdefault(name, []).append('{}{} {}'.format(name, _format_labels(labels), value))
+        for collector in self._collectors:
+            for name, labels, value in collector():
+                families.setdefault(name, []).append('{}{} {}'.format(name, _format_labels(labels), value))
+
+        output = []
+        for name in sorted(families):
+            metric_type, description = self._descriptions.get(name, ('untyped', name))
+            output.append('# HELP {} {}'.format(name, description))
+            output.append('# TYPE {} {}'.format(name, metric_type))
+            output.extend(families[name])
+        return '\n'.join(output) + '\n'
+
+    def export(self):
+        """ This is the metrics endpoint scraped by Prometheus
+        """
+        return Response(self.render(), mimetype=CONTENT_TYPE)
+
+
+class _ShardHolder(object):
+    __slots__ = ('shard', '__weakref__')
+
+    def __init__(self, shard):
+        self.shard = shard
+
+
+def _merge(totals, shard):
+    """
+    Add the histograms and counters of a shard to the totals
+    """
+    histograms, counters = totals
+    shard_histograms, shard_counters = shard
+    for key, values in list(shard_histograms.items()):
+        merged = histograms.get(key)
+        if merged is None:
+            histograms[key] = list(values)
+        else:
+            histograms[key] = [a + b for a, b in zip(merged, values)]
+    for key, value in list(shard_counters.items()):
+        counters[key] = counters.get(key, 0) + value
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"')
+                                           .replace('\n', '\\n')) for key, value in labels) + '}'
+
+
+metrics = Metrics()
@@ -0,0 +1,214 @@
+import json
+import threading
+from collections import OrderedDict
+from time import monotonic
+
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import make_transient_to_detached
+from sqlalchemy.orm.util import identity_key
+
+from app.extensions import db, logger
+from app.metrics import metrics
+from app.models import User, Group, Friend
+from app.replicas import replica_router
+
+
+class LocalBackend(object):
+    """
+    Dict of the process, the least recently used entries are dropped above max_entries
+    """
+
+    def __init__(self, max_entries=100000):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # key -> (values, expires at)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[1] < monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def set(self, key, values, ttl):
+        with self._lock:
+            self._entries[key] = (values, monotonic() + ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, keys):
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class RedisBackend(object):
+    """
+    Redis shared by the processes, the values are json
+    """
+
+    def __init__(self, url, prefix='model_cache:'):
+        import redis  # optional, only with MODEL_CACHE_REDIS_URL
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+
+    def get(self, key):
+        value = self.client.get(self.prefix + key)
+        return None if value is None else json.loads(value)
+
+    def set(self, key, values, ttl):
+        self.client.setex(self.prefix + key, int(ttl), json.dumps(values))
+
+    def delete(self, keys):
+        if keys:
+            self.client.delete(*[self.prefix + key for key in keys])
+
+    def __len__(self):
+        return 0
+
+
+class ModelCache(object):
+    """
+    Read-through cache of get_by_id for the rows read on every request: users, groups and friends.
+    A hit is merged into the session without a query, so the instance can still be changed and committed.
+    The rows changed by a commit of the session are dropped from the cache after the commit, bulk updates and
+    deletes of these tables call invalidate. MODEL_CACHE_TTL bounds the staleness of the rows changed by other
+    processes when the cache is local, MODEL_CACHE_REDIS_URL shares it between the processes.
+    Like the recent messages cache, a row loaded before a commit of this process invalidated it is not stored.
+    """
+
+    models = (User, Group, Friend)
+
+    def __init__(self):
+        self.app = None
+        self.backend = None
+        self.ttl = {}
+        self._versions = {}  # key -> number of committed invalidations, a fill read before one is dropped
+        self._epoch = 0
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        """
+        Init the cache, do nothing if MODEL_CACHE_ENABLED is False
+        :param app:
+        :return:
+        """
+        self.app = None
+        self.backend = None
+        with self._lock:
+            self._versions.clear()
+            self._epoch += 1
+        if not app.config.get('MODEL_CACHE_ENABLED'):
+            return
+        self.ttl = app.config.get('MODEL_CACHE_TTL', {})
+        redis_url = app.config.get('MODEL_CACHE_REDIS_URL')
+        if redis_url:
+            try:
+                self.backend = RedisBackend(redis_url)
+            except ImportError:
+                logger.error('MODEL_CACHE_REDIS_URL is set but redis is not installed, the model cache is local')
+        if self.backend is None:
+            self.backend = LocalBackend(app.config.get('MODEL_CACHE_MAX_ENTRIES', 100000))
+        self.app = app
+        app.extensions['model_cache'] = self
+
+        metrics.describe('model_cache_requests_total', 'counter', 'get_by_id lookups of the model cache')
+        metrics.describe('model_cache_invalidations_total', 'counter', 'Rows dropped from the model cache')
+        metrics.describe('model_cache_entries', 'gauge', 'Rows in the local model cache')
+        metrics.add_collector(self.collect)
+
+        if not event.contains(db.session, 'after_flush', self._after_flush):
+            event.listen(db.session, 'after_flush', self._after_flush)
+            event.listen(db.session, 'after_commit', self._after_commit)
+            event.listen(db.session, 'after_rollback', self._after_rollback)
+
+    @staticmethod
+    def key(model, _id):
+        return '{}:{}'.format(model.__tablename__, _id)
+
+    def get(self, model, _id):
+        """
+        Instance of a cached model by primary key, like query.get
+        Returns:
+            instance attached to the session, None if not found
+        """
+        if _id is None:
+            return None
+        session = db.session()
+        instance = session.identity_map.get(identity_key(model, _id))
+        if instance is not None and not inspect(instance).expired_attributes:
+            return instance
+
+        labels = (('model', model.__tablename__),)
+        key = self.key(model, _id)
+        values = self.backend.get(key)
+        if values is not None:
+            metrics.inc('model_cache_requests_total', labels + (('result', 'hit'),))
+            cached = model(**values)
+            make_transient_to_detached(cached)
+            return session.merge(cached, load=False)
+
+        metrics.inc('model_cache_requests_total', labels + (('result', 'miss'),))
+        version = self._version(key)
+        with replica_router.primary():
+            instance = model.query.get(_id)
+        if instance is not None:
+            values = {attr.key: getattr(instance, attr.key) for attr in inspect(model).column_attrs}
+            with self._lock:
+                if version == (self._epoch, self._versions.get(key, 0)):
+                    self.backend.set(key, values, self.ttl.get(model.__tablename__, 60))
+        return instance
+
+    def _version(self, key):
+        with self._lock:
+            return self._epoch, self._versions.get(key, 0)
+
+    def invalidate(self, model, *ids):
+        """
+        Drop rows from the cache at the commit, after a bulk update or delete
+        """
+        if self.app is None:
+            return
+        db.session.info.setdefault('model_cache', set()).update(self.key(model, _id) for _id in ids)
+
+    def _after_flush(self, session, flush_context):
+        keys = session.info.setdefault('model_cache', set())
+        for instance in list(session.new) + list(session.dirty) + list(session.deleted):
+            if isinstance(instance, self.models):
+                keys.add(self.key(type(instance), instance.id))
+
+    def _after_commit(self, session):
+        keys = session.info.pop('model_cache', None)
+        if not keys or self.backend is None:
+            return
+        with self._lock:
+            if len(self._versions) > 100000:
+                # the pending fills are dropped with the versions
+                self._versions.clear()
+                self._epoch += 1
+            for key in keys:
+                self._versions[key] = self._versions.get(key, 0) + 1
+        try:
+            self.backend.delete(list(keys))
+        except Exception as ex:
+            logger.error('Model cache invalidation error: {}'.format(ex))
+        for key in keys:
+            metrics.inc('model_cache_invalidations_total', (('model', key.split(':', 1)[0]),))
+
+    @staticmethod
+    def _after_rollback(session):
+        session.info.pop('model_cache', None)
+
+    def collect(self):
+        return [('model_cache_entries', (), len(self.backend))] if self.backend is not None else []
+
+
+model_cache = ModelCache()
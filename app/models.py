@@ -1,13 +1,29 @@
 # coding: utf-8
-from sqlalchemy import Index
+from collections import Counter
+from itertools import chain
+
+from flask import g, current_app, request, has_request_context
+from sqlalchemy import Index, or_, and_, case, select
+from sqlalchemy.orm import load_only, Load
 
 from app.enums import AVATAR_PATH_SEVER, DEFAULT_AVATAR
 from app.extensions import db
+from app.ids import BinaryId
 from flask_jwt_extended import decode_token, get_jwt_identity, get_raw_jwt
-from sqlalchemy.dialects.mysql import INTEGER, TEXT
+from sqlalchemy.dialects.mysql import INTEGER, TEXT, MEDIUMBLOB
 from app.utils import send_error, get_timestamp_now
 
 
+def get_cached(model, _id):
+    """
+    query.get through the model cache (app.model_cache) when it is enabled
+    """
+    cache = db.get_app().extensions.get('model_cache')
+    if cache is None:
+        return model.query.get(_id)
+    return cache.get(model, _id)
+
+
 class Group(db.Model):
     __tablename__ = 'groups'
 
@@ -46,7 +62,7 @@ class Group(db.Model):
 
     @classmethod
     def get_by_id(cls, _id):
-        return cls.query.get(_id)
+        return get_cached(cls, _id)
 
 
 class User(db.Model):
@@ -67,6 +83,7 @@ class User(db.Model):
     modified_date_password = db.Column(INTEGER(unsigned=True), default=get_timestamp_now())
     avatar_path = db.Column(db.String(255), default=AVATAR_PATH_SEVER + DEFAULT_AVATAR)
     test_message = db.Column(TEXT, default="test message")
+    last_seen = db.Column(INTEGER(unsigned=True))
 
     messages = db.relationship('Message', cascade="all,delete")
 
@@ -82,7 +99,8 @@ class User(db.Model):
             "force_change_password": self.force_change_password,
             "created_date": self.created_date,
             "avatar_path": self.avatar_path,
-            "pub_key": self.pub_key
+            "pub_key": self.pub_key,
+            "last_seen": self.last_seen
         }
 
     @staticmethod
@@ -97,7 +115,8 @@ class User(db.Model):
                 "force_change_password": o.force_change_password,
                 "created_date": o.created_date,
                 "avatar_path": o.avatar_path,
-                "pub_key": o.pub_key
+                "pub_key": o.pub_key,
+                "last_seen": o.last_seen
             }
             items.append(item)
         return items
@@ -108,11 +127,32 @@ class User(db.Model):
 
     @classmethod
     def get_current_user(cls):
-        return cls.query.get(get_jwt_identity())
+        """
+        User of the access token, loaded once per request. With user_fields on the view, only the declared columns
+        are loaded, together with the token check (Token.is_token_revoked)
+        """
+        if 'current_user' not in g:
+            fields = cls.declared_fields()
+            if fields:
+                g.current_user = cls.query.options(load_only(*fields)).get(get_jwt_identity())
+            else:
+                g.current_user = cls.get_by_id(get_jwt_identity())
+        return g.current_user
+
+    @staticmethod
+    def declared_fields():
+        """
+        Columns of the current user declared with user_fields by the view of the request
+        Returns:
+            tuple of column names, None if the view declares nothing
+        """
+        if not has_request_context() or request.endpoint is None:
+            return None
+        return getattr(current_app.view_functions.get(request.endpoint), 'user_fields', None)
 
     @classmethod
     def get_by_id(cls, _id):
-        return cls.query.get(_id)
+        return get_cached(cls, _id)
 
 
 class GroupUser(db.Model):
@@ -129,6 +169,10 @@ class GroupUser(db.Model):
     def get_by_user_id(cls, user_id):
         return cls.query.filter_by(user_id=user_id).first()
 
+    @classmethod
+    def get_members_id(cls, group_id):
+        return {row[0] for row in db.session.query(cls.user_id).filter(cls.group_id == group_id)}
+
 
 class Friend(db.Model):
     __tablename__ = 'friends'
@@ -139,7 +183,7 @@ class Friend(db.Model):
 
     @classmethod
     def get_by_id(cls, _id):
-        return cls.query.get(_id)
+        return get_cached(cls, _id)
 
     @classmethod
     def get_friends(cls, user_id, page, page_size):
@@ -160,7 +204,7 @@ class Message(db.Model):
     )
     # TODO oder_by desc filed created_date
 
-    id = db.Column(db.String(50), primary_key=True)
+    id = db.Column(BinaryId, primary_key=True)
     message = db.Column(TEXT)
     sender_id = db.Column(db.ForeignKey('users.id'))
     group_id = db.Column(db.String(50), nullable=False)
@@ -200,17 +244,172 @@ class Message(db.Model):
 
     @classmethod
     def get_messages(cls, group_id, page=1, page_size=10):
-        return cls.query.filter_by(group_id=group_id).order_by(
-            cls.created_date.desc()).paginate(page=page, per_page=page_size, error_out=False).items
+        offset = (page - 1) * page_size
+        cache = db.get_app().extensions.get('recent_messages')
+        if cache is None or offset + page_size > cache.size:
+            return cls._get_page(group_id, offset, page_size)
+        messages = cache.get_page(group_id, offset, page_size)
+        if messages is None:
+            messages = cache.load(group_id, lambda limit: cls._get_page(group_id, 0, limit))[offset:offset + page_size]
+        return messages
+
+    @classmethod
+    def _get_page(cls, group_id, offset, limit):
+        messages = cls.query.filter_by(group_id=group_id).order_by(
+            cls.created_date.desc(), cls.id.desc()).limit(limit).offset(offset).all()
+
+        archive = db.get_app().extensions.get('message_archive')
+        if archive is None or len(messages) == limit:
+            return messages
+        # the client scrolled past the hot messages, continue in the archive
+        hot_count = offset + len(messages) if messages else cls.count_messages(group_id)
+        return messages + archive.get_page(group_id, offset + len(messages) - hot_count, limit - len(messages))
+
+    @classmethod
+    def get_messages_before(cls, group_id, before=None, page_size=10):
+        """
+        Cursor paging from the newest message, then through the archive
+        Args:
+            group_id:
+            before: (created_date, id) of the oldest message already read, None for the first page
+            page_size:
+
+        Returns:
+            list of messages, newest first
+        """
+        query = cls.query.filter(cls.group_id == group_id)
+        if before is not None:
+            query = query.filter(or_(cls.created_date < before[0], and_(cls.created_date == before[0],
+                                                                         cls.id < before[1])))
+        messages = query.order_by(cls.created_date.desc(), cls.id.desc()).limit(page_size).all()
+
+        archive = db.get_app().extensions.get('message_archive')
+        if archive is None or len(messages) == page_size:
+            return messages
+        oldest = (messages[-1].created_date, messages[-1].id) if messages else before
+        return messages + archive.get_before(group_id, oldest, page_size - len(messages))
+
+    @classmethod
+    def count_messages(cls, group_id):
+        return cls.query.filter_by(group_id=group_id).count()
+
+    @classmethod
+    def get_latest(cls, group_id):
+        cache = db.get_app().extensions.get('recent_messages')
+        messages = cache.get_page(group_id, 0, 1) if cache is not None else None
+        if messages is None:
+            # a preview does not fill the cache, the first history page does
+            messages = cls._get_page(group_id, 0, 1)
+        return messages[0] if messages else None
+
+    @classmethod
+    def get_many(cls, messages_id, groups_id=None):
+        """
+        Messages by id with one query, the archived ones from the archive of their conversation
+        Args:
+            messages_id: list of message id
+            groups_id: group id of each message, needed to find the archived messages
+
+        Returns:
+            list of messages and ArchivedMessage, in no particular order
+        """
+        if not messages_id:
+            return []
+        messages = cls.query.filter(cls.id.in_(messages_id)).all()
+        archive = db.get_app().extensions.get('message_archive')
+        if archive is None or groups_id is None or len(messages) == len(set(messages_id)):
+            return messages
+        found = {o.id for o in messages}
+        missing = {}
+        for _id, group_id in zip(messages_id, groups_id):
+            if _id not in found:
+                missing.setdefault(group_id, []).append(_id)
+        for group_id, ids in missing.items():
+            messages.extend(archive.find(group_id, ids).values())
+        return messages
+
+    @classmethod
+    def delete_by_id(cls, _id, group_id):
+        cls.query.filter_by(id=_id).delete()
+        cache = db.get_app().extensions.get('recent_messages')
+        if cache is not None:
+            cache.discard(group_id)
+
+    @classmethod
+    def mark_seen(cls, group_id, messages_id):
+        """
+        Set seen on messages of a conversation with one UPDATE, applied to the recent messages cache at the commit
+        """
+        if not messages_id:
+            return
+        cls.query.filter(cls.id.in_(messages_id)).update({cls.seen: True}, synchronize_session=False)
+        cache = db.get_app().extensions.get('recent_messages')
+        if cache is not None:
+            cache.seen(group_id, messages_id)
+
+    @classmethod
+    def stream_messages(cls, group_id, after=None, batch_size=1000):
+        """
+        All messages of a conversation from the oldest, read with a server-side cursor
+        Args:
+            group_id:
+            after: (created_date, id) of the last message already read
+            batch_size: rows fetched per round trip
+
+        Returns:
+            iterator of rows
+        """
+        query = db.session.query(cls.id, cls.message, cls.sender_id, cls.created_date, cls.seen).filter(
+            cls.group_id == group_id)
+        if after is not None:
+            query = query.filter(or_(cls.created_date > after[0], and_(cls.created_date == after[0], cls.id > after[1])))
+        rows = query.order_by(cls.created_date, cls.id).execution_options(stream_results=True).yield_per(batch_size)
+
+        archive = db.get_app().extensions.get('message_archive')
+        if archive is None:
+            return rows
+        # the archived messages are older than the hot ones
+        return chain(archive.stream(group_id, after=after), rows)
+
+
+class PendingDelivery(db.Model):
+    """
+    Private messages sent while the receiver had no socket connected, flushed when the receiver authenticates
+    and trimmed by the acks of the client
+    """
+    __tablename__ = 'pending_deliveries'
+
+    user_id = db.Column(db.ForeignKey('users.id'), primary_key=True)
+    message_id = db.Column(BinaryId, primary_key=True)
+    group_id = db.Column(db.String(50), nullable=False)
+    created_date = db.Column(INTEGER(unsigned=True), default=get_timestamp_now())
+
+    @classmethod
+    def get_messages(cls, user_id, limit=1000):
+        pending = db.session.query(cls.message_id, cls.group_id).filter(cls.user_id == user_id).order_by(
+            cls.created_date, cls.message_id).limit(limit).all()
+        messages = {o.id: o for o in Message.get_many([row.message_id for row in pending],
+                                                       [row.group_id for row in pending])}
+        return [messages[row.message_id] for row in pending if row.message_id in messages]
+
+    @classmethod
+    def ack(cls, user_id, message_ids):
+        cls.query.filter(cls.user_id == user_id, cls.message_id.in_(message_ids)).delete(synchronize_session=False)
+        db.session.commit()
 
 
 class GroupMessage(db.Model):
     __tablename__ = 'group_messages'
+    __table_args__ = (
+        Index('index_group_get', 'group_id', 'created_date'),
+    )
 
-    id = db.Column(db.String(50), primary_key=True)
+    id = db.Column(BinaryId, primary_key=True)
     message = db.Column(TEXT)
     sender_id = db.Column(db.ForeignKey('users.id'))
     group_id = db.Column(db.ForeignKey('groups.id'))
+    # member whose pub_key encrypted this copy, null when the message is the same for every member
+    receiver_id = db.Column(db.ForeignKey('users.id'))
     created_date = db.Column(INTEGER(unsigned=True), default=get_timestamp_now())
 
     def to_json(self):
@@ -219,6 +418,7 @@ class GroupMessage(db.Model):
             "message": self.message,
             "sender_id": self.sender_id,
             "group_id": self.group_id,
+            "receiver_id": self.receiver_id,
             "created_date": self.created_date
         }
 
@@ -231,6 +431,7 @@ class GroupMessage(db.Model):
                 "message": o.message,
                 "sender_id": o.sender_id,
                 "group_id": o.group_id,
+                "receiver_id": o.receiver_id,
                 "created_date": o.created_date
             }
             items.append(item)
@@ -244,17 +445,216 @@ class GroupMessage(db.Model):
     def get_by_id(cls, _id):
         return cls.query.get(_id)
 
+    @classmethod
+    def insert_many(cls, rows):
+        """
+        Add the rows with one multi-row INSERT in the transaction of the session, without loading objects
+        Args:
+            rows: list of dict column -> value
+        """
+        db.session.execute(cls.__table__.insert().values(rows))
+
     @classmethod
     def get_messages(cls, group_id, page=1, page_size=10):
         return cls.query.filter_by(group_id=group_id).order_by(
             cls.created_date.desc()).paginate(page=page, per_page=page_size, error_out=False).items
 
+    @classmethod
+    def stream_messages(cls, group_id, after=None, batch_size=1000, receiver_id=None):
+        """
+        All messages of a group from the oldest, read with a server-side cursor
+        Args:
+            group_id:
+            after: (created_date, id) of the last message already read
+            batch_size: rows fetched per round trip
+            receiver_id: only the copies encrypted for this member, and the messages without receiver
+
+        Returns:
+            iterator of rows
+        """
+        query = db.session.query(cls.id, cls.message, cls.sender_id, cls.group_id, cls.receiver_id,
+                                 cls.created_date).filter(cls.group_id == group_id)
+        if receiver_id is not None:
+            query = query.filter(or_(cls.receiver_id.is_(None), cls.receiver_id == receiver_id))
+        if after is not None:
+            query = query.filter(or_(cls.created_date > after[0], and_(cls.created_date == after[0], cls.id > after[1])))
+        return query.order_by(cls.created_date, cls.id).execution_options(stream_results=True).yield_per(batch_size)
+
+
+class ArchiveSegment(db.Model):
+    """
+    Old private messages of a conversation moved out of the messages table by migrate/archive_messages.py,
+    gzip JSON lines ordered by (created_date, id). The boundary columns are the index of the segments,
+    data is loaded only when a client scrolls past the hot messages, see app.archive
+    """
+    __tablename__ = 'archive_segments'
+    __table_args__ = (
+        Index('index_archive', 'group_id', 'last_date'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    group_id = db.Column(db.String(50), nullable=False)
+    first_date = db.Column(INTEGER(unsigned=True), nullable=False)
+    first_id = db.Column(BinaryId, nullable=False)
+    last_date = db.Column(INTEGER(unsigned=True), nullable=False)
+    last_id = db.Column(BinaryId, nullable=False)
+    count = db.Column(db.Integer, nullable=False)
+    data = db.deferred(db.Column(db.LargeBinary().with_variant(MEDIUMBLOB(), 'mysql'), nullable=False))
+    created_date = db.Column(INTEGER(unsigned=True), default=get_timestamp_now())
+
+    @classmethod
+    def get_segments(cls, group_id):
+        """
+        Segments of a conversation without their data, newest first
+        """
+        return cls.query.filter_by(group_id=group_id).order_by(cls.last_date.desc(), cls.last_id.desc()).all()
+
+    @classmethod
+    def get_data(cls, _id):
+        return db.session.query(cls.data).filter_by(id=_id).scalar()
+
+
+class SyncSequence(db.Model):
+    """
+    Last sync sequence of every user, the row is locked by the transaction recording changes of the user
+    """
+    __tablename__ = 'sync_sequences'
+
+    user_id = db.Column(db.String(50), primary_key=True)
+    seq = db.Column(db.BigInteger, nullable=False, default=0)
+
+    @classmethod
+    def reserve(cls, counts):
+        """
+        Reserve the next sequences of users in the transaction of the session. The rows stay locked until the
+        commit, so the changes of a user become visible in sequence order: a transaction with a greater
+        sequence waits for the one holding a smaller sequence of the same user.
+        Args:
+            counts: dict user id -> number of sequences
+
+        Returns:
+            dict user id -> first reserved sequence
+        """
+        table = cls.__table__
+        users_id = sorted(counts)
+        existing = {row[0] for row in db.session.execute(
+            select([table.c.user_id]).where(table.c.user_id.in_(users_id)))}
+        missing = [user_id for user_id in users_id if user_id not in existing]
+        if missing:
+            # first change of the users, a concurrent transaction may insert the same rows
+            ignore = 'OR IGNORE' if db.session.get_bind().dialect.name == 'sqlite' else 'IGNORE'
+            db.session.execute(table.insert().prefix_with(ignore), [{'user_id': user_id, 'seq': 0}
+                                                                    for user_id in missing])
+        # one UPDATE locks the rows in primary key order, a second transaction waits for the commit of the first
+        db.session.execute(table.update().where(table.c.user_id.in_(users_id)).values(
+            seq=table.c.seq + case(counts, value=table.c.user_id)))
+        reserved = db.session.execute(select([table.c.user_id, table.c.seq]).where(table.c.user_id.in_(users_id)))
+        return {user_id: seq - counts[user_id] + 1 for user_id, seq in reserved}
+
+
+class Change(db.Model):
+    """
+    Change feed of the conversations and groups of every user: new, edited, deleted or seen messages, created,
+    edited or left groups.
+    seq is the sync cursor, a per-user sequence allocated under the lock of the SyncSequence row of the user: it
+    increases monotonically in commit order, so a device fetches what changed since its last cursor.
+    """
+    __tablename__ = 'changes'
+    __table_args__ = (
+        Index('index_sync', 'user_id', 'seq', unique=True),
+    )
+
+    NEW = 'new'
+    EDITED = 'edited'
+    DELETED = 'deleted'
+    SEEN = 'seen'
+    PRIVATE = 'private'
+    GROUP = 'group'
+    GROUP_INFO = 'group_info'  # name and members of a group, no message id
+
+    id = db.Column(db.BigInteger().with_variant(db.Integer, 'sqlite'), primary_key=True, autoincrement=True)
+    user_id = db.Column(db.String(50), nullable=False)
+    seq = db.Column(db.BigInteger, nullable=False)
+    kind = db.Column(db.String(10), nullable=False)
+    action = db.Column(db.String(10), nullable=False)
+    message_id = db.Column(BinaryId)
+    group_id = db.Column(db.String(50), nullable=False)
+    created_date = db.Column(INTEGER(unsigned=True), default=get_timestamp_now())
+
+    def to_json(self):
+        return {
+            "seq": self.seq,
+            "kind": self.kind,
+            "action": self.action,
+            "message_id": self.message_id,
+            "group_id": self.group_id,
+            "created_date": self.created_date
+        }
+
+    @classmethod
+    def record(cls, users_id, kind, action, message_id, group_id):
+        """
+        Add a change for every user of the conversation in the transaction of the session
+        Args:
+            users_id: list of user id
+            kind: Change.PRIVATE, Change.GROUP or Change.GROUP_INFO
+            action: Change.NEW, Change.EDITED, Change.DELETED or Change.SEEN
+            message_id: None for Change.GROUP_INFO
+            group_id: private conversation id or group id
+        """
+        cls.record_many(kind, action, group_id, [(user_id, message_id) for user_id in set(users_id)])
+
+    @classmethod
+    def record_many(cls, kind, action, group_id, changes):
+        """
+        Add one change per (user id, message id) with one multi-row INSERT in the transaction of the session,
+        the sequences of the users are reserved first
+        Args:
+            kind: Change.PRIVATE, Change.GROUP or Change.GROUP_INFO
+            action: Change.NEW, Change.EDITED, Change.DELETED or Change.SEEN
+            group_id: private conversation id or group id
+            changes: list of (user id, message id)
+        """
+        if not changes:
+            return
+        seqs = SyncSequence.reserve(Counter(user_id for user_id, _ in changes))
+        rows = []
+        created_date = get_timestamp_now()
+        for user_id, message_id in changes:
+            rows.append(dict(user_id=user_id, seq=seqs[user_id], kind=kind, action=action, message_id=message_id,
+                             group_id=group_id, created_date=created_date))
+            seqs[user_id] += 1
+        db.session.execute(cls.__table__.insert().values(rows))
+
+    @classmethod
+    def get_since(cls, user_id, since=0, limit=500):
+        """
+        Changes of the user after the cursor since, in seq order
+        Args:
+            user_id:
+            since: cursor, seq of the last change already read
+            limit:
+
+        Returns:
+            list of Change
+        """
+        return cls.query.filter(cls.user_id == user_id, cls.seq > since).order_by(cls.seq).limit(limit).all()
+
+    @staticmethod
+    def prune_database(before):
+        """
+        Delete the changes older than the timestamp before, devices with an older cursor have to sync again
+        from the histories
+        """
+        Change.query.filter(Change.created_date < before).delete()
+        db.session.commit()
+
 
 class Token(db.Model):
     __tablename__ = 'tokens'
 
     id = db.Column(db.Integer, primary_key=True)
-    jti = db.Column(db.String(36), nullable=False)
+    jti = db.Column(BinaryId, nullable=False)
     token_type = db.Column(db.String(10), nullable=False)
     user_identity = db.Column(db.String(50), nullable=False)
     revoked = db.Column(db.Boolean, nullable=False)
@@ -292,6 +692,15 @@ class Token(db.Model):
         it was created.
         """
         jti = decoded_token['jti']
+        fields = User.declared_fields()
+        if fields and decoded_token['type'] == 'access':
+            # the view reads the current user, load it with the token
+            row = db.session.query(Token.revoked, User).outerjoin(User, User.id == Token.user_identity).options(
+                Load(User).load_only(*fields)).filter(Token.jti == jti).first()
+            if row is None:
+                return True
+            g.current_user = row[1]
+            return row[0]
         token = Token.query.filter_by(jti=jti).first()
         if token:
             return token.revoked
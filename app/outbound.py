@@ -0,0 +1,194 @@
+import threading
+
+from engineio import packet as eio_packet
+from socketio import packet
+
+from app.extensions import sio, logger
+from app.metrics import metrics
+
+DROP_OLDEST = 'drop_oldest'
+DISCONNECT = 'disconnect'
+SYNC = 'sync'
+
+
+def merge_payloads(previous, data):
+    """
+    Coalesce two pending payloads of the same event: presence changes are merged by user, latest wins,
+    any other payload is replaced by the latest one
+    """
+    if isinstance(previous, dict) and isinstance(data, dict) and 'changes' in previous and 'changes' in data:
+        changes = {item.get('user_id'): item for item in previous['changes']}
+        changes.update((item.get('user_id'), item) for item in data['changes'])
+        return dict(data, changes=list(changes.values()))
+    return data
+
+
+class OutboundQueues(object):
+    """
+    Bound of the Engine.IO queue of every connection. Every packet of a socket waits in this queue until the
+    client reads it, a slow client (a mobile on long-polling) would make it grow without limit.
+    Above OUTBOUND_HIGH_WATER queued packets:
+      - the events of OUTBOUND_COALESCE_EVENTS (presence, typing) are held back and merged, the latest state is
+        sent once the queue drains
+      - the other events follow OUTBOUND_POLICY: drop_oldest drops the oldest queued events, disconnect closes the
+        socket, sync stops the realtime events of the socket and sends it sync_required once its queue is below
+        half the high-water mark, the client then reads what it missed from /api/v1/sync
+    """
+
+    def __init__(self):
+        self.app = None
+        self.high_water = 1000
+        self.policy = SYNC
+        self.coalesce_events = set()
+        self.interval = 0.5
+        self._send_packet = None
+        self._held = {}  # sid -> {event: (namespace, payload)}, coalesced events waiting for the queue to drain
+        self._lagging = set()  # sid of the sockets waiting for sync_required
+        self._lock = threading.Lock()
+        self._task = None
+
+    def init_app(self, app):
+        """
+        Wrap the packet writer of the Socket.IO server, do nothing if OUTBOUND_HIGH_WATER is 0
+        :param app:
+        :return:
+        """
+        self.app = app
+        self.high_water = app.config.get('OUTBOUND_HIGH_WATER', 1000)
+        self.policy = app.config.get('OUTBOUND_POLICY', SYNC)
+        self.coalesce_events = set(app.config.get('OUTBOUND_COALESCE_EVENTS', []))
+        self.interval = app.config.get('OUTBOUND_FLUSH_INTERVAL', 0.5)
+        if not self.high_water or sio.server is None:
+            return
+        if self.policy not in (DROP_OLDEST, DISCONNECT, SYNC):
+            raise ValueError('OUTBOUND_POLICY must be drop_oldest, disconnect or sync')
+        if self._send_packet is None or sio.server._send_packet != self.send_packet:
+            self._send_packet = sio.server._send_packet
+            sio.server._send_packet = self.send_packet
+
+        metrics.describe('socketio_outbound_queue_depth', 'gauge', 'Packets waiting in the connection queues')
+        metrics.describe('socketio_outbound_slow_consumers', 'gauge', 'Connections above the high-water mark')
+        metrics.describe('socketio_outbound_dropped_total', 'counter', 'Events not delivered to a slow consumer')
+        metrics.describe('socketio_outbound_coalesced_total', 'counter', 'Events merged into a held event')
+        metrics.describe('socketio_outbound_disconnects_total', 'counter', 'Slow consumers disconnected')
+        metrics.add_collector(self.collect)
+
+    def depth(self, sid):
+        socket = sio.server.eio.sockets.get(sid)
+        return socket.queue.qsize() if socket is not None else None
+
+    def send_packet(self, sid, pkt):
+        """
+        Replacement of Server._send_packet, called for every packet of every socket
+        """
+        if pkt.packet_type not in (packet.EVENT, packet.BINARY_EVENT):
+            return self._send_packet(sid, pkt)
+        depth = self.depth(sid)
+        if depth is None:
+            return self._send_packet(sid, pkt)
+        event = pkt.data[0]
+        if sid in self._lagging:
+            metrics.inc('socketio_outbound_dropped_total', (('event', event), ('policy', SYNC)))
+            return
+        if event in self.coalesce_events and (depth >= self.high_water or sid in self._held):
+            self._hold(sid, event, pkt)
+            return
+        if depth < self.high_water:
+            return self._send_packet(sid, pkt)
+
+        metrics.inc('socketio_outbound_dropped_total', (('event', event), ('policy', self.policy)))
+        if self.policy == DROP_OLDEST:
+            self._drop_oldest(sid)
+            return self._send_packet(sid, pkt)
+        with self._lock:
+            self._lagging.add(sid)
+            self._held.pop(sid, None)  # the sync covers the held events too
+        if self.policy == DISCONNECT:
+            metrics.inc('socketio_outbound_disconnects_total', ())
+            sio.start_background_task(self._disconnect, sid)
+        self._start()
+
+    def _hold(self, sid, event, pkt):
+        metrics.inc('socketio_outbound_coalesced_total', (('event', event),))
+        data = pkt.data[1] if len(pkt.data) > 1 else None
+        with self._lock:
+            held = self._held.setdefault(sid, {})
+            previous = held.get(event)
+            held[event] = (pkt.namespace, data if previous is None else merge_payloads(previous[1], data))
+        self._start()
+
+    def _drop_oldest(self, sid):
+        """
+        Remove the oldest queued events down to the high-water mark, the engine packets (pong, noop...) stay
+        """
+        socket = sio.server.eio.sockets.get(sid)
+        if socket is None:
+            return
+        kept = []
+        while socket.queue.qsize() + len(kept) >= self.high_water:
+            try:
+                queued = socket.queue.get_nowait()
+            except Exception:
+                break
+            if queued.packet_type != eio_packet.MESSAGE or not isinstance(queued.data, str) or \
+                    not queued.data.startswith((str(packet.EVENT), str(packet.BINARY_EVENT))):
+                kept.append(queued)  # not a Socket.IO event
+        for queued in kept:
+            socket.queue.put(queued)
+
+    def _disconnect(self, sid):
+        try:
+            sio.server.disconnect(sid)
+        except Exception as ex:
+            logger.error('Slow consumer disconnect error: ' + str(ex))
+
+    def _start(self):
+        # the slot is claimed under the lock, the task starts outside: under eventlet starting a task yields to the
+        # hub, an emitter waiting for the lock would block the whole thread
+        with self._lock:
+            start = self._task is None
+            self._task = True
+        if start:
+            self._task = sio.start_background_task(self._run)
+
+    def _run(self):
+        while True:
+            sio.sleep(self.interval)
+            try:
+                self.flush()
+            except Exception as ex:
+                logger.error('Outbound flush error: ' + str(ex))
+
+    def flush(self):
+        """
+        Send the held events and sync_required to the sockets whose queue drained
+        """
+        with self._lock:
+            held_sids, lagging_sids = list(self._held), list(self._lagging)
+        for sid in lagging_sids:
+            depth = self.depth(sid)
+            if depth is None or depth <= self.high_water // 2:
+                with self._lock:
+                    self._lagging.discard(sid)
+                if depth is not None and self.policy == SYNC:
+                    self._send_packet(sid, packet.Packet(packet.EVENT, data=['sync_required', {
+                        'reason': 'slow_consumer'}]))
+        for sid in held_sids:
+            depth = self.depth(sid)
+            if depth is not None and depth >= self.high_water:
+                continue
+            with self._lock:
+                held = self._held.pop(sid, {})
+            if depth is None:
+                continue
+            for event, (namespace, data) in held.items():
+                self._send_packet(sid, packet.Packet(packet.EVENT, namespace=namespace, data=[event, data]))
+
+    def collect(self):
+        depths = [socket.queue.qsize() for socket in list(sio.server.eio.sockets.values())]
+        return [('socketio_outbound_queue_depth', (('stat', 'max'),), max(depths) if depths else 0),
+                ('socketio_outbound_queue_depth', (('stat', 'total'),), sum(depths)),
+                ('socketio_outbound_slow_consumers', (), len(self._lagging))]
+
+
+outbound = OutboundQueues()
@@ -0,0 +1,168 @@
+import threading
+
+from sqlalchemy import bindparam, or_
+from sqlalchemy.orm import aliased
+
+from app.extensions import db, sio, logger
+from app.models import User, Friend, GroupUser
+from app.utils import get_timestamp_now
+
+online_users = {}  # session id -> user id
+user_sessions = {}  # user id -> set of session id
+
+
+def add_session(session_id, user_id):
+    """
+    Register an authenticated socket, a socket authenticating again as another user leaves its previous user first
+    Returns:
+        True if it is the first session of the user
+    """
+    previous_id = online_users.get(session_id)
+    if previous_id == user_id:
+        return False
+    if previous_id is not None and remove_session(session_id) is not None:
+        presence.user_offline(previous_id)
+    online_users[session_id] = user_id
+    sessions = user_sessions.setdefault(user_id, set())
+    sessions.add(session_id)
+    return len(sessions) == 1
+
+
+def remove_session(session_id):
+    """
+    Unregister a socket
+    Returns:
+        user id if it was the last session of the user, else None
+    """
+    user_id = online_users.pop(session_id, None)
+    sessions = user_sessions.get(user_id)
+    if sessions is None:
+        return None
+    sessions.discard(session_id)
+    if sessions:
+        return None
+    user_sessions.pop(user_id, None)
+    return user_id
+
+
+def get_user_sessions(user_id):
+    """
+    Session ids of all sockets authenticated as the user
+    Args:
+        user_id:
+
+    Returns:
+        list of session id, empty if the user is offline
+    """
+    return list(user_sessions.get(user_id, ()))
+
+
+class Presence(object):
+    """
+    Presence of the users, delivered to their friends and group peers only.
+    Logins and logouts are coalesced during PRESENCE_INTERVAL seconds, then every peer receives one presence event
+    with the list of its changed peers, and last_seen of the changed users is written with one batched UPDATE.
+    """
+
+    def __init__(self):
+        self.app = None
+        self.interval = 1.0
+        self._changes = {}  # user_id -> (online, timestamp), latest state wins
+        self._lock = threading.Lock()
+        self._task = None
+
+    def init_app(self, app):
+        self.app = app
+        self.interval = app.config.get('PRESENCE_INTERVAL', 1.0)
+
+    def user_online(self, user_id):
+        self._record(user_id, True)
+
+    def user_offline(self, user_id):
+        self._record(user_id, False)
+
+    def _record(self, user_id, online):
+        with self._lock:
+            self._changes[user_id] = (online, get_timestamp_now())
+            start = self._task is None
+            self._task = True  # the single writer slot is claimed, the task starts below
+        # started outside the lock: under eventlet starting a task yields to the hub, another login would block
+        # the whole thread on the lock
+        if start:
+            self._task = sio.start_background_task(self._run)
+
+    def _run(self):
+        while True:
+            sio.sleep(self.interval)
+            try:
+                self.flush()
+            except Exception as ex:
+                logger.error('Presence flush error: ' + str(ex))
+
+    @staticmethod
+    def get_peers(users_id):
+        """
+        Friends and group peers of the users with two queries
+        Args:
+            users_id: list of user id
+
+        Returns:
+            dict user id -> set of peer id
+        """
+        peers = {user_id: set() for user_id in users_id}
+        friends = db.session.query(Friend.user_id_1, Friend.user_id_2).filter(
+            or_(Friend.user_id_1.in_(users_id), Friend.user_id_2.in_(users_id))).all()
+        for user_id_1, user_id_2 in friends:
+            if user_id_1 in peers:
+                peers[user_id_1].add(user_id_2)
+            if user_id_2 in peers:
+                peers[user_id_2].add(user_id_1)
+
+        member = aliased(GroupUser)
+        group_peers = db.session.query(GroupUser.user_id, member.user_id).join(
+            member, member.group_id == GroupUser.group_id).filter(GroupUser.user_id.in_(users_id)).all()
+        for user_id, peer_id in group_peers:
+            peers[user_id].add(peer_id)
+
+        for user_id in users_id:
+            peers[user_id].discard(user_id)
+        return peers
+
+    def flush(self):
+        """
+        Send the coalesced presence changes to the online peers and store last_seen
+        """
+        with self._lock:
+            changes, self._changes = self._changes, {}
+        if not changes:
+            return
+
+        with self.app.app_context():
+            peers = self.get_peers(list(changes))
+            diffs = {}
+            for user_id, (online, timestamp) in changes.items():
+                item = {"user_id": user_id, "online": online, "last_seen": timestamp}
+                for peer_id in peers[user_id]:
+                    diffs.setdefault(peer_id, []).append(item)
+
+            for peer_id, items in diffs.items():
+                for session_id in get_user_sessions(peer_id):
+                    sio.emit('presence', {"changes": items}, room=session_id)
+
+            users = User.__table__
+            db.session.execute(users.update().where(users.c.id == bindparam('_id')).values(
+                last_seen=bindparam('last_seen')),
+                [{"_id": user_id, "last_seen": timestamp} for user_id, (online, timestamp) in changes.items()])
+            cache = self.app.extensions.get('model_cache')
+            if cache is not None:
+                cache.invalidate(User, *changes)
+            db.session.commit()
+
+    def snapshot(self, user_id):
+        """
+        Online peers of the user, sent to a session when it authenticates
+        """
+        return [peer_id for peer_id in self.get_peers([user_id])[user_id] if get_user_sessions(peer_id)]
+
+
+presence = Presence()
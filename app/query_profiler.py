@@ -0,0 +1,151 @@
+import re
+from collections import Counter
+from contextlib import contextmanager
+from time import perf_counter, strftime
+
+from flask import g, has_app_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from app.decorators import socket_event_hooks
+from app.extensions import slow_query_logger
+from app.metrics import metrics
+
+_re_string = re.compile(r"'(?:[^'\\]|\\.|'')*'")
+_re_number = re.compile(r"\b\d+(?:\.\d+)?\b")
+_re_placeholder = re.compile(r"%s|%\(\w+\)s|:\w+|\?")
+_re_in_list = re.compile(r"\bIN\s*\((?:\s*\?\s*,)*\s*\?\s*\)", re.IGNORECASE)
+_re_values = re.compile(r"\bVALUES\s*(\((?:\s*\?\s*,)*\s*\?\s*\))(?:\s*,\s*\((?:\s*\?\s*,)*\s*\?\s*\))+", re.IGNORECASE)
+_re_space = re.compile(r"\s+")
+
+
+def normalize_sql(statement):
+    """
+    Normalize a sql statement to its shape: literals and placeholders become ?, IN lists and multi-row VALUES
+    are collapsed, so the same query with different parameters has the same shape
+    Args:
+        statement: sql string
+
+    Returns:
+        normalized sql string
+    """
+    shape = _re_string.sub('?', statement)
+    shape = _re_placeholder.sub('?', shape)
+    shape = _re_number.sub('?', shape)
+    shape = _re_in_list.sub('IN (?)', shape)
+    shape = _re_values.sub(r'VALUES \1', shape)
+    return _re_space.sub(' ', shape).strip()
+
+
+class QueryProfiler(object):
+    """
+    Opt-in SQL profiler hooked into the SQLAlchemy engine events.
+    It counts queries and the db time of every request or socket event, writes the slow queries to
+    logs/slow_query.log and flags the statement shapes repeated inside one request as N+1 candidates.
+    """
+
+    def __init__(self):
+        self.slow_query_threshold = 0.1
+        self.n_plus_one_threshold = 5
+        self.headers = False
+
+    def init_app(self, app):
+        """
+        Init the profiler, do nothing if SQL_PROFILER_ENABLED is False
+        :param app:
+        :return:
+        """
+        if not app.config.get('SQL_PROFILER_ENABLED', False):
+            return
+        self.slow_query_threshold = app.config.get('SQL_SLOW_QUERY_THRESHOLD', 0.1)
+        self.n_plus_one_threshold = app.config.get('SQL_N_PLUS_ONE_THRESHOLD', 5)
+        self.headers = app.config.get('SQL_PROFILER_HEADERS', app.debug)
+
+        metrics.describe('db_queries_total', 'counter', 'SQL statements executed')
+        metrics.describe('db_query_duration_seconds', 'histogram', 'Total db time of a request or socket event')
+        metrics.describe('db_n_plus_one_total', 'counter', 'Statement shapes repeated inside one request')
+
+        if not event.contains(Engine, 'before_cursor_execute', self._before_cursor_execute):
+            event.listen(Engine, 'before_cursor_execute', self._before_cursor_execute)
+            event.listen(Engine, 'after_cursor_execute', self._after_cursor_execute)
+            event.listen(Engine, 'handle_error', self._handle_error)
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+        if self.track_event not in socket_event_hooks:
+            socket_event_hooks.append(self.track_event)
+
+    @staticmethod
+    def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_start_time', []).append(perf_counter())
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        duration = perf_counter() - conn.info['query_start_time'].pop()
+        profile = g.get('query_profile') if has_app_context() else None
+        if profile is None:
+            return
+        shape = normalize_sql(statement)
+        profile['count'] += 1
+        profile['time'] += duration
+        profile['shapes'][shape] += 1
+        if duration >= self.slow_query_threshold:
+            slow_query_logger.warning('%s SLOW %.1fms [%s] %s', strftime('[%Y-%b-%d %H:%M]'), duration * 1000,
+                                      profile['scope'], shape)
+
+    @staticmethod
+    def _handle_error(exception_context):
+        # a failed statement never reaches after_cursor_execute, drop its start time here
+        conn = exception_context.connection
+        if conn is not None and conn.info.get('query_start_time'):
+            conn.info['query_start_time'].pop()
+
+    def _start(self, scope):
+        g.query_profile = {'scope': scope, 'count': 0, 'time': 0.0, 'shapes': Counter()}
+
+    def _finish(self):
+        """
+        Close the profile of the current request or socket event
+        Returns:
+            the profile, None if there is no profile
+        """
+        profile = g.pop('query_profile', None)
+        if profile is None:
+            return None
+        labels = (('scope', profile['scope']),)
+        metrics.inc('db_queries_total', labels, profile['count'])
+        metrics.observe('db_query_duration_seconds', labels, profile['time'])
+
+        profile['n_plus_one'] = [(shape, count) for shape, count in profile['shapes'].items()
+                                 if count >= self.n_plus_one_threshold]
+        for shape, count in profile['n_plus_one']:
+            metrics.inc('db_n_plus_one_total', labels)
+            slow_query_logger.warning('%s N+1 %d times [%s] %s', strftime('[%Y-%b-%d %H:%M]'), count,
+                                      profile['scope'], shape)
+        return profile
+
+    def _before_request(self):
+        self._start(request.endpoint or 'unmatched')
+
+    def _after_request(self, response):
+        profile = self._finish()
+        if profile is not None and self.headers:
+            response.headers['X-Query-Count'] = str(profile['count'])
+            response.headers['X-Query-Time-Ms'] = '{:.1f}'.format(profile['time'] * 1000)
+            response.headers['X-Query-N-Plus-One'] = str(len(profile['n_plus_one']))
+        return response
+
+    @contextmanager
+    def track_event(self, event_name, namespace):
+        """
+        Hook of the socket_event decorator, profile the queries of one socket event
+        Args:
+            event_name:
+            namespace:
+        """
+        self._start('socket:' + event_name)
+        try:
+            yield
+        finally:
+            self._finish()
+
+
+query_profiler = QueryProfiler()
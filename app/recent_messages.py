@@ -0,0 +1,217 @@
+import threading
+from collections import namedtuple, OrderedDict
+
+from sqlalchemy import event, inspect
+
+from app.archive import ArchivedMessage
+from app.extensions import db
+from app.metrics import metrics
+from app.models import Message
+from app.replicas import replica_router
+
+CachedMessage = namedtuple('CachedMessage', ['id', 'message', 'sender_id', 'created_date', 'seen'])
+
+MESSAGE_OVERHEAD = 400  # bytes of a cached message besides its text and ids, tuple, strings and list slot
+
+
+def sort_key(message):
+    return message.created_date, message.id
+
+
+def message_size(message):
+    return MESSAGE_OVERHEAD + len(message.message or '') + len(message.id) + len(message.sender_id or '')
+
+
+class Conversation(object):
+    """
+    Newest messages of a conversation, sorted by (created_date, id)
+    """
+    __slots__ = ('messages', 'complete', 'size')
+
+    def __init__(self, messages, complete):
+        self.messages = messages
+        self.complete = complete  # every message of the conversation is in the list
+        self.size = sum(message_size(message) for message in messages)
+
+
+class RecentMessages(object):
+    """
+    The last RECENT_CACHE_MESSAGES messages of the active conversations, in memory. A first history page is filled
+    from the primary once, then the sends, seen updates and deletes committed by this process are applied to it, so
+    the next first pages and the latest message of the chat list are read without a query.
+    Conversations are evicted least recently used first when the cache holds more than RECENT_CACHE_BYTES.
+    Each process has its own cache, run one socket process (like the presence maps) or disable it.
+    """
+
+    def __init__(self):
+        self.app = None
+        self.size = 50
+        self.max_bytes = 64 * 1024 * 1024
+        self.bytes = 0
+        self._conversations = OrderedDict()  # group id -> Conversation, least recently used first
+        self._versions = {}  # group id -> number of committed changes, a fill read before a change is dropped
+        self._epoch = 0
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        """
+        Init the cache, do nothing if RECENT_CACHE_ENABLED is False
+        :param app:
+        :return:
+        """
+        self.app = None
+        self.clear()
+        if not app.config.get('RECENT_CACHE_ENABLED'):
+            return
+        self.app = app
+        self.size = app.config.get('RECENT_CACHE_MESSAGES', 50)
+        self.max_bytes = app.config.get('RECENT_CACHE_BYTES', 64 * 1024 * 1024)
+        app.extensions['recent_messages'] = self
+
+        metrics.describe('recent_cache_requests_total', 'counter', 'Reads of the recent messages cache')
+        metrics.describe('recent_cache_bytes', 'gauge', 'Estimated size of the recent messages cache')
+        metrics.describe('recent_cache_conversations', 'gauge', 'Conversations in the recent messages cache')
+        metrics.add_collector(self.collect)
+
+        if not event.contains(db.session, 'after_flush', self._after_flush):
+            event.listen(db.session, 'after_flush', self._after_flush)
+            event.listen(db.session, 'after_commit', self._after_commit)
+            event.listen(db.session, 'after_rollback', self._after_rollback)
+
+    def clear(self):
+        with self._lock:
+            self._conversations.clear()
+            self._versions.clear()
+            self._epoch += 1
+            self.bytes = 0
+
+    def get_page(self, group_id, offset, limit):
+        """
+        Cached messages of a conversation, newest first
+        Returns:
+            list of messages, None if the page is not in the cache
+        """
+        with self._lock:
+            conversation = self._conversations.get(group_id)
+            if conversation is not None and (conversation.complete or offset + limit <= len(conversation.messages)):
+                self._conversations.move_to_end(group_id)
+                end = len(conversation.messages) - offset
+                messages = conversation.messages[max(end - limit, 0):max(end, 0)][::-1]
+            else:
+                messages = None
+        metrics.inc('recent_cache_requests_total', (('result', 'miss' if messages is None else 'hit'),))
+        return messages
+
+    def load(self, group_id, loader):
+        """
+        Read the newest messages of a conversation from the primary and cache them
+        Args:
+            group_id:
+            loader: function(limit) returning the newest messages, newest first
+
+        Returns:
+            the loaded messages, newest first
+        """
+        version = self._version(group_id)
+        with replica_router.primary():
+            messages = loader(self.size)
+        cached = [message if isinstance(message, ArchivedMessage) else
+                  CachedMessage(message.id, message.message, message.sender_id, message.created_date,
+                                bool(message.seen)) for message in reversed(messages)]
+        with self._lock:
+            if version == (self._epoch, self._versions.get(group_id, 0)):
+                self._put(group_id, Conversation(cached, complete=len(messages) < self.size))
+        return cached[::-1]
+
+    def discard(self, group_id):
+        """
+        Drop a conversation from the cache at the commit, after a bulk delete or update of its messages
+        """
+        db.session.info.setdefault('recent_messages', []).append(('discard', group_id, None))
+
+    def seen(self, group_id, messages_id):
+        """
+        Mark messages seen in the cache at the commit, after their bulk update
+        """
+        db.session.info.setdefault('recent_messages', []).append(('seen', group_id, set(messages_id)))
+
+    def _version(self, group_id):
+        with self._lock:
+            return self._epoch, self._versions.get(group_id, 0)
+
+    def _put(self, group_id, conversation):
+        previous = self._conversations.pop(group_id, None)
+        if previous is not None:
+            self.bytes -= previous.size
+        self._conversations[group_id] = conversation
+        self.bytes += conversation.size
+        while self.bytes > self.max_bytes and self._conversations:
+            _, evicted = self._conversations.popitem(last=False)
+            self.bytes -= evicted.size
+
+    def _apply(self, operation, group_id, value):
+        """
+        Apply a committed change, the lock is held
+        """
+        if len(self._versions) > 100000:
+            # the pending fills are dropped with the versions
+            self._versions.clear()
+            self._epoch += 1
+        self._versions[group_id] = self._versions.get(group_id, 0) + 1
+        conversation = self._conversations.get(group_id)
+        if conversation is None:
+            return
+        if operation == 'discard':
+            self.bytes -= self._conversations.pop(group_id).size
+        elif operation == 'add':
+            conversation.messages.append(value)
+            if len(conversation.messages) > 1 and sort_key(conversation.messages[-2]) > sort_key(value):
+                conversation.messages.sort(key=sort_key)
+            conversation.size += message_size(value)
+            self.bytes += message_size(value)
+            if len(conversation.messages) > self.size:
+                removed = conversation.messages.pop(0)
+                conversation.size -= message_size(removed)
+                self.bytes -= message_size(removed)
+                conversation.complete = False
+            self._put(group_id, conversation)
+        elif operation == 'seen':
+            conversation.messages = [message._replace(seen=True) if message.id in value and
+                                     isinstance(message, CachedMessage) else message
+                                     for message in conversation.messages]
+
+    def _after_flush(self, session, flush_context):
+        operations = session.info.setdefault('recent_messages', [])
+        for instance in session.new:
+            if isinstance(instance, Message):
+                operations.append(('add', instance.group_id, CachedMessage(
+                    instance.id, instance.message, instance.sender_id, instance.created_date, bool(instance.seen))))
+        for instance in session.dirty:
+            if isinstance(instance, Message) and session.is_modified(instance):
+                changed = {attr.key for attr in inspect(instance).attrs if attr.history.has_changes()}
+                if changed == {'seen'} and instance.seen:
+                    operations.append(('seen', instance.group_id, {instance.id}))
+                else:
+                    operations.append(('discard', instance.group_id, None))
+        for instance in session.deleted:
+            if isinstance(instance, Message):
+                operations.append(('discard', instance.group_id, None))
+
+    def _after_commit(self, session):
+        operations = session.info.pop('recent_messages', None)
+        if not operations:
+            return
+        with self._lock:
+            for operation, group_id, value in operations:
+                self._apply(operation, group_id, value)
+
+    @staticmethod
+    def _after_rollback(session):
+        session.info.pop('recent_messages', None)
+
+    def collect(self):
+        return [('recent_cache_bytes', (), self.bytes),
+                ('recent_cache_conversations', (), len(self._conversations))]
+
+
+recent_messages = RecentMessages()
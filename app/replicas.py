@@ -0,0 +1,203 @@
+import threading
+from contextlib import contextmanager
+from time import monotonic
+
+from flask import g, has_app_context, request
+from flask_jwt_extended import get_jwt_identity
+from sqlalchemy import event
+from sqlalchemy.sql.expression import UpdateBase
+
+from app.decorators import socket_event_hooks
+from app.extensions import db, logger
+from app.metrics import metrics
+from app.presence import online_users
+
+
+class ReplicaRouter(object):
+    """
+    Route the reads of the views decorated with read_replica to the replica binds of SQLALCHEMY_REPLICAS,
+    everything else stays on the primary: flushes, INSERT/UPDATE/DELETE statements, the reads following a write
+    of the same request, and the reads of a user during REPLICA_STICKY_SECONDS after one of their writes.
+    A replica lagging more than REPLICA_MAX_LAG seconds, or failing, is skipped until its next lag check.
+    Every bind of SQLALCHEMY_BINDS has its own engine and connection pool.
+    """
+
+    def __init__(self):
+        self.app = None
+        self.replicas = []
+        self.max_lag = 5
+        self.check_interval = 5
+        self.lag_query = None
+        self.sticky_seconds = 5
+        self._lags = {}  # bind key -> (lag in seconds, checked at)
+        self._sticky = {}  # user id -> reads go to the primary until this time
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        """
+        Init the router, do nothing if SQLALCHEMY_REPLICAS is empty
+        :param app:
+        :return:
+        """
+        binds = app.config.get('SQLALCHEMY_BINDS') or {}
+        self.replicas = [key for key in app.config.get('SQLALCHEMY_REPLICAS', []) if key in binds]
+        if not self.replicas:
+            return
+        self.app = app
+        self.max_lag = app.config.get('REPLICA_MAX_LAG', 5)
+        self.check_interval = app.config.get('REPLICA_LAG_CHECK_INTERVAL', 5)
+        self.lag_query = app.config.get('REPLICA_LAG_QUERY')
+        self.sticky_seconds = app.config.get('REPLICA_STICKY_SECONDS', 5)
+        app.extensions['replicas'] = self
+
+        metrics.describe('db_replica_reads_total', 'counter', 'Statements of read_replica views sent to a replica')
+        metrics.describe('db_replica_fallbacks_total', 'counter', 'Reads sent to the primary, no healthy replica')
+        metrics.describe('db_replica_lag_seconds', 'gauge', 'Last measured lag of the replicas')
+        metrics.add_collector(self.collect)
+
+        for key in self.replicas:
+            engine = db.get_engine(app, bind=key)
+            event.listen(engine, 'handle_error', self._replica_error(key))
+        if not event.contains(db.session, 'after_flush', self._after_flush):
+            event.listen(db.session, 'after_flush', self._after_flush)
+        app.after_request(self._after_request)
+        if self.track_event not in socket_event_hooks:
+            socket_event_hooks.append(self.track_event)
+
+    def get_bind(self, session, clause=None):
+        """
+        Called by the session for every statement
+        Returns:
+            engine of a replica, None to use the primary
+        """
+        if not has_app_context() or not g.get('read_replica'):
+            return None
+        if isinstance(clause, UpdateBase):  # INSERT, UPDATE, DELETE
+            g.db_written = True
+            return None
+        if g.get('db_written') or session._flushing or session.new or session.dirty or session.deleted:
+            return None
+        if self.is_sticky(g.get('replica_identity')):
+            return None
+
+        key = g.get('replica_bind')
+        if key is None:
+            key = g.replica_bind = self._choose()
+        if not key:
+            return None
+        metrics.inc('db_replica_reads_total', (('bind', key),))
+        return db.get_engine(self.app, bind=key)
+
+    def _choose(self):
+        """
+        Round robin over the replicas lagging less than REPLICA_MAX_LAG
+        Returns:
+            bind key, '' if no replica is healthy
+        """
+        for _ in range(len(self.replicas)):
+            self._next = (self._next + 1) % len(self.replicas)
+            key = self.replicas[self._next]
+            if self.lag(key) <= self.max_lag:
+                return key
+        metrics.inc('db_replica_fallbacks_total', ())
+        return ''
+
+    def lag(self, key):
+        """
+        Replication lag of a replica, measured again every REPLICA_LAG_CHECK_INTERVAL seconds
+        Returns:
+            seconds, inf if the replica is broken
+        """
+        lag, checked_at = self._lags.get(key, (0, None))
+        if checked_at is not None and monotonic() - checked_at < self.check_interval:
+            return lag
+        if not self._lock.acquire(blocking=False):
+            return lag  # another thread is probing
+        try:
+            lag = self._probe(key)
+        except Exception as ex:
+            logger.error('Replica {} lag check error: {}'.format(key, ex))
+            lag = float('inf')
+        finally:
+            self._lock.release()
+        self._lags[key] = (lag, monotonic())
+        return lag
+
+    def _probe(self, key):
+        engine = db.get_engine(self.app, bind=key)
+        with engine.connect() as connection:
+            if self.lag_query:
+                return float(connection.execute(self.lag_query).scalar() or 0)
+            if engine.dialect.name == 'mysql':
+                status = connection.execute('SHOW SLAVE STATUS').first()
+                if status is None:
+                    return 0  # not a replica
+                lag = status['Seconds_Behind_Master']
+                return float('inf') if lag is None else float(lag)
+        return 0
+
+    def _replica_error(self, key):
+        def handle_error(context):
+            if context.is_disconnect or context.connection is None:
+                self._lags[key] = (float('inf'), monotonic())
+
+        return handle_error
+
+    def is_sticky(self, user_id):
+        until = self._sticky.get(user_id)
+        if until is None:
+            return False
+        if until < monotonic():
+            self._sticky.pop(user_id, None)
+            return False
+        return True
+
+    def stick(self, user_id):
+        """
+        Send the next reads of the user to the primary, so the user reads their own writes
+        """
+        if user_id is None:
+            return
+        now = monotonic()
+        if len(self._sticky) > 10000:
+            self._sticky = {key: until for key, until in self._sticky.items() if until > now}
+        self._sticky[user_id] = now + self.sticky_seconds
+
+    @staticmethod
+    def _after_flush(session, flush_context):
+        if has_app_context():
+            g.db_written = True
+
+    def _after_request(self, response):
+        if g.get('db_written'):
+            self.stick(get_jwt_identity())
+        return response
+
+    @staticmethod
+    @contextmanager
+    def primary():
+        """
+        The reads of the block go to the primary, e.g. to fill a cache kept up to date by the writes
+        """
+        read_replica = g.get('read_replica')
+        g.read_replica = False
+        try:
+            yield
+        finally:
+            g.read_replica = read_replica
+
+    @contextmanager
+    def track_event(self, event_name, namespace):
+        """
+        Hook of the socket_event decorator, a socket event writing makes its user sticky
+        """
+        yield
+        if g.get('db_written'):
+            self.stick(online_users.get(request.sid))
+
+    def collect(self):
+        return [('db_replica_lag_seconds', (('bind', key),), lag) for key, (lag, checked_at) in self._lags.items()]
+
+
+replica_router = ReplicaRouter()
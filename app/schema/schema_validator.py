@@ -36,3 +36,34 @@ password_validator = {
     },
     "required": ["new_password"]
 }
+
+group_messages_validator = {
+    "type": "object",
+    "properties": {
+        "group_id": {
+            "type": "string",
+            "minLength": 1,
+            "maxLength": 50
+        },
+        "messages": {
+            "type": "array",
+            "minItems": 1,
+            "items": {
+                "type": "object",
+                "properties": {
+                    "receiver_id": {
+                        "type": "string",
+                        "minLength": 1,
+                        "maxLength": 50
+                    },
+                    "message": {
+                        "type": "string",
+                        "minLength": 1
+                    }
+                },
+                "required": ["receiver_id", "message"]
+            }
+        }
+    },
+    "required": ["messages"]
+}
@@ -27,6 +27,93 @@ class ProdConfig(Config):
     SQLALCHEMY_DATABASE_URI = 'mysql://root:1234567aA@@db/secure_chat'
     SQLALCHEMY_TRACK_MODIFICATIONS = True
 
+    # read replica config
+    SQLALCHEMY_BINDS = {'replica_{}'.format(i): uri
+                        for i, uri in enumerate(filter(None, os_env.get('REPLICA_URIS', '').split(',')))}
+    SQLALCHEMY_REPLICAS = list(SQLALCHEMY_BINDS)  # binds receiving the reads of the read_replica views
+    REPLICA_MAX_LAG = 5  # seconds, a replica lagging more is skipped until its next lag check
+    REPLICA_LAG_CHECK_INTERVAL = 5  # seconds between two lag checks of a replica
+    REPLICA_LAG_QUERY = os_env.get('REPLICA_LAG_QUERY')  # sql returning the lag, default SHOW SLAVE STATUS
+    REPLICA_STICKY_SECONDS = 5  # after a write, the reads of the user stay on the primary
+
+    # message archive config
+    ARCHIVE_ENABLED = os_env.get('ARCHIVE_ENABLED') == '1'  # opt-in, on every app process before archiving
+    ARCHIVE_AFTER_DAYS = int(os_env.get('ARCHIVE_AFTER_DAYS', 90))  # older private messages go to the archive
+    ARCHIVE_SEGMENT_SIZE = 1000  # messages per segment
+    ARCHIVE_CACHE_SEGMENTS = 64  # decoded segments kept in memory
+
+    # recent messages cache config
+    RECENT_CACHE_ENABLED = True  # per process, disable when several processes serve the api
+    RECENT_CACHE_MESSAGES = 50  # newest messages kept per conversation
+    RECENT_CACHE_BYTES = 64 * 1024 * 1024
+
+    # model cache config
+    MODEL_CACHE_ENABLED = os_env.get('MODEL_CACHE_ENABLED', '1') == '1'  # kill switch
+    MODEL_CACHE_TTL = {'users': 60, 'groups': 300, 'friends': 300}  # seconds, by table
+    MODEL_CACHE_MAX_ENTRIES = 100000  # local cache
+    MODEL_CACHE_REDIS_URL = os_env.get('MODEL_CACHE_REDIS_URL')  # shared by the processes, needs redis-py
+
+    # metrics config
+    METRICS_ENABLED = True
+    METRICS_PATH = '/metrics'
+
+    # sql profiler config
+    SQL_PROFILER_ENABLED = False
+
+    # cpu profiler config
+    PROFILER_TOKEN = os_env.get('PROFILER_TOKEN')  # value of the X-Profile header profiling one request
+    PROFILER_SAMPLE_RATE = float(os_env.get('PROFILER_SAMPLE_RATE', 0))  # percentage of the traffic, 0.01 = 1%
+    PROFILER_INTERVAL = 0.01  # seconds between two samples
+    PROFILER_OUTPUT_DIR = 'logs/profiles'
+
+    # tracing config
+    TRACING_ENABLED = os_env.get('TRACING_ENABLED') == '1'
+    TRACING_SAMPLE_RATE = float(os_env.get('TRACING_SAMPLE_RATE', 0.1))
+    TRACING_EXPORT_PATH = 'logs/traces.jsonl'
+    TRACING_EXPORT_MAX_BYTES = 10000000
+    TRACING_EXPORT_BACKUP_COUNT = 10
+    TRACING_SERVICE_NAME = 'secure-chat'
+
+    # offline delivery config
+    PENDING_BATCH_SIZE = 100  # messages per new_private_msg_batch event
+    PENDING_FLUSH_LIMIT = 1000  # messages sent on login, the rest after the acks and the next login
+
+    # delta sync config
+    SYNC_CHUNK_SIZE = 500  # changes loaded per query while streaming
+    SYNC_MAX_CHANGES = 5000  # changes per sync request
+
+    # presence config
+    PRESENCE_INTERVAL = 1.0  # seconds, presence changes are coalesced and sent to the friends once per interval
+
+    # socket auth config
+    # the handshake needs ?token=<access token> or Authorization: Bearer, on once no client relies on the auth event
+    SOCKET_AUTH_ON_CONNECT = os_env.get('SOCKET_AUTH_ON_CONNECT') == '1'
+    SOCKET_AUTH_CACHE_TTL = 300  # seconds a verified token is trusted, revocations of other processes included
+    SOCKET_AUTH_CACHE_SIZE = 100000
+
+    # outbound queues config
+    OUTBOUND_HIGH_WATER = 1000  # packets queued for one connection, 0 for no limit
+    OUTBOUND_POLICY = 'sync'  # slow consumer: drop_oldest, disconnect or sync
+    OUTBOUND_COALESCE_EVENTS = ['presence', 'typing']  # held and merged above the high-water mark
+    OUTBOUND_FLUSH_INTERVAL = 0.5  # seconds between two checks of the held events
+
+    # room broadcast config
+    BROADCAST_TICK = 0  # seconds the events of a busy room are gathered in one room_batch frame, 0 sends at once
+    BROADCAST_MIN_MEMBERS = 50  # smaller rooms are sent at once
+    BROADCAST_MAX_BATCH = 100  # events per room_batch frame
+
+    # socket transport config
+    SOCKETIO_TRANSPORTS = ['polling', 'websocket']  # ['websocket'] rejects the long-polling handshakes
+    SOCKETIO_ALLOW_UPGRADES = True  # polling clients move to websocket after the handshake
+    SOCKETIO_PING_INTERVAL = 25  # seconds, a longer interval wakes idle mobile clients less often
+    SOCKETIO_PING_TIMEOUT = 60  # seconds without pong before the connection is closed
+    SOCKETIO_HTTP_COMPRESSION = True  # gzip/deflate of the polling payloads
+    SOCKETIO_COMPRESSION_THRESHOLD = 1024  # bytes, smaller polling payloads are not compressed
+    SOCKETIO_WEBSOCKET_COMPRESSION = True  # permessage-deflate of the websocket frames, when the client offers it
+
+    # group send config
+    GROUP_SEND_MAX_RECIPIENTS = 500  # ciphertexts in one group send, one per member
+
 
 class DevConfig(Config):
     """Development configuration."""
@@ -45,3 +132,91 @@ class DevConfig(Config):
     # mysql config
     SQLALCHEMY_DATABASE_URI = 'mysql://root:1234567aA@@localhost/secure_chat'
     SQLALCHEMY_TRACK_MODIFICATIONS = True
+
+    # read replica config
+    SQLALCHEMY_BINDS = {}
+    SQLALCHEMY_REPLICAS = []
+    REPLICA_MAX_LAG = 5
+    REPLICA_LAG_CHECK_INTERVAL = 5
+    REPLICA_LAG_QUERY = None
+    REPLICA_STICKY_SECONDS = 5
+
+    # message archive config
+    ARCHIVE_ENABLED = False
+    ARCHIVE_AFTER_DAYS = 90
+    ARCHIVE_SEGMENT_SIZE = 1000
+    ARCHIVE_CACHE_SEGMENTS = 64
+
+    # recent messages cache config
+    RECENT_CACHE_ENABLED = True
+    RECENT_CACHE_MESSAGES = 50
+    RECENT_CACHE_BYTES = 64 * 1024 * 1024
+
+    # model cache config
+    MODEL_CACHE_ENABLED = True
+    MODEL_CACHE_TTL = {'users': 60, 'groups': 300, 'friends': 300}
+    MODEL_CACHE_MAX_ENTRIES = 100000
+    MODEL_CACHE_REDIS_URL = None
+
+    # metrics config
+    METRICS_ENABLED = True
+    METRICS_PATH = '/metrics'
+
+    # sql profiler config
+    SQL_PROFILER_ENABLED = True
+    SQL_PROFILER_HEADERS = True  # X-Query-Count, X-Query-Time-Ms and X-Query-N-Plus-One response headers
+    SQL_SLOW_QUERY_THRESHOLD = 0.1  # seconds
+    SQL_N_PLUS_ONE_THRESHOLD = 5  # same statement shape repeated in one request
+
+    # cpu profiler config
+    PROFILER_TOKEN = os_env.get('PROFILER_TOKEN', 'dev-profile')
+    PROFILER_SAMPLE_RATE = float(os_env.get('PROFILER_SAMPLE_RATE', 0))
+    PROFILER_INTERVAL = 0.005
+    PROFILER_OUTPUT_DIR = 'logs/profiles'
+
+    # tracing config
+    TRACING_ENABLED = True
+    TRACING_SAMPLE_RATE = 1.0
+    TRACING_EXPORT_PATH = 'logs/traces.jsonl'
+    TRACING_EXPORT_MAX_BYTES = 10000000
+    TRACING_EXPORT_BACKUP_COUNT = 10
+    TRACING_SERVICE_NAME = 'secure-chat'
+
+    # offline delivery config
+    PENDING_BATCH_SIZE = 100  # messages per new_private_msg_batch event
+    PENDING_FLUSH_LIMIT = 1000  # messages sent on login, the rest after the acks and the next login
+
+    # delta sync config
+    SYNC_CHUNK_SIZE = 500  # changes loaded per query while streaming
+    SYNC_MAX_CHANGES = 5000  # changes per sync request
+
+    # presence config
+    PRESENCE_INTERVAL = 1.0  # seconds, presence changes are coalesced and sent to the friends once per interval
+
+    # socket auth config
+    SOCKET_AUTH_ON_CONNECT = False
+    SOCKET_AUTH_CACHE_TTL = 300
+    SOCKET_AUTH_CACHE_SIZE = 100000
+
+    # outbound queues config
+    OUTBOUND_HIGH_WATER = 1000
+    OUTBOUND_POLICY = 'sync'
+    OUTBOUND_COALESCE_EVENTS = ['presence', 'typing']
+    OUTBOUND_FLUSH_INTERVAL = 0.5
+
+    # room broadcast config
+    BROADCAST_TICK = 0
+    BROADCAST_MIN_MEMBERS = 50
+    BROADCAST_MAX_BATCH = 100
+
+    # socket transport config
+    SOCKETIO_TRANSPORTS = ['polling', 'websocket']
+    SOCKETIO_ALLOW_UPGRADES = True
+    SOCKETIO_PING_INTERVAL = 25
+    SOCKETIO_PING_TIMEOUT = 60
+    SOCKETIO_HTTP_COMPRESSION = True
+    SOCKETIO_COMPRESSION_THRESHOLD = 1024
+    SOCKETIO_WEBSOCKET_COMPRESSION = True
+
+    # group send config
+    GROUP_SEND_MAX_RECIPIENTS = 500
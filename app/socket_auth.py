@@ -0,0 +1,160 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from time import time
+
+from flask import request
+from flask_jwt_extended import decode_token
+from jwt import ExpiredSignatureError
+from sqlalchemy import event
+
+from app.extensions import db
+from app.metrics import metrics
+from app.models import Token
+
+INVALID_TTL = 60  # seconds a malformed or badly signed token stays rejected without decoding it again
+
+
+def get_handshake_token():
+    """
+    Access token of a Socket.IO handshake: the query string (io('...', {query: {token}})) or the
+    Authorization: Bearer header (extraHeaders)
+    """
+    token = request.args.get('token')
+    if token:
+        return token
+    header = request.headers.get('Authorization', '')
+    if header.startswith('Bearer '):
+        return header[len('Bearer '):]
+    return None
+
+
+class SocketAuth(object):
+    """
+    Verification of the access tokens of the sockets, at connect and in the auth event. The signature, the expiry
+    and the revocation check run once per token, the result is kept by sha256 of the token until the token
+    expires or SOCKET_AUTH_CACHE_TTL, revocations committed by this process drop their token at once.
+    With SOCKET_AUTH_ON_CONNECT, a connect without a valid token is rejected by the handshake (HTTP 401),
+    before the session of the socket exists.
+    """
+
+    def __init__(self):
+        self.app = None
+        self.on_connect = False
+        self.cache_ttl = 300
+        self.cache_size = 100000
+        self._results = OrderedDict()  # token hash -> (user id or None, reason, valid until, jti)
+        self._hashes = {}  # jti -> token hash
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        """
+        Init the token cache
+        :param app:
+        :return:
+        """
+        self.app = app
+        self.on_connect = app.config.get('SOCKET_AUTH_ON_CONNECT', False)
+        self.cache_ttl = app.config.get('SOCKET_AUTH_CACHE_TTL', 300)
+        self.cache_size = app.config.get('SOCKET_AUTH_CACHE_SIZE', 100000)
+        with self._lock:
+            self._results.clear()
+            self._hashes.clear()
+
+        metrics.describe('socketio_connects_total', 'counter', 'Socket.IO connections, accepted or rejected')
+        metrics.describe('socketio_auth_rejects_total', 'counter', 'Socket tokens rejected, by reason')
+        metrics.describe('socketio_auth_cache_total', 'counter', 'Socket token verifications, from the cache or not')
+
+        if not event.contains(db.session, 'after_flush', self._after_flush):
+            event.listen(db.session, 'after_flush', self._after_flush)
+            event.listen(db.session, 'after_commit', self._after_commit)
+            event.listen(db.session, 'after_rollback', self._after_rollback)
+
+    def authenticate(self, token):
+        """
+        Verify an access token: signature, expiry, type and revocation
+        Args:
+            token: encoded jwt
+
+        Returns:
+            (user id, None) or (None, reason of the reject)
+        """
+        if not token:
+            return self._reject('missing')
+        key = hashlib.sha256(token.encode()).hexdigest()
+        now = time()
+        with self._lock:
+            result = self._results.get(key)
+            if result is not None and result[2] <= now:
+                self._drop(key)
+                result = None
+        if result is not None:
+            metrics.inc('socketio_auth_cache_total', (('result', 'hit'),))
+            if result[1] is not None:
+                return self._reject(result[1])
+            return result[0], None
+
+        metrics.inc('socketio_auth_cache_total', (('result', 'miss'),))
+        try:
+            decoded_token = decode_token(token)
+        except ExpiredSignatureError:
+            self._store(key, None, 'expired', now + INVALID_TTL, None)
+            return self._reject('expired')
+        except Exception:
+            self._store(key, None, 'invalid', now + INVALID_TTL, None)
+            return self._reject('invalid')
+
+        expires = decoded_token['exp']
+        if decoded_token['type'] != 'access':
+            self._store(key, None, 'invalid', expires, None)
+            return self._reject('invalid')
+        if Token.is_token_revoked(decoded_token):
+            # a revoked token stays revoked
+            self._store(key, None, 'revoked', expires, decoded_token['jti'])
+            return self._reject('revoked')
+        user_id = decoded_token[self.app.config['JWT_IDENTITY_CLAIM']]
+        self._store(key, user_id, None, min(expires, now + self.cache_ttl), decoded_token['jti'])
+        return user_id, None
+
+    def _reject(self, reason):
+        metrics.inc('socketio_auth_rejects_total', (('reason', reason),))
+        return None, reason
+
+    def _store(self, key, user_id, reason, valid_until, jti):
+        with self._lock:
+            self._results[key] = (user_id, reason, valid_until, jti)
+            if jti is not None:
+                self._hashes[jti] = key
+            while len(self._results) > self.cache_size:
+                self._drop(next(iter(self._results)))
+
+    def _drop(self, key):
+        """
+        Remove a token from the cache, the lock is held
+        """
+        result = self._results.pop(key, None)
+        if result is not None and result[3] is not None:
+            self._hashes.pop(result[3], None)
+
+    @staticmethod
+    def _after_flush(session, flush_context):
+        for instance in session.dirty:
+            if isinstance(instance, Token) and instance.revoked:
+                session.info.setdefault('revoked_jti', set()).add(instance.jti)
+
+    def _after_commit(self, session):
+        revoked = session.info.pop('revoked_jti', None)
+        if not revoked:
+            return
+        with self._lock:
+            for jti in revoked:
+                key = self._hashes.get(jti)
+                if key is not None:
+                    self._drop(key)
+
+    @staticmethod
+    def _after_rollback(session):
+        session.info.pop('revoked_jti', None)
+
+
+socket_auth = SocketAuth()
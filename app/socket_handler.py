@@ -1,27 +1,112 @@
-import uuid
+from flask import request, current_app
+from flask_socketio import join_room, leave_room, disconnect as disconnect_socket
+from jsonschema import validate, ValidationError
+
+from app.broadcast import broadcaster
+from app.decorators import socket_event
+from app.extensions import db, logger, sio
+from app.group_send import send_group_copies
+from app.ids import new_id
+from app.metrics import metrics
+from app.models import Message, User, PendingDelivery, Change
+from app.presence import presence, online_users, add_session, remove_session, get_user_sessions
+from app.schema.schema_validator import group_messages_validator
+from app.socket_auth import socket_auth, get_handshake_token
+from app.tracing import tracer
+from app.utils import generate_id, get_timestamp_now
 
-from flask import request
-from flask_jwt_extended import decode_token
-from flask_socketio import send, emit, join_room, leave_room
 
-from app.extensions import sio, db, logger
-from app.models import Message, User
-from app.utils import generate_id, get_timestamp_now
+def flush_pending_messages(user_id, session_id):
+    """
+    Send the messages received while the user was offline to a session, in batches of
+    PENDING_BATCH_SIZE messages on the event new_private_msg_batch.
+    Messages stay pending until the client acks them with ack_private_msg.
+    Args:
+        user_id:
+        session_id:
+
+    Returns:
+
+    """
+    limit = current_app.config.get('PENDING_FLUSH_LIMIT', 1000)
+    batch_size = current_app.config.get('PENDING_BATCH_SIZE', 100)
+    messages = PendingDelivery.get_messages(user_id, limit=limit + 1)
+    has_more = len(messages) > limit
+    messages = Message.many_to_json(messages[:limit])
+    for index in range(0, len(messages), batch_size):
+        last_batch = index + batch_size >= len(messages)
+        tracer.emit('new_private_msg_batch', {'messages': messages[index:index + batch_size],
+                                              'has_more': has_more and last_batch}, room=session_id)
+
+
+def login_session(user_id, session_id):
+    """
+    Register the socket of an authenticated user
+    Args:
+        user_id:
+        session_id:
+
+    Returns:
+
+    """
+    if add_session(session_id, user_id):
+        presence.user_online(user_id)
+
+
+def send_login_state(user_id, session_id):
+    """
+    Send a socket that just logged in the presence of its peers and its pending messages
+    Args:
+        user_id:
+        session_id:
+
+    Returns:
+
+    """
+    now = get_timestamp_now()
+    sio.emit('presence', {"changes": [{"user_id": peer_id, "online": True, "last_seen": now}
+                                      for peer_id in presence.snapshot(user_id)]}, room=session_id)
+    flush_pending_messages(user_id, session_id)
+
 
-online_users = {}
+def send_login_state_task(app, user_id, session_id):
+    """
+    send_login_state in a background task: the connect handler runs before the CONNECT packet is sent, the events
+    of the login have to follow it
+    """
+    sio.sleep(0)  # the task can start before the handler returns, let the CONNECT packet go first
+    with app.app_context():
+        try:
+            send_login_state(user_id, session_id)
+        except Exception as ex:
+            logger.error('Login state error: ' + str(ex))
 
 
-@sio.on('connect')
+@socket_event('connect')
 def connect():
     """
-    The connection event handler can return False to reject the connection, or it can also raise ConectionRefusedError
+    The connection event handler can return False to reject the connection, or it can also raise ConectionRefusedError.
+    With SOCKET_AUTH_ON_CONNECT the access token of the handshake (?token=... or Authorization: Bearer) is required,
+    the socket is logged in without the auth event
     Returns:
 
     """
+    if not socket_auth.on_connect:
+        metrics.inc('socketio_connects_total', (('result', 'accepted'),))
+        print('[CONNECTED] ' + request.sid)
+        return
+    user_id, reason = socket_auth.authenticate(get_handshake_token())
+    if user_id is None:
+        # nothing was allocated for this socket, the handshake fails with 401
+        metrics.inc('socketio_connects_total', (('result', 'rejected'),))
+        return False
+    metrics.inc('socketio_connects_total', (('result', 'accepted'),))
     print('[CONNECTED] ' + request.sid)
+    login_session(user_id, request.sid)
+    sio.start_background_task(send_login_state_task, current_app._get_current_object(), user_id, request.sid)
 
 
-@sio.on('connect', namespace='/message2')
+@socket_event('connect', namespace='/message2')
 def test_connect2():
     """
     The connection event handler can return False to reject the connection, or it can also raise ConectionRefusedError
@@ -31,7 +116,7 @@ def test_connect2():
     print('[CONNECTED MESSAGE2] ' + request.sid)
 
 
-@sio.on('disconnect')
+@socket_event('disconnect')
 def disconnect():
     """
     Disconnect event when client run socket.disconnect();
@@ -40,31 +125,52 @@ def disconnect():
     """
     session_id = request.sid
     print('[DISCONNECTED] ', session_id)
-    for key, value in online_users.items():
-        if value == session_id:
-            online_users.pop(key, 'No Key found')
-            break
+    user_id = remove_session(session_id)
+    if user_id is not None:
+        presence.user_offline(user_id)
 
 
-@sio.on('auth')
+@socket_event('auth')
 def auth(token):
     """
     A user when connect to this socket will have a session ID of the connection which can be obtained from request.sid
-    this function will store all users in a dictionary with username and the session ID of the connection
+    this function will store all users in a dictionary with username and the session ID of the connection.
+    Sockets already logged in by the token of the handshake (SOCKET_AUTH_ON_CONNECT) can skip it
     Args:
         token:
 
     Returns:
 
     """
-    decoded_token = decode_token(token)
-    user_id = decoded_token["identity"] if "identity" in decoded_token else "NONE"
-    online_users[request.sid] = user_id
+    user_id, reason = socket_auth.authenticate(token)
+    if user_id is None:
+        disconnect_socket()
+        return
+    if online_users.get(request.sid) == user_id:
+        return  # already logged in by the handshake
     print(user_id + ' Login')
-    send(user_id, broadcast=True)
+    login_session(user_id, request.sid)
+    send_login_state(user_id, request.sid)
+
 
+@socket_event('ack_private_msg')
+def ack_private_msg(data):
+    """
+    The client received the messages of new_private_msg_batch, remove them from its pending deliveries
+    Args:
+        data: {"message_ids": [...]}
+
+    Returns:
 
-@sio.on('message')
+    """
+    user_id = online_users.get(request.sid)
+    message_ids = data.get('message_ids') if isinstance(data, dict) else None
+    if user_id is None or not message_ids:
+        return
+    PendingDelivery.ack(user_id, message_ids)
+
+
+@socket_event('message')
 def handle_message(msg):
     """
     broadcast=True When a message is sent with the broadcast option enabled, all clients connected
@@ -76,10 +182,10 @@ def handle_message(msg):
     Returns:
 
     """
-    send(msg, broadcast=True)
+    broadcaster.emit('message', msg)
 
 
-@sio.on('private_chat')
+@socket_event('private_chat')
 def private_chat(data):
     """
     A session ID of the connection is a room contain this user, this function will get session id of the receiver user
@@ -94,28 +200,35 @@ def private_chat(data):
     receiver_id = data["receiver_id"]
     message = data['message']
 
-    check_receiver = User.get_by_id(receiver_id)
+    with tracer.span('chat.check_receiver', receiver_id=receiver_id):
+        check_receiver = User.get_by_id(receiver_id)
     if check_receiver is None:
         logger.error("Not found receiver")
         return
 
     created_date = get_timestamp_now()
-    _id = str(uuid.uuid1())
+    _id = new_id()
     current_user_id = online_users[request.sid]
     group_id = generate_id(current_user_id, receiver_id)
-    new_values = Message(id=_id, message=message, sender_id=current_user_id, group_id=group_id,
-                         created_date=created_date)
-    db.session.add(new_values)
-    db.session.commit()
+    receivers_session_id = get_user_sessions(receiver_id)
+    with tracer.span('chat.store_message', group_id=group_id):
+        new_values = Message(id=_id, message=message, sender_id=current_user_id, group_id=group_id,
+                             created_date=created_date)
+        db.session.add(new_values)
+        if not receivers_session_id:
+            db.session.add(PendingDelivery(user_id=receiver_id, message_id=_id, group_id=group_id,
+                                           created_date=created_date))
+        Change.record([current_user_id, receiver_id], Change.PRIVATE, Change.NEW, _id, group_id)
+        db.session.commit()
 
-    receivers_session_id = [key for key, value in online_users.items() if value == receiver_id]
-    data = new_values.to_json()
+    with tracer.span('chat.deliver', receiver_id=receiver_id):
+        data = new_values.to_json()
 
-    for i in receivers_session_id:
-        sio.emit('new_private_msg', data, room=i)
+        for i in receivers_session_id:
+            tracer.emit('new_private_msg', data, room=i)
 
 
-@sio.on('chat_group')
+@socket_event('chat_group')
 def chat_group(data):
     """
     room=room all clients join this room will receive it
@@ -128,10 +241,32 @@ def chat_group(data):
     room = data['room']
     sender = data['username']
     message = sender + ': ' + data['message']
-    emit('new_group_msg', message, room=room)
+    broadcaster.emit('new_group_msg', message, room=room)
+
+
+@socket_event('group_cipher_chat')
+def group_cipher_chat(data):
+    """
+    Message of an end-to-end encrypted group, one ciphertext per member encrypted with the pub_key of the member,
+    every receiver gets its copy on new_group_cipher
+    Args:
+        data: {"group_id", "messages": [{"receiver_id", "message"}, ...]}
+
+    Returns:
+        ack {"messages": the stored copies, "missing": members without a copy}
+
+    """
+    current_user_id = online_users.get(request.sid)
+    if current_user_id is None:
+        return
+    try:
+        validate(instance=data, schema=group_messages_validator)
+        return send_group_copies(current_user_id, data['group_id'], data['messages'])
+    except (ValidationError, KeyError, ValueError) as ex:
+        logger.error("Group message error: " + str(ex))
 
 
-@sio.on('join')
+@socket_event('join')
 def on_join(data):
     """
     Joining a room in default namespace
@@ -144,10 +279,10 @@ def on_join(data):
     username = data['username']
     room = data['room']
     join_room(room)
-    emit('msg_room', username + ' has entered the room.' + room.upper(), room=room)
+    broadcaster.emit('msg_room', username + ' has entered the room.' + room.upper(), room=room)
 
 
-@sio.on('leave')
+@socket_event('leave')
 def on_leave(data):
     """
     Leaving a room in default namespace
@@ -160,10 +295,10 @@ def on_leave(data):
     username = data['username']
     room = data['room']
     leave_room(room)
-    emit('msg_room', username + ' has left the room ' + room.upper(), room=room)
+    broadcaster.emit('msg_room', username + ' has left the room ' + room.upper(), room=room)
 
 
-@sio.on('join2', namespace='/message2')
+@socket_event('join2', namespace='/message2')
 def on_join(data):
     """
     Default namespace is '/', connect io.connect('http://127.0.0.1:5000')
@@ -177,9 +312,9 @@ def on_join(data):
     username = data['username']
     room = data['room']
     join_room(room)
-    emit('msg_room', username + ' has entered the room.' + room.upper(), room=room, namespace='/message2')
+    broadcaster.emit('msg_room', username + ' has entered the room.' + room.upper(), room=room, namespace='/message2')
 
 
-@sio.on('message', namespace='/message2')
+@socket_event('message', namespace='/message2')
 def on_message2(msg):
-    send(msg, room='AI', namespace='/message2')
+    broadcaster.emit('message', msg, room='AI', namespace='/message2')
@@ -0,0 +1,286 @@
+import json
+import logging
+import os
+import random
+import threading
+from contextlib import contextmanager
+from logging.handlers import RotatingFileHandler
+from time import time_ns
+
+from flask import g, has_app_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from app.decorators import socket_event_hooks
+from app.extensions import sio
+from app.query_profiler import normalize_sql
+
+SPAN_KIND_INTERNAL = 1
+SPAN_KIND_SERVER = 2
+SPAN_KIND_CLIENT = 3
+SPAN_KIND_PRODUCER = 4
+STATUS_ERROR = 2
+
+
+class Span(object):
+    """
+    One timed operation of a trace
+    """
+    __slots__ = ('name', 'trace_id', 'span_id', 'parent_id', 'kind', 'start', 'end', 'attributes', 'error')
+
+    def __init__(self, name, trace_id, parent_id=None, kind=SPAN_KIND_INTERNAL, attributes=None):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.kind = kind
+        self.start = time_ns()
+        self.end = None
+        self.attributes = attributes or {}
+        self.error = None
+
+    def to_otlp(self):
+        span = {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": self.kind,
+            "startTimeUnixNano": str(self.start),
+            "endTimeUnixNano": str(self.end),
+            "attributes": [_otlp_attribute(key, value) for key, value in self.attributes.items()]
+        }
+        if self.parent_id:
+            span["parentSpanId"] = self.parent_id
+        if self.error:
+            span["status"] = {"code": STATUS_ERROR, "message": self.error}
+        return span
+
+
+class FileExporter(object):
+    """
+    Append the finished traces to a file, one OTLP/JSON ExportTraceServiceRequest per line,
+    the file can be replayed to any OTLP/HTTP collector with Content-Type: application/json.
+    It is rotated like the log files: at max_bytes it is renamed to .1, .2, ... and the oldest of the
+    backup_count backups is dropped
+    """
+
+    def __init__(self, path, service_name, max_bytes=10000000, backup_count=10):
+        self.path = path
+        self.resource = {"attributes": [_otlp_attribute("service.name", service_name)]}
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._handler = RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backup_count, delay=True)
+
+    def export(self, spans):
+        line = json.dumps({"resourceSpans": [{
+            "resource": self.resource,
+            "scopeSpans": [{"scope": {"name": "app.tracing"}, "spans": [span.to_otlp() for span in spans]}]
+        }]})
+        self._handler.handle(logging.makeLogRecord({'msg': line}))
+
+
+class Tracer(object):
+    """
+    Trace spans of every request and socket event, with child spans for the db statements and the
+    sio.emit fan-out. The trace id is taken from the W3C traceparent header when the client sends one,
+    returned in the X-Trace-Id response header and put in the metadata of the emitted payloads.
+    """
+
+    def __init__(self):
+        self.sample_rate = 1.0
+        self.exporter = None
+
+    def init_app(self, app):
+        """
+        Init the tracer, do nothing if TRACING_ENABLED is False
+        :param app:
+        :return:
+        """
+        if not app.config.get('TRACING_ENABLED', False):
+            return
+        self.sample_rate = app.config.get('TRACING_SAMPLE_RATE', 1.0)
+        self.exporter = FileExporter(app.config.get('TRACING_EXPORT_PATH', 'logs/traces.jsonl'),
+                                     app.config.get('TRACING_SERVICE_NAME', 'secure-chat'),
+                                     app.config.get('TRACING_EXPORT_MAX_BYTES', 10000000),
+                                     app.config.get('TRACING_EXPORT_BACKUP_COUNT', 10))
+
+        if not event.contains(Engine, 'before_cursor_execute', self._before_cursor_execute):
+            event.listen(Engine, 'before_cursor_execute', self._before_cursor_execute)
+            event.listen(Engine, 'after_cursor_execute', self._after_cursor_execute)
+            event.listen(Engine, 'handle_error', self._handle_error)
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+        app.teardown_request(self._teardown_request)
+        if self.track_event not in socket_event_hooks:
+            socket_event_hooks.append(self.track_event)
+
+    @property
+    def current_span(self):
+        if not has_app_context():
+            return None
+        spans = g.get('trace_spans')
+        return spans[-1] if spans else None
+
+    def start_trace(self, name, kind, attributes=None, traceparent=None):
+        """
+        Start the root span of the current request or socket event
+        Args:
+            name: span name
+            kind: SPAN_KIND_SERVER for requests and socket events
+            attributes: dict of span attributes
+            traceparent: W3C traceparent of the caller, 00-<trace id>-<parent span id>-<flags>
+
+        Returns:
+            the root span, None if the trace is not sampled
+        """
+        trace_id, parent_id, sampled = None, None, None
+        if traceparent:
+            parts = traceparent.split('-')
+            if len(parts) == 4 and len(parts[1]) == 32 and len(parts[2]) == 16 and len(parts[3]) == 2:
+                try:
+                    # only the sampled bit of the trace flags matters, the other bits may be set too
+                    sampled = bool(int(parts[3], 16) & 1)
+                    trace_id, parent_id = parts[1], parts[2]
+                except ValueError:
+                    pass
+        if sampled is None:
+            sampled = random.random() < self.sample_rate
+        if not sampled:
+            return None
+
+        span = Span(name, trace_id or os.urandom(16).hex(), parent_id, kind, attributes)
+        g.trace_spans = [span]
+        g.trace_finished = []
+        return span
+
+    def end_trace(self, error=None):
+        """
+        End the root span and export the trace
+        """
+        spans = g.pop('trace_spans', None)
+        finished = g.pop('trace_finished', None)
+        if not spans:
+            return
+        for span in reversed(spans):
+            span.error = span.error or error
+            span.end = time_ns()
+            finished.append(span)
+        self.exporter.export(finished)
+
+    def start_span(self, name, kind=SPAN_KIND_INTERNAL, attributes=None):
+        parent = self.current_span
+        if parent is None:
+            return None
+        span = Span(name, parent.trace_id, parent.span_id, kind, attributes)
+        g.trace_spans.append(span)
+        return span
+
+    @staticmethod
+    def end_span(span, error=None):
+        if span is None:
+            return
+        span.end = time_ns()
+        span.error = error
+        spans = g.get('trace_spans')
+        if spans and span in spans:
+            spans.remove(span)
+            g.trace_finished.append(span)
+
+    @contextmanager
+    def span(self, name, **attributes):
+        """
+        Child span of the current span, does nothing when the request is not traced
+        Args:
+            name: span name
+            attributes: span attributes
+
+        Examples::
+
+            with tracer.span('chat.store_message', group_id=group_id):
+                db.session.commit()
+        """
+        span = self.start_span(name, attributes=attributes)
+        try:
+            yield span
+        except Exception as ex:
+            self.end_span(span, error=str(ex))
+            raise
+        else:
+            self.end_span(span)
+
+    def emit(self, event_name, data, room=None, **kwargs):
+        """
+        sio.emit inside a producer span, dict payloads carry the trace context in "_trace"
+        Args:
+            event_name: socket event
+            data: payload
+            room: session id or room
+            kwargs: other arguments of sio.emit
+        """
+        span = self.start_span('sio.emit ' + event_name, SPAN_KIND_PRODUCER,
+                               {'messaging.destination': str(room), 'messaging.system': 'socketio'})
+        if span is not None and isinstance(data, dict):
+            data = dict(data, _trace={'trace_id': span.trace_id, 'span_id': span.span_id})
+        try:
+            sio.emit(event_name, data, room=room, **kwargs)
+        except Exception as ex:
+            self.end_span(span, error=str(ex))
+            raise
+        self.end_span(span)
+
+    def _before_request(self):
+        self.start_trace('{} {}'.format(request.method, request.endpoint or 'unmatched'), SPAN_KIND_SERVER,
+                         {'http.method': request.method, 'http.target': request.full_path},
+                         request.headers.get('traceparent'))
+
+    def _after_request(self, response):
+        span = g.get('trace_spans', [None])[0]
+        if span is not None:
+            span.attributes['http.status_code'] = response.status_code
+            response.headers['X-Trace-Id'] = span.trace_id
+        return response
+
+    def _teardown_request(self, exc):
+        self.end_trace(error=str(exc) if exc else None)
+
+    @contextmanager
+    def track_event(self, event_name, namespace):
+        """
+        Hook of the socket_event decorator, trace one socket event
+        Args:
+            event_name:
+            namespace:
+        """
+        self.start_trace('socket ' + event_name, SPAN_KIND_SERVER,
+                         {'socketio.event': event_name, 'socketio.namespace': namespace})
+        try:
+            yield
+        except Exception as ex:
+            self.end_trace(error=str(ex))
+            raise
+        else:
+            self.end_trace()
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if context is not None:
+            context.trace_span = self.start_span('db.query', SPAN_KIND_CLIENT, {
+                'db.system': conn.dialect.name,
+                'db.statement': normalize_sql(statement)
+            })
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        self.end_span(getattr(context, 'trace_span', None))
+
+    def _handle_error(self, exception_context):
+        context = exception_context.execution_context
+        self.end_span(getattr(context, 'trace_span', None), error=str(exception_context.original_exception))
+
+
+def _otlp_attribute(key, value):
+    if isinstance(value, bool):
+        return {"key": key, "value": {"boolValue": value}}
+    if isinstance(value, int):
+        return {"key": key, "value": {"intValue": str(value)}}
+    return {"key": key, "value": {"stringValue": str(value)}}
+
+
+tracer = Tracer()
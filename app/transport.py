@@ -0,0 +1,107 @@
+from types import SimpleNamespace
+from urllib.parse import parse_qs
+
+from app.extensions import sio
+from app.metrics import metrics
+
+POLLING = 'polling'
+WEBSOCKET = 'websocket'
+
+
+def server_options(config):
+    """
+    Engine.IO options of sio.init_app from the SOCKETIO_* config
+    Args:
+        config: app config
+
+    Returns:
+        dict of keyword arguments
+    """
+    transports = config.get('SOCKETIO_TRANSPORTS', [POLLING, WEBSOCKET])
+    return {
+        'ping_interval': config.get('SOCKETIO_PING_INTERVAL', 25),
+        'ping_timeout': config.get('SOCKETIO_PING_TIMEOUT', 60),
+        'allow_upgrades': WEBSOCKET in transports and config.get('SOCKETIO_ALLOW_UPGRADES', True),
+        'http_compression': config.get('SOCKETIO_HTTP_COMPRESSION', True),
+        'compression_threshold': config.get('SOCKETIO_COMPRESSION_THRESHOLD', 1024),
+    }
+
+
+def _with_compression(websocket_class, compression):
+    """
+    WebSocket handler class negotiating the permessage-deflate extension offered by the client only if compression
+    """
+
+    class WebSocketWSGI(websocket_class):
+        def _negotiate_permessage_deflate(self, extensions):
+            if not compression:
+                return None
+            return super(WebSocketWSGI, self)._negotiate_permessage_deflate(extensions)
+
+    return WebSocketWSGI
+
+
+class TransportPolicy(object):
+    """
+    Transports of the Socket.IO connections. SOCKETIO_TRANSPORTS = ['websocket'] rejects the long-polling handshakes
+    (HTTP 400), the clients connect with transports: ['websocket'] and every message is a frame of an open socket
+    instead of an HTTP request. With polling allowed, the clients upgrade to WebSocket after the handshake.
+    The polling payloads above SOCKETIO_COMPRESSION_THRESHOLD bytes are gzip/deflate compressed, the WebSocket frames
+    use permessage-deflate when the client offers it and SOCKETIO_WEBSOCKET_COMPRESSION is set.
+    """
+
+    def __init__(self):
+        self.app = None
+        self.transports = [POLLING, WEBSOCKET]
+        self._handle_request = None
+
+    def init_app(self, app):
+        """
+        Apply the transport policy to the Engine.IO server created by sio.init_app(app, **server_options(config))
+        :param app:
+        :return:
+        """
+        self.app = app
+        self.transports = app.config.get('SOCKETIO_TRANSPORTS', [POLLING, WEBSOCKET])
+        if not self.transports or set(self.transports) - {POLLING, WEBSOCKET}:
+            raise ValueError('SOCKETIO_TRANSPORTS must be a list of polling and websocket')
+        eio = sio.server.eio
+        self._handle_request = None
+        if POLLING not in self.transports:
+            self._handle_request = eio.handle_request
+            eio.handle_request = self.handle_request
+        self._websocket_compression(eio, app.config.get('SOCKETIO_WEBSOCKET_COMPRESSION', True))
+
+        metrics.describe('socketio_connections', 'gauge', 'Open Engine.IO connections, by transport')
+        metrics.describe('socketio_transport_rejects_total', 'counter', 'Handshakes on a disabled transport')
+        metrics.add_collector(self.collect)
+
+    @staticmethod
+    def _websocket_compression(eio, enabled):
+        websocket_module = eio._async.get('websocket') if eio._async else None
+        websocket_class = getattr(websocket_module, eio._async.get('websocket_class') or '', None) \
+            if websocket_module is not None else None
+        if websocket_class is None:
+            return
+        websocket = SimpleNamespace(WebSocketWSGI=_with_compression(websocket_class, enabled))
+        eio._async = dict(eio._async, websocket=websocket, websocket_class='WebSocketWSGI')
+
+    def handle_request(self, environ, start_response):
+        """
+        Replacement of the Engine.IO request handler when polling is disabled
+        """
+        query = parse_qs(environ.get('QUERY_STRING', ''))
+        if query.get('transport', [POLLING])[0] == POLLING and 'sid' not in query:
+            metrics.inc('socketio_transport_rejects_total', (('transport', POLLING),))
+            start_response('400 BAD REQUEST', [('Content-Type', 'text/plain')])
+            return [b'Transport polling is disabled, connect with transports: ["websocket"]']
+        return self._handle_request(environ, start_response)
+
+    def collect(self):
+        counts = {POLLING: 0, WEBSOCKET: 0}
+        for socket in list(sio.server.eio.sockets.values()):
+            counts[WEBSOCKET if socket.upgraded else POLLING] += 1
+        return [('socketio_connections', (('transport', transport),), count) for transport, count in counts.items()]
+
+
+transport_policy = TransportPolicy()
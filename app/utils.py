@@ -1,6 +1,9 @@
+import json
+import zlib
+from functools import lru_cache
 from time import time
 
-from flask import jsonify
+from flask import jsonify, Response, stream_with_context
 from app.enums import ALLOWED_EXTENSIONS_IMG
 from .extensions import parser
 import datetime
@@ -65,6 +68,64 @@ def send_error(data=None, message="Error", code=200, version=1, status=False):
     return jsonify(res_error), code
 
 
+def send_ndjson(rows, to_json, compress=False, chunk_size=500):
+    """
+    Stream rows as NDJSON, one json object per line, with a constant memory whatever the number of rows.
+    Every object has a "cursor" key, send it back as the after parameter to resume the export.
+    Args:
+        rows: iterator of rows with created_date and id, e.g. Message.stream_messages
+        to_json: function converting a list of rows to a list of dict, e.g. Message.many_to_json
+        compress: gzip the stream on the fly
+        chunk_size: rows per written chunk
+
+    Returns:
+        streamed response
+    """
+
+    def generate():
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None
+        chunk = []
+        for row in rows:
+            chunk.append(row)
+            if len(chunk) < chunk_size:
+                continue
+            data = _ndjson_lines(chunk, to_json)
+            chunk = []
+            yield compressor.compress(data) if compressor else data
+        if chunk:
+            data = _ndjson_lines(chunk, to_json)
+            yield compressor.compress(data) if compressor else data
+        if compressor:
+            yield compressor.flush()
+
+    headers = {'Content-Encoding': 'gzip'} if compress else {}
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson', headers=headers)
+
+
+def _ndjson_lines(rows, to_json):
+    lines = []
+    for row, item in zip(rows, to_json(rows)):
+        item["cursor"] = '{}:{}'.format(row.created_date, row.id)
+        lines.append(json.dumps(item))
+    return ('\n'.join(lines) + '\n').encode('utf-8')
+
+
+def parse_cursor(cursor):
+    """
+    Parse the cursor of send_ndjson
+    Args:
+        cursor: "<created_date>:<id>"
+
+    Returns:
+        (created_date, id), None if the cursor is empty or invalid
+    """
+    try:
+        created_date, _id = cursor.split(':', 1)
+        return int(created_date), _id
+    except (AttributeError, ValueError):
+        return None
+
+
 def get_version(version):
     """
     if version = 1, return api v1
@@ -182,10 +243,45 @@ mapping_char_to_number = {**{chr(i): i - 48 for i in range(48, 58)},
 mapping_number_to_char = {**{i: chr(i + 48) for i in range(0, 10)},
                           **{i: chr(i + 87) for i in range(10, 36)}}
 
+# an id is packed in an int, one byte per digit (0-35): the 32 digits of two ids are added by one int addition,
+# a byte holds at most 70 so nothing carries into the next digit
+_DIGITS = bytes(mapping_char_to_number.get(chr(i), 255) for i in range(256))
+_CHARS = bytes(ord(mapping_number_to_char.get(i, '?')) for i in range(256))
+_ONES = int.from_bytes(b'\x01' * 32, 'big')
+_PLUS_92 = 92 * _ONES  # a byte of the sum + 92 has its high bit set when the digit sum is >= 36
+_HIGH_BITS = 0x80 * _ONES
+
+
+@lru_cache(maxsize=100000)
+def _id_digits(_id):
+    """
+    Digits of the 32 characters of an id around the dashes 8-4-4-4-12, packed in an int
+    """
+    chars = _id[0:8] + _id[9:13] + _id[14:18] + _id[19:23] + _id[24:36]
+    digits = chars.encode('latin-1', 'replace').translate(_DIGITS)
+    if len(digits) != 32:
+        raise IndexError('string index out of range')
+    if 255 in digits:
+        raise KeyError(chars[digits.index(255)])
+    return int.from_bytes(digits, 'big')
+
+
+def _add_digits(digits1, digits2):
+    total = digits1 + digits2
+    total -= (((total + _PLUS_92) & _HIGH_BITS) >> 7) * 36  # (a + b) % 36 on every byte
+    chars = total.to_bytes(32, 'big').translate(_CHARS).decode()
+    return '-'.join((chars[0:8], chars[8:12], chars[12:16], chars[16:20], chars[20:32]))
+
+
+@lru_cache(maxsize=100000)
+def _pair_id(id1, id2):
+    return _add_digits(_id_digits(id1), _id_digits(id2))
+
 
 def generate_id(id1, id2):
     """
-    Generate id from two id
+    Generate id from two id: digit by digit (0-9a-z) sum modulo 36, the dashes of a uuid kept.
+    The id of a pair does not depend on its order, the most recent pairs are cached
     Args:
         id1:
         id2:
@@ -193,16 +289,18 @@ def generate_id(id1, id2):
     Returns:
 
     """
-    u11 = id1
-    u22 = id2
-    arr = [8, 4, 4, 4, 12]
-    new_id = ""
-    index = 0
-    for item in arr:
-        for i in range(item):
-            new_id += mapping_number_to_char[
-                (mapping_char_to_number[u11[index]] + mapping_char_to_number[u22[index]]) % 36]
-            index += 1
-        index += 1
-        new_id += '-'
-    return new_id[:-1]
+    return _pair_id(id1, id2) if id1 <= id2 else _pair_id(id2, id1)
+
+
+def conversation_ids(user_id, partners_id):
+    """
+    Conversation ids of one user with many partners, the digits of the user are read once
+    Args:
+        user_id:
+        partners_id: list of user id
+
+    Returns:
+        list of conversation id, in the order of partners_id
+    """
+    user_digits = _id_digits(user_id)
+    return [_add_digits(user_digits, _id_digits(partner_id)) for partner_id in partners_id]
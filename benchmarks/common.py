@@ -0,0 +1,192 @@
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import uuid
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from flask_jwt_extended import create_access_token
+from sqlalchemy import event
+from werkzeug.security import generate_password_hash
+
+from app.app import create_app
+from app.extensions import db
+from app.models import User, Friend, Message, Group, GroupUser, Token
+from app.settings import DevConfig
+from app.utils import generate_id, get_timestamp_now
+
+BENCH_PASSWORD = 'bench-password'
+
+
+class BenchConfig(DevConfig):
+    """Benchmark configuration: a local SQLite file stands in for MySQL, the profilers are off."""
+    ENV = 'bench'
+    DEBUG = False
+    SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(os.environ.get('BENCH_DIR', '/tmp'), 'secure_chat_bench.db')
+    SQLALCHEMY_ENGINE_OPTIONS = {'connect_args': {'timeout': 30, 'check_same_thread': False}}
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
+    SQL_PROFILER_ENABLED = False
+    PROFILER_TOKEN = None
+    PROFILER_SAMPLE_RATE = 0
+    TRACING_ENABLED = False
+    SOCKET_AUTH_ON_CONNECT = True  # the swarm and transport clients send the token in the handshake
+
+
+def _set_sqlite_pragma(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.close()
+
+
+def tune_sqlite(engine):
+    """
+    WAL journal on the SQLite stand-ins, like the InnoDB redo log readers do not block the writer
+    """
+    if engine.dialect.name == 'sqlite' and not event.contains(engine, 'connect', _set_sqlite_pragma):
+        event.listen(engine, 'connect', _set_sqlite_pragma)
+
+
+def create_bench_app(config_object=BenchConfig):
+    """
+    Create the app on the benchmark database, tables are dropped and created again
+    """
+    app = create_app(config_object)
+    with app.app_context():
+        tune_sqlite(db.get_engine(app))
+        db.drop_all()
+        db.create_all()
+    return app
+
+
+def seed(app, users=200, friends_per_user=10, messages_per_conversation=50, groups=20, members_per_group=5,
+         seed_value=42):
+    """
+    Insert a deterministic dataset, every user has friends_per_user conversations of messages_per_conversation
+    messages and is member of some groups
+    Returns:
+        dict with the ids of the users, friend pairs and groups
+    """
+    rng = random.Random(seed_value)
+    now = get_timestamp_now()
+    password_hash = generate_password_hash(BENCH_PASSWORD)
+
+    def new_id():
+        return str(uuid.UUID(int=rng.getrandbits(128), version=1))
+
+    user_ids = [new_id() for _ in range(users)]
+    user_rows = [dict(id=_id, username='user{}'.format(i), password_hash=password_hash, pub_key='bench-key',
+                      display_name='User {}'.format(i), is_active=True, created_date=now, modified_date=now,
+                      modified_date_password=now, test_message='test message')
+                 for i, _id in enumerate(user_ids)]
+
+    pairs = set()
+    for user_id in user_ids:
+        for partner_id in rng.sample(user_ids, min(friends_per_user, users - 1)):
+            if partner_id != user_id and (partner_id, user_id) not in pairs:
+                pairs.add((user_id, partner_id))
+    pairs = sorted(pairs)
+    friend_rows = [dict(id=generate_id(a, b), user_id_1=a, user_id_2=b) for a, b in pairs]
+
+    message_rows = []
+    for a, b in pairs:
+        group_id = generate_id(a, b)
+        for i in range(messages_per_conversation):
+            message_rows.append(dict(id=new_id(), message='ciphertext ' * rng.randint(1, 20),
+                                     sender_id=a if rng.random() < 0.5 else b, group_id=group_id,
+                                     created_date=now - messages_per_conversation + i, seen=True))
+
+    group_ids = [new_id() for _ in range(groups)]
+    group_rows = [dict(id=_id, group_name='Group {}'.format(i), created_date=now, modified_date=now)
+                  for i, _id in enumerate(group_ids)]
+    group_user_rows = [dict(user_id=user_id, group_id=group_id) for group_id in group_ids
+                       for user_id in rng.sample(user_ids, min(members_per_group, users))]
+
+    with app.app_context():
+        for model, rows in ((User, user_rows), (Friend, friend_rows), (Message, message_rows),
+                            (Group, group_rows), (GroupUser, group_user_rows)):
+            db.session.bulk_insert_mappings(model, rows)
+        db.session.commit()
+
+    return {'users': user_ids, 'pairs': pairs, 'groups': group_ids}
+
+
+def create_tokens(app, user_ids):
+    """
+    Create and store an access token for every user without going through the login api
+    Returns:
+        dict user id -> access token
+    """
+    tokens = {}
+    with app.app_context():
+        for user_id in user_ids:
+            tokens[user_id] = create_access_token(identity=user_id)
+            Token.add_token_to_database(tokens[user_id], user_id)
+    return tokens
+
+
+def percentiles(samples, points=(50, 90, 95, 99)):
+    """
+    Nearest-rank percentiles of a list of latencies, in milliseconds
+    """
+    if not samples:
+        return {}
+    ordered = sorted(samples)
+    result = {'p{}'.format(p): round(ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))] * 1000, 3)
+              for p in points}
+    result['mean'] = round(sum(ordered) / len(ordered) * 1000, 3)
+    result['max'] = round(ordered[-1] * 1000, 3)
+    return result
+
+
+def metadata(**extra):
+    """
+    Environment of a benchmark run, stored with the results so runs of different commits can be compared
+    """
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+                                         cwd=os.path.dirname(os.path.realpath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    meta = {'commit': commit, 'python': platform.python_version(), 'machine': platform.machine(),
+            'cpus': os.cpu_count()}
+    meta.update(extra)
+    return meta
+
+
+def write_report(report, output=None):
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if output:
+        with open(output, 'w') as file:
+            file.write(text + '\n')
+    print(text)
+
+
+def compare(results, baseline, threshold, higher_is_better=('throughput',), lower_is_better=('p50', 'p99')):
+    """
+    Compare the results of two runs
+    Args:
+        results: dict name -> dict of measures
+        baseline: results of the reference run
+        threshold: allowed relative regression, 0.2 = 20%
+        higher_is_better: measures where a decrease is a regression
+        lower_is_better: measures where an increase is a regression
+
+    Returns:
+        list of regressions (name, measure, baseline value, new value)
+    """
+    regressions = []
+    for name, measures in results.items():
+        reference = baseline.get(name)
+        if not reference:
+            continue
+        for key in higher_is_better:
+            if key in measures and reference.get(key) and measures[key] < reference[key] * (1 - threshold):
+                regressions.append((name, key, reference[key], measures[key]))
+        for key in lower_is_better:
+            if key in measures and reference.get(key) and measures[key] > reference[key] * (1 + threshold):
+                regressions.append((name, key, reference[key], measures[key]))
+    return regressions
@@ -0,0 +1,144 @@
+"""
+Index size, insert and lookup throughput of the message ids: VARCHAR(50) uuid1 strings against BINARY(16)
+time-ordered ids (app.ids)
+
+Each layout is a copy of the messages table with its index_get secondary index. On SQLite the tables are
+WITHOUT ROWID, clustered on the primary key like InnoDB, so every secondary index entry carries the id:
+
+    python benchmarks/id_bench.py --rows 200000 --lookups 20000 --output ids.json
+    python benchmarks/id_bench.py --compare ids.json --threshold 0.2
+
+--uri runs on another database, e.g. MySQL, the sizes are then read from information_schema.
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import uuid
+from time import perf_counter
+
+from sqlalchemy import create_engine, MetaData, Table, Column, String, Text, Integer, Boolean, Index, select, text, \
+    bindparam
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from app.ids import BinaryId, new_id
+from benchmarks.common import metadata as run_metadata, write_report, compare
+
+LAYOUTS = {
+    'string': (lambda: String(50), lambda: str(uuid.uuid1())),
+    'binary': (lambda: BinaryId, new_id),
+}
+
+
+def make_table(metadata, layout):
+    id_type, _ = LAYOUTS[layout]
+    name = 'messages_' + layout
+    return Table(name, metadata,
+                 Column('id', id_type(), primary_key=True),
+                 Column('message', Text),
+                 Column('sender_id', String(50)),
+                 Column('group_id', String(50), nullable=False),
+                 Column('created_date', Integer),
+                 Column('seen', Boolean),
+                 Index('index_get_' + layout, 'group_id', 'created_date'),
+                 sqlite_with_rowid=False, mysql_engine='InnoDB')
+
+
+def sizes(engine, table):
+    """
+    Bytes of the table (clustered on the primary key) and of its secondary index
+    """
+    with engine.connect() as connection:
+        if engine.dialect.name == 'sqlite':
+            pages = dict(connection.execute(text('SELECT name, SUM(pgsize) FROM dbstat GROUP BY name')).fetchall())
+            return {'table_bytes': pages.get(table.name, 0),
+                    'index_bytes': pages.get('index_get_' + table.name.split('_', 1)[1], 0)}
+        if engine.dialect.name == 'mysql':
+            connection.execute(text('ANALYZE TABLE `{}`'.format(table.name)))
+            row = connection.execute(text('SELECT DATA_LENGTH, INDEX_LENGTH FROM information_schema.TABLES '
+                                          'WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = :name'),
+                                     name=table.name).first()
+            return {'table_bytes': int(row[0]), 'index_bytes': int(row[1])}
+    return {}
+
+
+def run(engine, layout, rows, lookups, batch_size, conversations, seed_value):
+    metadata = MetaData()
+    table = make_table(metadata, layout)
+    metadata.drop_all(engine)
+    metadata.create_all(engine)
+    _, generate = LAYOUTS[layout]
+    rng = random.Random(seed_value)
+    groups_id = [str(uuid.UUID(int=rng.getrandbits(128))) for _ in range(conversations)]
+    sender_id = str(uuid.UUID(int=rng.getrandbits(128)))
+
+    ids = []
+    start = perf_counter()
+    for offset in range(0, rows, batch_size):
+        batch = [dict(id=generate(), message='ciphertext', sender_id=sender_id, group_id=rng.choice(groups_id),
+                      created_date=1600000000 + offset + i, seen=False)
+                 for i in range(min(batch_size, rows - offset))]
+        with engine.begin() as connection:
+            connection.execute(table.insert(), batch)
+        ids.extend(row['id'] for row in batch)
+    insert_elapsed = perf_counter() - start
+
+    query = select([table]).where(table.c.id == bindparam('id'))
+    sample = [rng.choice(ids) for _ in range(lookups)]
+    start = perf_counter()
+    with engine.connect() as connection:
+        for _id in sample:
+            if connection.execute(query, id=_id).first() is None:
+                raise RuntimeError('id {} not found'.format(_id))
+    lookup_elapsed = perf_counter() - start
+
+    result = {'rows': rows, 'insert_throughput': round(rows / insert_elapsed, 2),
+              'lookup_throughput': round(lookups / lookup_elapsed, 2)}
+    result.update(sizes(engine, table))
+    metadata.drop_all(engine)
+    return result
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    arg_parser.add_argument('--rows', type=int, default=200000)
+    arg_parser.add_argument('--lookups', type=int, default=20000)
+    arg_parser.add_argument('--batch-size', type=int, default=1000, help='rows per insert transaction')
+    arg_parser.add_argument('--conversations', type=int, default=1000)
+    arg_parser.add_argument('--seed', type=int, default=42)
+    arg_parser.add_argument('--uri', help='database uri, default a SQLite file in BENCH_DIR')
+    arg_parser.add_argument('--output')
+    arg_parser.add_argument('--compare')
+    arg_parser.add_argument('--threshold', type=float, default=0.2)
+    args = arg_parser.parse_args()
+
+    uri = args.uri or 'sqlite:///' + os.path.join(os.environ.get('BENCH_DIR', '/tmp'), 'secure_chat_ids.db')
+    engine = create_engine(uri)
+    results = {}
+    for layout in LAYOUTS:
+        results[layout] = run(engine, layout, args.rows, args.lookups, args.batch_size, args.conversations,
+                              args.seed)
+        print('{:<8} insert {:>10.1f} rows/s  lookup {:>10.1f} /s  table {:>12} B  index_get {:>12} B'.format(
+            layout, results[layout]['insert_throughput'], results[layout]['lookup_throughput'],
+            results[layout].get('table_bytes'), results[layout].get('index_bytes')), file=sys.stderr)
+
+    report = {'meta': run_metadata(benchmark='id_bench', rows=args.rows, lookups=args.lookups,
+                                   batch_size=args.batch_size, dialect=engine.dialect.name, seed=args.seed),
+              'results': results}
+    write_report(report, args.output)
+
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)['results']
+        regressions = compare(results, baseline, args.threshold,
+                              higher_is_better=('insert_throughput', 'lookup_throughput'),
+                              lower_is_better=('table_bytes', 'index_bytes'))
+        for name, key, before, after in regressions:
+            print('REGRESSION {} {}: {} -> {}'.format(name, key, before, after), file=sys.stderr)
+        sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
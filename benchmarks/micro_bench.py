@@ -0,0 +1,135 @@
+"""
+Micro-benchmarks of the helpers running on every request or message
+
+    python benchmarks/micro_bench.py --save               # store the baseline of this machine
+    python benchmarks/micro_bench.py --check              # fail if a helper is slower than the baseline
+    python benchmarks/micro_bench.py --check --threshold 0.1 --filter generate_id
+"""
+import argparse
+import json
+import os
+import sys
+import timeit
+import uuid
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from jsonschema import validate
+
+from app.app import create_app
+from app.models import User, Message, Group
+from app.schema.schema_validator import user_validator, password_validator
+from app.utils import generate_id, conversation_ids, send_result, parse_req, FieldString
+from benchmarks.common import BenchConfig, metadata, write_report, compare
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'baselines', 'micro.json')
+
+
+def build_cases(app):
+    """
+    Returns:
+        dict name -> function without argument running one operation
+    """
+    id1, id2 = str(uuid.uuid1()), str(uuid.uuid1())
+    partners_id = [str(uuid.uuid1()) for _ in range(100)]
+    user = User(id=id1, username='username', display_name='Display Name', gender=True, force_change_password=False,
+                created_date=1600000000, avatar_path='http://localhost/avatars/default_avatar.png', pub_key='k' * 400)
+    users = [user] * 100
+    message = Message(id=id2, message='c' * 256, sender_id=id1, group_id=generate_id(id1, id2),
+                      created_date=1600000000, seen=False)
+    messages = [message] * 100
+    group = Group(id=id2, group_name='Group Chat', created_date=1600000000, modified_date=1600000000)
+    groups = [group] * 100
+    user_json = {'password': 'password', 'display_name': 'Display Name', 'gender': 1}
+    password_json = {'current_password': 'password', 'new_password': 'new password'}
+    login_params = {'username': FieldString(), 'password': FieldString()}
+    page = Message.many_to_json(messages[:10])
+
+    def in_request(func, **kwargs):
+        context = app.test_request_context('/', method='POST', **kwargs)
+
+        def run():
+            with context:
+                return func()
+
+        return run
+
+    return {
+        'generate_id': lambda: generate_id(id1, id2),
+        'conversation_ids_100': lambda: conversation_ids(id1, partners_id),
+        'user_to_json': user.to_json,
+        'user_many_to_json_100': lambda: User.many_to_json(users),
+        'message_to_json': message.to_json,
+        'message_many_to_json_100': lambda: Message.many_to_json(messages),
+        'group_many_to_json_100': lambda: Group.many_to_json(groups),
+        'send_result_page': in_request(lambda: send_result(data=page)),
+        'parse_req_login': in_request(lambda: parse_req(login_params),
+                                      json={'username': 'username', 'password': 'password'}),
+        'validate_user': lambda: validate(instance=user_json, schema=user_validator),
+        'validate_password': lambda: validate(instance=password_json, schema=password_validator),
+    }
+
+
+def measure(func, repeat, min_time):
+    """
+    Best time of `repeat` runs, each run lasts at least min_time seconds
+    Returns:
+        nanoseconds per operation
+    """
+    timer = timeit.Timer(func)
+    number = 1
+    while timer.timeit(number) < min_time:
+        number *= 2
+    return round(min(timer.repeat(repeat=repeat, number=number)) / number * 1e9, 1)
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    arg_parser.add_argument('--filter', help='comma separated benchmarks')
+    arg_parser.add_argument('--repeat', type=int, default=5)
+    arg_parser.add_argument('--min-time', type=float, default=0.1, help='seconds of one run')
+    arg_parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+    arg_parser.add_argument('--save', action='store_true', help='store the results as the baseline')
+    arg_parser.add_argument('--check', action='store_true', help='exit 1 when a benchmark regresses')
+    arg_parser.add_argument('--threshold', type=float, default=0.2, help='allowed regression, 0.2 = 20%%')
+    arg_parser.add_argument('--output')
+    args = arg_parser.parse_args()
+    if args.check and not args.save and not os.path.exists(args.baseline):
+        sys.exit('no baseline at {}, run --save first'.format(args.baseline))
+
+    app = create_app(BenchConfig)
+    cases = build_cases(app)
+    names = args.filter.split(',') if args.filter else list(cases)
+
+    results = {}
+    for name in names:
+        results[name] = {'ns_per_op': measure(cases[name], args.repeat, args.min_time)}
+        print('{:<28} {:>12.1f} ns/op'.format(name, results[name]['ns_per_op']), file=sys.stderr)
+
+    report = {'meta': metadata(benchmark='micro', repeat=args.repeat, min_time=args.min_time), 'results': results}
+    write_report(report, args.output)
+
+    if args.save:
+        baseline = {'meta': report['meta'], 'results': {}}
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as file:
+                baseline = json.load(file)
+        baseline['meta'] = report['meta']
+        baseline['results'].update(results)
+        os.makedirs(os.path.dirname(args.baseline), exist_ok=True)
+        with open(args.baseline, 'w') as file:
+            json.dump(baseline, file, indent=2, sort_keys=True)
+            file.write('\n')
+
+    if args.check:
+        with open(args.baseline) as file:
+            baseline = json.load(file)['results']
+        regressions = compare(results, baseline, args.threshold, higher_is_better=(), lower_is_better=('ns_per_op',))
+        for name, key, before, after in regressions:
+            print('REGRESSION {}: {} -> {} ns/op (+{:.0%})'.format(name, before, after, after / before - 1),
+                  file=sys.stderr)
+        sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
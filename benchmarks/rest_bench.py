@@ -0,0 +1,149 @@
+"""
+REST load test on a local SQLite stand-in of the database
+
+    python benchmarks/rest_bench.py --concurrency 8 --requests 2000 --output bench.json
+    python benchmarks/rest_bench.py --compare bench.json --threshold 0.2
+"""
+import argparse
+import itertools
+import json
+import os
+import random
+import sys
+import threading
+from time import perf_counter
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from benchmarks.common import (BENCH_PASSWORD, create_bench_app, seed, create_tokens, percentiles, metadata,
+                               write_report, compare)
+
+
+def scenario_login(client, data, rng, tokens):
+    index = rng.randrange(len(data['users']))
+    return client.post('/api/v1/auth/login', json={'username': 'user{}'.format(index), 'password': BENCH_PASSWORD})
+
+
+def scenario_send(client, data, rng, tokens):
+    sender_id, receiver_id = rng.choice(data['pairs'])
+    return client.post('/api/v1/chats/' + receiver_id, json={'message': 'ciphertext ' * rng.randint(1, 20)},
+                       headers=tokens[sender_id])
+
+
+def scenario_history(client, data, rng, tokens):
+    user_id, partner_id = rng.choice(data['pairs'])
+    return client.get('/api/v1/chats/{}?page={}&page_size=10'.format(partner_id, rng.randint(1, 3)),
+                      headers=tokens[user_id])
+
+
+def scenario_chat_list(client, data, rng, tokens):
+    user_id = rng.choice(data['pairs'])[0]
+    return client.get('/api/v1/users/chats', headers=tokens[user_id])
+
+
+def scenario_friends(client, data, rng, tokens):
+    user_id = rng.choice(data['pairs'])[0]
+    return client.get('/api/v1/users/friends', headers=tokens[user_id])
+
+
+def scenario_group_list(client, data, rng, tokens):
+    return client.get('/api/v1/groups?page={}'.format(rng.randint(1, 2)), headers=tokens[data['users'][0]])
+
+
+def scenario_group_detail(client, data, rng, tokens):
+    return client.get('/api/v1/groups/' + rng.choice(data['groups']), headers=tokens[data['users'][0]])
+
+
+SCENARIOS = {
+    'login': scenario_login,
+    'send': scenario_send,
+    'history': scenario_history,
+    'chat_list': scenario_chat_list,
+    'friends': scenario_friends,
+    'group_list': scenario_group_list,
+    'group_detail': scenario_group_detail,
+}
+
+
+def run_scenario(app, scenario, data, tokens, concurrency, requests, seed_value):
+    """
+    Send `requests` requests of one scenario from `concurrency` threads
+    Returns:
+        dict of throughput (requests/s), latency percentiles (ms) and errors
+    """
+    counter = itertools.count()
+    latencies = []
+    errors = []
+
+    def worker(index):
+        client = app.test_client()
+        rng = random.Random(seed_value + index)
+        local_latencies = []
+        local_errors = 0
+        while next(counter) < requests:
+            start = perf_counter()
+            response = scenario(client, data, rng, tokens)
+            local_latencies.append(perf_counter() - start)
+            if response.status_code != 200 or not (response.get_json() or {}).get('status'):
+                local_errors += 1
+        latencies.extend(local_latencies)
+        errors.append(local_errors)
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(concurrency)]
+    start = perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = perf_counter() - start
+
+    result = {'requests': len(latencies), 'errors': sum(errors), 'throughput': round(len(latencies) / elapsed, 2)}
+    result.update(percentiles(latencies))
+    return result
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    arg_parser.add_argument('--scenarios', default=','.join(SCENARIOS), help='comma separated scenarios')
+    arg_parser.add_argument('--concurrency', type=int, default=8)
+    arg_parser.add_argument('--requests', type=int, default=1000, help='requests per scenario')
+    arg_parser.add_argument('--login-requests', type=int, default=100, help='login is bound by password hashing')
+    arg_parser.add_argument('--users', type=int, default=200)
+    arg_parser.add_argument('--friends', type=int, default=10, help='conversations per user')
+    arg_parser.add_argument('--messages', type=int, default=50, help='messages per conversation')
+    arg_parser.add_argument('--groups', type=int, default=20)
+    arg_parser.add_argument('--seed', type=int, default=42)
+    arg_parser.add_argument('--output', help='write the json report to this file')
+    arg_parser.add_argument('--compare', help='json report of the reference run')
+    arg_parser.add_argument('--threshold', type=float, default=0.2, help='allowed regression, 0.2 = 20%%')
+    args = arg_parser.parse_args()
+
+    app = create_bench_app()
+    data = seed(app, users=args.users, friends_per_user=args.friends, messages_per_conversation=args.messages,
+                groups=args.groups, seed_value=args.seed)
+    tokens = {user_id: {'Authorization': 'Bearer ' + token}
+              for user_id, token in create_tokens(app, data['users']).items()}
+
+    results = {}
+    for name in args.scenarios.split(','):
+        requests = args.login_requests if name == 'login' else args.requests
+        results[name] = run_scenario(app, SCENARIOS[name], data, tokens, args.concurrency, requests, args.seed)
+        print('{:<14} {}'.format(name, json.dumps(results[name])), file=sys.stderr)
+
+    report = {'meta': metadata(benchmark='rest', concurrency=args.concurrency, users=args.users,
+                               friends=args.friends, messages=args.messages, groups=args.groups, seed=args.seed,
+                               database=app.config['SQLALCHEMY_DATABASE_URI']),
+              'results': results}
+    write_report(report, args.output)
+
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)['results']
+        regressions = compare(results, baseline, args.threshold)
+        for name, key, before, after in regressions:
+            print('REGRESSION {} {}: {} -> {}'.format(name, key, before, after), file=sys.stderr)
+        sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
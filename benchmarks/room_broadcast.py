@@ -0,0 +1,129 @@
+"""
+CPU per delivered message of the room broadcasts, against the size of the room
+
+Each room member is an Engine.IO socket stand-in that encodes the frames written to it like a transport would,
+no network is involved. A run emits the same events to a room with the three paths:
+    emit     sio.emit, the packet is encoded again for every member
+    encoded  broadcaster.emit without tick, the frame is encoded once per event
+    tick     broadcaster.emit with BROADCAST_TICK, the events of a tick share one room_batch frame
+
+    python benchmarks/room_broadcast.py --members 10,100,1000,10000 --output rooms.json
+    python benchmarks/room_broadcast.py --compare rooms.json --threshold 0.2
+"""
+import argparse
+import json
+import os
+import sys
+import uuid
+from time import process_time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from app.app import create_app
+from app.broadcast import broadcaster
+from app.extensions import sio
+from benchmarks.common import BenchConfig, metadata, write_report, compare
+
+ROOM = 'bench-room'
+
+
+class QueueStandIn(object):
+    @staticmethod
+    def qsize():
+        return 0
+
+
+class SocketStandIn(object):
+    """
+    Engine.IO socket reading its frames at once
+    """
+
+    def __init__(self):
+        self.closed = False
+        self.queue = QueueStandIn()
+        self.frames = 0
+
+    def send(self, pkt):
+        pkt.encode()
+        self.frames += 1
+
+
+def join(members):
+    sockets = {}
+    for _ in range(members):
+        sid = uuid.uuid4().hex
+        sockets[sid] = sio.server.eio.sockets[sid] = SocketStandIn()
+        sio.server.manager.connect(sid, '/')
+        sio.server.manager.enter_room(sid, '/', ROOM)
+    return sockets
+
+
+def leave(sockets):
+    for sid in sockets:
+        sio.server.manager.disconnect(sid, '/')
+        sio.server.eio.sockets.pop(sid, None)
+
+
+def run(mode, members, events, tick_events):
+    sockets = join(members)
+    payloads = [{'id': str(uuid.uuid1()), 'message': 'ciphertext ' * 24, 'sender_id': str(uuid.uuid1()),
+                 'room': ROOM, 'created_date': 1600000000 + i} for i in range(events)]
+    broadcaster.tick = 0.05 if mode == 'tick' else 0
+    broadcaster.min_members = 1
+    start = process_time()
+    for index, payload in enumerate(payloads):
+        if mode == 'emit':
+            sio.emit('new_group_msg', payload, room=ROOM)
+        else:
+            broadcaster.emit('new_group_msg', payload, room=ROOM)
+        if mode == 'tick' and (index + 1) % tick_events == 0:
+            broadcaster.flush()
+    broadcaster.flush()
+    elapsed = process_time() - start
+    frames = sum(socket.frames for socket in sockets.values())
+    leave(sockets)
+    delivered = events * members
+    return {'members': members, 'events': events, 'frames': frames,
+            'cpu_us_per_message': round(elapsed / delivered * 1e6, 3),
+            'throughput': round(delivered / elapsed, 2) if elapsed else None}
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    arg_parser.add_argument('--members', default='10,100,1000,10000', help='comma separated room sizes')
+    arg_parser.add_argument('--deliveries', type=int, default=200000, help='delivered messages per run')
+    arg_parser.add_argument('--tick-events', type=int, default=10, help='events gathered in one tick')
+    arg_parser.add_argument('--modes', default='emit,encoded,tick')
+    arg_parser.add_argument('--output')
+    arg_parser.add_argument('--compare')
+    arg_parser.add_argument('--threshold', type=float, default=0.2)
+    args = arg_parser.parse_args()
+
+    config = type('BroadcastBenchConfig', (BenchConfig,), {'OUTBOUND_HIGH_WATER': 0, 'BROADCAST_MAX_BATCH': 1000})
+    app = create_app(config)
+    results = {}
+    with app.app_context():
+        for members in [int(value) for value in args.members.split(',')]:
+            events = max(args.tick_events, args.deliveries // members)
+            for mode in args.modes.split(','):
+                name = '{}_{}'.format(mode, members)
+                results[name] = run(mode, members, events, args.tick_events)
+                print('{:<14} {:>8.3f} us/message  {:>12.1f} messages/s  {:>8} frames'.format(
+                    name, results[name]['cpu_us_per_message'], results[name]['throughput'] or 0,
+                    results[name]['frames']), file=sys.stderr)
+
+    report = {'meta': metadata(benchmark='room_broadcast', deliveries=args.deliveries,
+                               tick_events=args.tick_events), 'results': results}
+    write_report(report, args.output)
+
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)['results']
+        regressions = compare(results, baseline, args.threshold, lower_is_better=('cpu_us_per_message',))
+        for name, key, before, after in regressions:
+            print('REGRESSION {} {}: {} -> {}'.format(name, key, before, after), file=sys.stderr)
+        sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,245 @@
+"""
+Socket.IO swarm: thousands of simulated clients against the realtime server
+
+Start a server on a seeded SQLite stand-in, it writes the users, tokens and conversations to --data:
+
+    python benchmarks/socket_swarm.py serve --port 5013 --users 2000 --data /tmp/swarm.json
+
+Run the swarm, --server-pid reports the memory per connection (ulimit -n must allow --clients sockets):
+
+    python benchmarks/socket_swarm.py run --url http://127.0.0.1:5013 --data /tmp/swarm.json \
+        --clients 2000 --rate 500 --duration 30 --group-ratio 0.2 --server-pid <pid> --output swarm.json
+
+The client speaks Engine.IO v3 over WebSocket directly, it needs aiohttp and a server running with eventlet.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+from time import perf_counter
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from benchmarks.common import percentiles, metadata, write_report, compare
+
+MARKER = 'swarm:'
+
+
+def serve(args):
+    from benchmarks.common import create_bench_app, seed, create_tokens
+    from app.extensions import sio
+
+    app = create_bench_app()
+    data = seed(app, users=args.users, friends_per_user=args.friends, messages_per_conversation=1,
+                groups=args.groups, seed_value=args.seed)
+    data['tokens'] = create_tokens(app, data['users'])
+    with open(args.data, 'w') as file:
+        json.dump(data, file)
+    print('serving pid={} users={} data={}'.format(os.getpid(), args.users, args.data), file=sys.stderr)
+    sio.run(app, host='127.0.0.1', port=args.port)
+
+
+def rss_bytes(pid):
+    """
+    Resident memory of a process, None if it cannot be read
+    """
+    try:
+        with open('/proc/{}/status'.format(pid)) as file:
+            for line in file:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        return None
+
+
+class SwarmClient(object):
+    """
+    Minimal Socket.IO client: Engine.IO v3 over WebSocket, default namespace, json events
+    """
+
+    def __init__(self, session, url, user_id, token, stats):
+        self.session = session
+        self.url = url.replace('http', 'ws', 1) + '/socket.io/?EIO=3&transport=websocket&token=' + token
+        self.user_id = user_id
+        self.token = token
+        self.stats = stats
+        self.ws = None
+        self.tasks = []
+
+    async def connect(self, room):
+        start = perf_counter()
+        self.ws = await self.session.ws_connect(self.url, max_msg_size=0)
+        handshake = await self.ws.receive()
+        ping_interval = json.loads(handshake.data[1:])['pingInterval'] / 1000
+        packet = (await self.ws.receive()).data
+        if packet != '40':
+            raise ConnectionRefusedError(packet)
+        await self.emit('auth', self.token)
+        await self.emit('join', {'username': self.user_id, 'room': room})
+        self.stats['connect'].append(perf_counter() - start)
+        self.tasks = [asyncio.ensure_future(self._read()), asyncio.ensure_future(self._ping(ping_interval))]
+
+    async def emit(self, event, data):
+        await self.ws.send_str('42' + json.dumps([event, data]))
+
+    async def _ping(self, interval):
+        while not self.ws.closed:
+            await asyncio.sleep(interval)
+            await self.ws.send_str('2')
+
+    async def _read(self):
+        async for msg in self.ws:
+            text = msg.data
+            if not isinstance(text, str) or not text.startswith('42'):
+                continue
+            event, *args = json.loads(text[2:])
+            if event == 'new_private_msg':
+                self._received('private', args[0]['message'])
+            elif event == 'new_group_msg':
+                self._received('group', args[0])
+
+    def _received(self, kind, message):
+        index = message.find(MARKER)
+        if index >= 0:
+            self.stats[kind].append(perf_counter() - float(message[index + len(MARKER):]))
+
+    async def close(self):
+        for task in self.tasks:
+            task.cancel()
+        if self.ws is not None:
+            await self.ws.close()
+
+
+async def swarm(args, data):
+    import aiohttp
+
+    stats = {'connect': [], 'private': [], 'group': [], 'rejected': 0, 'sent_private': 0, 'sent_group': 0,
+             'expected_group': 0}
+    rng = random.Random(args.seed)
+    user_ids = data['users'][:args.clients]
+    partners = {}
+    for a, b in data['pairs']:
+        partners.setdefault(a, []).append(b)
+        partners.setdefault(b, []).append(a)
+    rooms = {user_id: 'swarm-' + data['groups'][i % len(data['groups'])] for i, user_id in enumerate(user_ids)}
+    room_sizes = {}
+    for room in rooms.values():
+        room_sizes[room] = room_sizes.get(room, 0) + 1
+
+    rss_before = rss_bytes(args.server_pid) if args.server_pid else None
+    connector = aiohttp.TCPConnector(limit=0)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        clients = {}
+        semaphore = asyncio.Semaphore(args.connect_concurrency)
+
+        async def open_client(user_id):
+            async with semaphore:
+                client = SwarmClient(session, args.url, user_id, data['tokens'][user_id], stats)
+                try:
+                    await client.connect(rooms[user_id])
+                    clients[user_id] = client
+                except Exception:
+                    stats['rejected'] += 1
+                    await client.close()
+
+        start = perf_counter()
+        await asyncio.gather(*(open_client(user_id) for user_id in user_ids))
+        connect_elapsed = perf_counter() - start
+        rss_after = rss_bytes(args.server_pid) if args.server_pid else None
+
+        # wait for the login broadcasts of the ramp-up to drain before measuring deliveries
+        await asyncio.sleep(args.settle)
+        connected = list(clients)
+        end = perf_counter() + args.duration
+        interval = 1.0 / args.rate
+        while perf_counter() < end and connected:
+            sender_id = rng.choice(connected)
+            message = '{}{}'.format(MARKER, perf_counter())
+            if rng.random() < args.group_ratio:
+                await clients[sender_id].emit('chat_group', {'room': rooms[sender_id], 'username': sender_id,
+                                                             'message': message})
+                stats['sent_group'] += 1
+                stats['expected_group'] += room_sizes[rooms[sender_id]]
+            else:
+                online_partners = [p for p in partners.get(sender_id, []) if p in clients]
+                if online_partners:
+                    await clients[sender_id].emit('private_chat', {'receiver_id': rng.choice(online_partners),
+                                                                   'message': message})
+                    stats['sent_private'] += 1
+            await asyncio.sleep(interval)
+        await asyncio.sleep(args.settle)
+
+        for client in clients.values():
+            await client.close()
+
+    results = {
+        'connect': dict(percentiles(stats['connect']), connected=len(stats['connect']), rejected=stats['rejected'],
+                        throughput=round(len(stats['connect']) / connect_elapsed, 2)),
+        'private': dict(percentiles(stats['private']), sent=stats['sent_private'], received=len(stats['private'])),
+        'group': dict(percentiles(stats['group']), sent=stats['sent_group'], expected=stats['expected_group'],
+                      received=len(stats['group'])),
+    }
+    if rss_before is not None and rss_after is not None and clients:
+        results['memory'] = {'rss_before': rss_before, 'rss_after': rss_after,
+                             'bytes_per_connection': (rss_after - rss_before) // len(stats['connect'])}
+    return results
+
+
+def run(args):
+    with open(args.data) as file:
+        data = json.load(file)
+    results = asyncio.get_event_loop().run_until_complete(swarm(args, data))
+    report = {'meta': metadata(benchmark='socket_swarm', clients=args.clients, rate=args.rate,
+                               duration=args.duration, group_ratio=args.group_ratio, seed=args.seed),
+              'results': results}
+    write_report(report, args.output)
+
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)['results']
+        regressions = compare(results, baseline, args.threshold)
+        for name, key, before, after in regressions:
+            print('REGRESSION {} {}: {} -> {}'.format(name, key, before, after), file=sys.stderr)
+        sys.exit(1 if regressions else 0)
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = arg_parser.add_subparsers(dest='command')
+
+    serve_parser = commands.add_parser('serve', help='run a server on a seeded SQLite database')
+    serve_parser.add_argument('--port', type=int, default=5013)
+    serve_parser.add_argument('--users', type=int, default=2000)
+    serve_parser.add_argument('--friends', type=int, default=10)
+    serve_parser.add_argument('--groups', type=int, default=100)
+    serve_parser.add_argument('--seed', type=int, default=42)
+    serve_parser.add_argument('--data', default='/tmp/swarm.json')
+
+    run_parser = commands.add_parser('run', help='connect the swarm and drive messages')
+    run_parser.add_argument('--url', default='http://127.0.0.1:5013')
+    run_parser.add_argument('--data', default='/tmp/swarm.json')
+    run_parser.add_argument('--clients', type=int, default=1000)
+    run_parser.add_argument('--connect-concurrency', type=int, default=100)
+    run_parser.add_argument('--rate', type=float, default=200, help='messages per second')
+    run_parser.add_argument('--duration', type=float, default=30, help='seconds')
+    run_parser.add_argument('--group-ratio', type=float, default=0.2, help='part of group messages')
+    run_parser.add_argument('--settle', type=float, default=2, help='seconds to wait for in-flight messages')
+    run_parser.add_argument('--server-pid', type=int)
+    run_parser.add_argument('--seed', type=int, default=42)
+    run_parser.add_argument('--output')
+    run_parser.add_argument('--compare')
+    run_parser.add_argument('--threshold', type=float, default=0.2)
+
+    args = arg_parser.parse_args()
+    if args.command == 'serve':
+        serve(args)
+    elif args.command == 'run':
+        run(args)
+    else:
+        arg_parser.print_help()
+
+
+if __name__ == '__main__':
+    main()
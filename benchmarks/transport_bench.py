@@ -0,0 +1,175 @@
+"""
+Bandwidth and server CPU of the Socket.IO transports
+
+A client is connected through the Engine.IO handshake, then the server emits a workload of private messages
+(--message-size bytes of ciphertext) and history batches (--batch-size messages) to it:
+    polling      the client polls after every --events-per-poll events, the HTTP responses are measured,
+                 gzip above SOCKETIO_COMPRESSION_THRESHOLD when SOCKETIO_HTTP_COMPRESSION is set
+    websocket    the queued packets are encoded and framed like the websocket handler writes them,
+                 with permessage-deflate (context takeover) for websocket_deflate
+
+    python benchmarks/transport_bench.py --events 2000 --output transport.json
+    python benchmarks/transport_bench.py --thresholds 0,1024,16384 --compare transport.json
+"""
+import argparse
+import base64
+import json
+import os
+import random
+import re
+import sys
+import zlib
+from time import process_time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from app.extensions import sio
+from benchmarks.common import BenchConfig, create_bench_app, seed, create_tokens, metadata, write_report, compare
+
+
+def transport_config(http_compression=True, threshold=1024):
+    return type('TransportBenchConfig', (BenchConfig,), {
+        'SOCKETIO_HTTP_COMPRESSION': http_compression, 'SOCKETIO_COMPRESSION_THRESHOLD': threshold,
+        'OUTBOUND_HIGH_WATER': 0})
+
+
+def workload(events, message_size, batch_size, batch_ratio, seed_value):
+    """
+    Events emitted to the client, (event, payload), deterministic
+    """
+    rng = random.Random(seed_value)
+
+    def message(i):
+        return {'id': '{:032x}'.format(rng.getrandbits(128)), 'sender_id': '{:032x}'.format(rng.getrandbits(128)),
+                'message': base64.b64encode(rng.getrandbits(8 * message_size).to_bytes(message_size, 'big')).decode(),
+                'created_date': 1600000000 + i, 'seen': False}
+
+    result = []
+    for i in range(events):
+        if rng.random() < batch_ratio:
+            result.append(('new_private_msg_batch', {'messages': [message(i) for _ in range(batch_size)],
+                                                     'has_more': False}))
+        else:
+            result.append(('new_private_msg', message(i)))
+    return result
+
+
+def connect(client, token):
+    """
+    Engine.IO handshake on long-polling, the response carries the connect and presence packets too
+    Returns:
+        session id
+    """
+    response = client.get('/socket.io/?EIO=3&transport=polling&token=' + token)
+    if response.status_code != 200:
+        raise RuntimeError('handshake failed: {} {}'.format(response.status_code, response.data[:200]))
+    sid = re.search(r'"sid":\s*"([^"]+)"', response.get_data().decode('latin-1')).group(1)
+    return sid
+
+
+def close(sid):
+    """
+    Close the session without waiting for a transport to read the close packet
+    """
+    sio.server.eio.sockets.pop(sid).close(wait=False, abort=True)
+
+
+def frame_size(payload):
+    length = len(payload)
+    return length + (2 if length < 126 else 4 if length < 65536 else 10)
+
+
+def run_polling(app, token, events, events_per_poll):
+    client = app.test_client()
+    sid = connect(client, token)
+    total_bytes = requests = 0
+    start = process_time()
+    for index, (event, payload) in enumerate(events):
+        sio.emit(event, payload, room=sid)
+        if (index + 1) % events_per_poll == 0 or index + 1 == len(events):
+            response = client.get('/socket.io/?EIO=3&transport=polling&sid=' + sid,
+                                  headers={'Accept-Encoding': 'gzip'})
+            total_bytes += len(response.get_data()) + sum(len(key) + len(value) + 4
+                                                          for key, value in response.headers.items())
+            requests += 1
+    elapsed = process_time() - start
+    close(sid)
+    return total_bytes, requests, elapsed
+
+
+def run_websocket(app, token, events, deflate):
+    client = app.test_client()
+    sid = connect(client, token)
+    socket = sio.server.eio.sockets[sid]
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -zlib.MAX_WBITS)
+    total_bytes = 0
+    start = process_time()
+    for event, payload in events:
+        sio.emit(event, payload, room=sid)
+        while socket.queue.qsize():
+            data = socket.queue.get().encode(always_bytes=False)
+            if isinstance(data, str):
+                data = data.encode()
+            if deflate:
+                data = (compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH))[:-4]
+            total_bytes += frame_size(data)
+    elapsed = process_time() - start
+    close(sid)
+    return total_bytes, 0, elapsed
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    arg_parser.add_argument('--events', type=int, default=2000)
+    arg_parser.add_argument('--message-size', type=int, default=256, help='bytes of ciphertext per message')
+    arg_parser.add_argument('--batch-size', type=int, default=100, help='messages per history batch')
+    arg_parser.add_argument('--batch-ratio', type=float, default=0.02, help='part of history batches')
+    arg_parser.add_argument('--events-per-poll', type=int, default=1)
+    arg_parser.add_argument('--thresholds', default='1024', help='comma separated SOCKETIO_COMPRESSION_THRESHOLD')
+    arg_parser.add_argument('--seed', type=int, default=42)
+    arg_parser.add_argument('--output')
+    arg_parser.add_argument('--compare')
+    arg_parser.add_argument('--threshold', type=float, default=0.2)
+    args = arg_parser.parse_args()
+
+    events = workload(args.events, args.message_size, args.batch_size, args.batch_ratio, args.seed)
+    messages = sum(len(payload['messages']) if 'messages' in payload else 1 for _, payload in events)
+    profiles = [('polling', dict(http_compression=False), 'polling', None)]
+    profiles += [('polling_gzip_{}'.format(value), dict(threshold=int(value)), 'polling', None)
+                 for value in args.thresholds.split(',')]
+    profiles += [('websocket', {}, 'websocket', False), ('websocket_deflate', {}, 'websocket', True)]
+
+    results = {}
+    for name, options, transport, deflate in profiles:
+        app = create_bench_app(transport_config(**options))
+        data = seed(app, users=2, friends_per_user=1, messages_per_conversation=0, groups=0, seed_value=args.seed)
+        token = create_tokens(app, data['users'][:1])[data['users'][0]]
+        with app.app_context():
+            if transport == 'polling':
+                total_bytes, requests, elapsed = run_polling(app, token, events, args.events_per_poll)
+            else:
+                total_bytes, requests, elapsed = run_websocket(app, token, events, deflate)
+        results[name] = {'bytes': total_bytes, 'bytes_per_message': round(total_bytes / messages, 1),
+                         'http_requests': requests, 'cpu_us_per_message': round(elapsed / messages * 1e6, 3)}
+        print('{:<22} {:>10.1f} bytes/message  {:>8.3f} us/message  {:>6} requests'.format(
+            name, results[name]['bytes_per_message'], results[name]['cpu_us_per_message'], requests),
+            file=sys.stderr)
+
+    report = {'meta': metadata(benchmark='transport_bench', events=args.events, messages=messages,
+                               message_size=args.message_size, batch_size=args.batch_size,
+                               batch_ratio=args.batch_ratio, events_per_poll=args.events_per_poll, seed=args.seed),
+              'results': results}
+    write_report(report, args.output)
+
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)['results']
+        regressions = compare(results, baseline, args.threshold, higher_is_better=(),
+                              lower_is_better=('bytes_per_message', 'cpu_us_per_message'))
+        for name, key, before, after in regressions:
+            print('REGRESSION {} {}: {} -> {}'.format(name, key, before, after), file=sys.stderr)
+        sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
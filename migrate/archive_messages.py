@@ -0,0 +1,69 @@
+"""
+Move the private messages older than ARCHIVE_AFTER_DAYS into the compressed segments of archive_segments
+(app.archive), while the app keeps running. Run it periodically, e.g. from cron:
+
+    python migrate/archive_messages.py --dry-run
+    python migrate/archive_messages.py --days 90 --segment-size 1000
+
+History pages, cursor pages and exports read the archive when a client scrolls past the hot messages.
+"""
+import argparse
+from time import perf_counter
+
+from flask import Flask
+
+import os, sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from app.archive import message_archive
+from app.extensions import db
+from app.models import ArchiveSegment
+from app.settings import DevConfig, ProdConfig, os
+from app.utils import get_timestamp_now
+
+CONFIG = DevConfig if os.environ.get('DevConfig') == '1' else ProdConfig
+
+
+class Archiver:
+    def __init__(self, config=CONFIG, segment_size=None):
+        app = Flask(__name__)
+        app.config.from_object(config)
+        app.config['ARCHIVE_ENABLED'] = True
+        if segment_size:
+            app.config['ARCHIVE_SEGMENT_SIZE'] = segment_size
+        db.app = app
+        db.init_app(app)
+        message_archive.init_app(app)
+        app_context = app.app_context()
+        app_context.push()
+
+        ArchiveSegment.__table__.create(bind=db.get_engine(app), checkfirst=True)
+
+    @staticmethod
+    def run(days=None, dry_run=False):
+        """
+        Returns:
+            number of archived messages
+        """
+        if days is None:
+            days = message_archive.after_days
+        before = get_timestamp_now() - days * 24 * 3600
+        start = perf_counter()
+        counts = message_archive.archive(before=before, dry_run=dry_run)
+        for group_id, count in counts.items():
+            print("{}: {} messages".format(group_id, count))
+        total = sum(counts.values())
+        print("{} conversations in {:.2f}s".format(len(counts), perf_counter() - start))
+        return total
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--days', type=int, help='archive the messages older than this, default ARCHIVE_AFTER_DAYS')
+    parser.add_argument('--segment-size', type=int, help='messages per segment, default ARCHIVE_SEGMENT_SIZE')
+    parser.add_argument('--dry-run', action='store_true', help='only count the messages to archive')
+    args = parser.parse_args()
+
+    archiver = Archiver(segment_size=args.segment_size)
+    total = archiver.run(days=args.days, dry_run=args.dry_run)
+    print("=" * 50, "{} messages {}".format(total, "to archive" if args.dry_run else "archived"), "=" * 50)
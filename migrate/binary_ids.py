@@ -0,0 +1,132 @@
+"""
+Convert the message and token ids from VARCHAR uuid strings to BINARY(16) (app.ids.BinaryId).
+Stop the app first, the old code writes strings:
+
+    python migrate/binary_ids.py --dry-run
+    python migrate/binary_ids.py --batch-size 10000
+
+On MySQL the column becomes VARBINARY, the rows are converted by batches with UNHEX, then the column becomes
+BINARY(16). On SQLite the text values are replaced by their 16 bytes. A stopped run resumes where it stopped,
+a converted column is skipped. Rows whose id is not a uuid are reported and stop the conversion of their column.
+"""
+import argparse
+import uuid
+from time import perf_counter
+
+from flask import Flask
+from sqlalchemy import text
+
+import os, sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from app.extensions import db
+from app.models import Message, PendingDelivery, GroupMessage, Change, ArchiveSegment, Token
+from app.settings import DevConfig, ProdConfig, os
+
+CONFIG = DevConfig if os.environ.get('DevConfig') == '1' else ProdConfig
+
+COLUMNS = [(Message, 'id'), (PendingDelivery, 'message_id'), (GroupMessage, 'id'), (Change, 'message_id'),
+           (ArchiveSegment, 'first_id'), (ArchiveSegment, 'last_id'), (Token, 'jti')]
+
+UUID_REGEXP = '^[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}$'
+
+
+class IdConverter:
+    def __init__(self, config=CONFIG, batch_size=10000, dry_run=False):
+        app = Flask(__name__)
+        app.config.from_object(config)
+        db.app = app
+        db.init_app(app)
+        app_context = app.app_context()
+        app_context.push()
+        self.batch_size = batch_size
+        self.dry_run = dry_run
+
+    def run(self):
+        """
+        Returns:
+            number of converted (or, with dry_run, convertible) values
+        """
+        total = 0
+        for model, column in COLUMNS:
+            start = perf_counter()
+            with db.engine.connect() as connection:
+                if not connection.dialect.has_table(connection, model.__tablename__):
+                    continue
+                if db.engine.dialect.name == 'mysql':
+                    count = self.convert_mysql(connection, model.__tablename__, column)
+                else:
+                    count = self.convert_sqlite(connection, model.__tablename__, column)
+            print("{}.{}: {} values in {:.2f}s".format(model.__tablename__, column, count, perf_counter() - start))
+            total += count
+        return total
+
+    def convert_mysql(self, connection, table, column):
+        data_type = connection.execute(text(
+            "SELECT DATA_TYPE FROM information_schema.COLUMNS WHERE TABLE_SCHEMA = DATABASE() "
+            "AND TABLE_NAME = :table AND COLUMN_NAME = :column"), table=table, column=column).scalar()
+        if data_type == 'binary':
+            return 0
+        if data_type != 'varbinary':
+            invalid = connection.execute(text("SELECT `{0}` FROM `{1}` WHERE `{0}` NOT REGEXP :regexp LIMIT 10".format(
+                column, table)), regexp=UUID_REGEXP).fetchall()
+            if invalid:
+                print("{}.{}: ids that are not uuids, not converted: {}".format(table, column,
+                                                                                [row[0] for row in invalid]))
+                return 0
+        if self.dry_run:
+            return connection.execute(text("SELECT COUNT(*) FROM `{0}` WHERE LENGTH(`{1}`) = 36".format(
+                table, column))).scalar()
+        if data_type != 'varbinary':
+            # same bytes, the text can then be replaced by binary values
+            connection.execute(text("ALTER TABLE `{0}` MODIFY `{1}` VARBINARY(50) NOT NULL".format(table, column)))
+
+        update = text("UPDATE `{0}` SET `{1}` = UNHEX(REPLACE(`{1}`, '-', '')) WHERE LENGTH(`{1}`) = 36 "
+                      "LIMIT {2}".format(table, column, self.batch_size))
+        count = 0
+        while True:
+            rowcount = connection.execute(update).rowcount
+            count += rowcount
+            if rowcount < self.batch_size:
+                break
+        connection.execute(text("ALTER TABLE `{0}` MODIFY `{1}` BINARY(16) NOT NULL".format(table, column)))
+        return count
+
+    def convert_sqlite(self, connection, table, column):
+        if self.dry_run:
+            return connection.execute(text('SELECT COUNT(DISTINCT "{0}") FROM "{1}" '
+                                           'WHERE typeof("{0}") = \'text\''.format(column, table))).scalar()
+        query = text('SELECT DISTINCT "{0}" FROM "{1}" WHERE typeof("{0}") = \'text\' LIMIT {2}'.format(
+            column, table, self.batch_size))
+        update = text('UPDATE "{0}" SET "{1}" = :new WHERE "{1}" = :old'.format(table, column))
+        count = 0
+        while True:
+            values = [row[0] for row in connection.execute(query)]
+            invalid = [value for value in values if not _is_uuid(value)]
+            if invalid:
+                print("{}.{}: ids that are not uuids, not converted: {}".format(table, column, invalid[:10]))
+                return count
+            if not values:
+                return count
+            with connection.begin():
+                connection.execute(update, [{'old': value, 'new': uuid.UUID(value).bytes} for value in values])
+            count += len(values)
+
+
+def _is_uuid(value):
+    try:
+        uuid.UUID(value)
+        return True
+    except ValueError:
+        return False
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--batch-size', type=int, default=10000, help='values converted per statement')
+    parser.add_argument('--dry-run', action='store_true', help='only count the values to convert')
+    args = parser.parse_args()
+
+    converter = IdConverter(batch_size=args.batch_size, dry_run=args.dry_run)
+    total = converter.run()
+    print("=" * 50, "{} ids {}".format(total, "to convert" if args.dry_run else "converted"), "=" * 50)
@@ -1,3 +1,4 @@
+import argparse
 import json
 from flask import Flask
 
@@ -7,16 +8,20 @@ sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
 from app.extensions import db
 from app.models import User
 from app.settings import DevConfig, ProdConfig, os
+from migrate.seed_data import Seeder, SEED_NOW
 
 CONFIG = DevConfig if os.environ.get('DevConfig') == '1' else ProdConfig
 default_file = "default.json" if os.environ.get('DevConfig') == '1' else "migrate/default.json"
 
 
 class Worker:
-    def __init__(self):
+    def __init__(self, load_data=False):
         app = Flask(__name__)
 
         app.config.from_object(CONFIG)
+        if load_data:
+            # LOAD DATA LOCAL INFILE must be allowed by the client
+            app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {'connect_args': {'local_infile': 1}}
         db.app = app
         db.init_app(app)
         app_context = app.app_context()
@@ -39,8 +44,36 @@ class Worker:
 
         db.session.commit()
 
+    @staticmethod
+    def insert_synthetic_data(args):
+        seeder = Seeder(seed=args.seed, batch_size=args.batch_size, load_data=args.load_data, alpha=args.alpha,
+                        days=args.days, now=args.now)
+        seeder.run(users=args.users, max_friends=args.max_friends, groups=args.groups, max_members=args.max_members,
+                   messages=args.messages, group_messages=args.group_messages,
+                   tokens_per_user=args.tokens_per_user)
+
 
 if __name__ == '__main__':
-    worker = Worker()
+    parser = argparse.ArgumentParser(description='Recreate the database, with --seed add a synthetic dataset')
+    parser.add_argument('--seed', type=int, help='generate a synthetic dataset deterministic from this seed')
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--max-friends', type=int, default=500, help='cap of the power-law friend count')
+    parser.add_argument('--groups', type=int, default=1000)
+    parser.add_argument('--max-members', type=int, default=200, help='cap of the power-law group size')
+    parser.add_argument('--messages', type=int, default=1000000, help='private messages in total')
+    parser.add_argument('--group-messages', type=int, default=100000, help='group messages in total')
+    parser.add_argument('--tokens-per-user', type=int, default=2)
+    parser.add_argument('--alpha', type=float, default=1.2, help='power-law exponent, lower is more skewed')
+    parser.add_argument('--days', type=int, default=365, help='messages are spread over the last days')
+    parser.add_argument('--now', type=int, default=SEED_NOW, help='timestamp of the end of the history, '
+                                                                   'default a fixed date')
+    parser.add_argument('--batch-size', type=int, default=10000, help='rows per insert')
+    parser.add_argument('--load-data', action='store_true', help='load the batches with LOAD DATA LOCAL INFILE '
+                                                                 '(MySQL only)')
+    args = parser.parse_args()
+
+    worker = Worker(load_data=args.load_data)
     worker.insert_default_users()
+    if args.seed is not None:
+        worker.insert_synthetic_data(args)
     print("=" * 50, "Database migration completed", "=" * 50)
@@ -0,0 +1,172 @@
+import os
+import random
+import tempfile
+import uuid
+from time import perf_counter
+
+from app.enums import AVATAR_PATH_SEVER, DEFAULT_AVATAR
+from app.extensions import db
+from app.ids import BinaryId
+from app.models import User, Friend, Group, GroupUser, Message, GroupMessage, Token
+from app.utils import generate_id
+
+# password of the default users, a fixed hash keeps the dataset deterministic
+PASSWORD_HASH = "pbkdf2:sha256:150000$VuKE7ySs$ced9ddc3a3ffddbf73f47af936797eb2b4c594e39e452456f9496f72ed7028ce"
+# end of the generated history, a fixed date keeps the timestamps the same from one run to the next
+SEED_NOW = 1640995200  # 2022-01-01 00:00:00 UTC
+
+# LOAD DATA escapes of the default FIELDS ESCAPED BY '\\'
+LOAD_DATA_ESCAPES = str.maketrans({'\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r', '\0': '\\0'})
+
+
+class Seeder:
+    """
+    Generate a large synthetic dataset, deterministic from the seed:
+    users, friendships with power-law degrees, groups with power-law sizes, tokens, and messages distributed over
+    the conversations with power-law sizes (a few huge conversations, a long tail of small ones).
+    Rows are generated lazily and written by batches, with executemany multi-row inserts or LOAD DATA LOCAL INFILE.
+    """
+
+    def __init__(self, seed=42, batch_size=10000, load_data=False, alpha=1.2, days=365, now=SEED_NOW):
+        self.rng = random.Random(seed)
+        self.batch_size = batch_size
+        self.load_data = load_data
+        self.alpha = alpha
+        self.now = now
+        self.start = self.now - days * 86400
+
+    def new_id(self):
+        return str(uuid.UUID(int=self.rng.getrandbits(128), version=1))
+
+    def power_law(self, minimum, maximum):
+        return min(maximum, int(minimum * self.rng.paretovariate(self.alpha)))
+
+    def split(self, total, parts):
+        """
+        Split total between parts with power-law weights
+        Returns:
+            list of counts
+        """
+        weights = [self.rng.paretovariate(self.alpha) for _ in range(parts)]
+        scale = total / sum(weights) if weights else 0
+        counts = [int(weight * scale) for weight in weights]
+        if counts:
+            counts[0] += total - sum(counts)
+        return counts
+
+    def run(self, users=1000, max_friends=200, groups=100, max_members=100, messages=100000, group_messages=10000,
+            tokens_per_user=2):
+        user_ids = [self.new_id() for _ in range(users)]
+        self.insert(User, ({
+            "id": user_id, "username": "user{}".format(i), "password_hash": PASSWORD_HASH, "pub_key": "seed-key",
+            "gender": self.rng.random() < 0.5, "display_name": "User {}".format(i), "is_active": True,
+            "login_failed_attempts": 0, "force_change_password": False, "created_date": self.start,
+            "modified_date": self.start, "modified_date_password": self.start, "avatar_path": AVATAR_PATH_SEVER + DEFAULT_AVATAR,
+            "test_message": "test message"
+        } for i, user_id in enumerate(user_ids)))
+
+        pairs = set()
+        for user_id in user_ids:
+            for _ in range(self.power_law(1, max_friends)):
+                partner_id = user_ids[self.rng.randrange(users)]
+                if partner_id != user_id and (partner_id, user_id) not in pairs:
+                    pairs.add((user_id, partner_id))
+        pairs = sorted(pairs)
+        self.insert(Friend, ({"id": generate_id(a, b), "user_id_1": a, "user_id_2": b} for a, b in pairs))
+
+        group_members = {}
+        for _ in range(groups):
+            group_members[self.new_id()] = self.rng.sample(user_ids, min(users, self.power_law(3, max_members)))
+        self.insert(Group, ({"id": group_id, "group_name": "Group {}".format(i), "created_date": self.start,
+                             "modified_date": self.start} for i, group_id in enumerate(group_members)))
+        self.insert(GroupUser, ({"user_id": user_id, "group_id": group_id}
+                                for group_id, members in group_members.items() for user_id in members))
+
+        self.insert(Token, ({
+            "jti": self.new_id(), "token_type": "access", "user_identity": user_id, "revoked": False,
+            "expires": self.now + 30 * 86400
+        } for user_id in user_ids for _ in range(tokens_per_user)))
+
+        conversations = [(generate_id(a, b), (a, b)) for a, b in pairs]
+        self.insert(Message, self.messages(conversations, messages, with_seen=True))
+        self.insert(GroupMessage, self.messages(list(group_members.items()), group_messages, with_seen=False))
+
+    def messages(self, conversations, total, with_seen):
+        for (group_id, members), count in zip(conversations, self.split(total, len(conversations))):
+            created_date = self.start + self.rng.randrange(86400)
+            step = max(1, (self.now - created_date) // max(count, 1))
+            for _ in range(count):
+                created_date += self.rng.randrange(step)
+                row = {"id": self.new_id(), "message": "ciphertext " * self.rng.randint(1, 30),
+                       "sender_id": members[self.rng.randrange(len(members))], "group_id": group_id,
+                       "created_date": created_date}
+                if with_seen:
+                    row["seen"] = True
+                yield row
+
+    def insert(self, model, rows):
+        """
+        Write the rows by batches of batch_size
+        Args:
+            model: model of the table
+            rows: iterator of dict
+        """
+        table = model.__table__
+        start = perf_counter()
+        count = 0
+        batch = []
+        with db.engine.connect() as connection:
+            if connection.dialect.name == 'mysql':
+                connection.execute('SET FOREIGN_KEY_CHECKS=0')
+                connection.execute('SET UNIQUE_CHECKS=0')
+            for row in rows:
+                batch.append(row)
+                if len(batch) >= self.batch_size:
+                    self.write(connection, table, batch)
+                    count += len(batch)
+                    batch = []
+            if batch:
+                self.write(connection, table, batch)
+                count += len(batch)
+            if connection.dialect.name == 'mysql':
+                connection.execute('SET FOREIGN_KEY_CHECKS=1')
+                connection.execute('SET UNIQUE_CHECKS=1')
+        elapsed = perf_counter() - start
+        print("{:<16} {:>12} rows {:>8.1f}s {:>10.0f} rows/s".format(table.name, count, elapsed,
+                                                                      count / elapsed if elapsed else 0))
+
+    def write(self, connection, table, batch):
+        if self.load_data and connection.dialect.name == 'mysql':
+            self.write_load_data(connection, table, batch)
+            return
+        with connection.begin():
+            # mysqlclient rewrites executemany INSERT into multi-row INSERT statements
+            connection.execute(table.insert(), batch)
+
+    @staticmethod
+    def write_load_data(connection, table, batch):
+        columns = list(batch[0])
+        with tempfile.NamedTemporaryFile('w', suffix='.tsv', delete=False, newline='') as file:
+            for row in batch:
+                file.write('\t'.join(_load_data_field(row[column]) for column in columns) + '\n')
+        # BINARY(16) ids are read as their uuid text, then converted like migrate/binary_ids.py
+        binary = [column for column in columns if isinstance(table.c[column].type, BinaryId)]
+        targets = ['@' + column if column in binary else column for column in columns]
+        conversions = ', '.join("{0} = UNHEX(REPLACE(@{0}, '-', ''))".format(column) for column in binary)
+        try:
+            with connection.begin():
+                connection.execute("LOAD DATA LOCAL INFILE '{}' INTO TABLE {} ({}){}".format(
+                    file.name, table.name, ', '.join(targets), ' SET ' + conversions if conversions else ''))
+        finally:
+            os.remove(file.name)
+
+
+def _load_data_field(value):
+    """
+    Text of a value in a LOAD DATA file, \\N is NULL and is not escaped
+    """
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        return str(int(value))
+    return str(value).translate(LOAD_DATA_ESCAPES)
@@ -0,0 +1,66 @@
+import os
+
+import pytest
+
+from app.app import create_app
+from app.extensions import db, sio
+from app.settings import DevConfig
+
+
+class TestConfig(DevConfig):
+    """Test configuration: a SQLite file stands in for MySQL, the profilers and the tracer are off."""
+    ENV = 'test'
+    DEBUG = False
+    TESTING = True
+    SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(os.environ.get('TEST_DIR', '/tmp'), 'secure_chat_test.db')
+    SQLALCHEMY_ENGINE_OPTIONS = {'connect_args': {'timeout': 30, 'check_same_thread': False}}
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
+    SQL_PROFILER_ENABLED = False
+    PROFILER_TOKEN = None
+    PROFILER_SAMPLE_RATE = 0
+    TRACING_ENABLED = False
+
+
+@pytest.fixture(scope='session')
+def app():
+    return create_app(TestConfig)
+
+
+@pytest.fixture(autouse=True)
+def database(app):
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+    yield
+    with app.app_context():
+        db.session.remove()
+
+
+@pytest.fixture(autouse=True)
+def socket_server(app):
+    # the Socket.IO test client replaces the packet writer of the server
+    send_packet = sio.server._send_packet
+    yield
+    sio.server._send_packet = send_packet
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+@pytest.fixture
+def create_user(client):
+    """
+    Register a user and log it in
+    Returns:
+        function username -> (user id, access token)
+    """
+    def create(username):
+        user_id = client.post('/api/v1/users', json={'username': username, 'password': 'secret',
+                                                     'pub_key': 'key'}).json['data']['id']
+        token = client.post('/api/v1/auth/login', json={'username': username,
+                                                        'password': 'secret'}).json['data']['access_token']
+        return user_id, token
+
+    return create
@@ -0,0 +1,53 @@
+from app.models import Group, GroupUser, GroupMessage
+
+
+def auth_header(token):
+    return {'Authorization': 'Bearer ' + token}
+
+
+def create_group(client, token, users_id):
+    group_id = client.post('/api/v1/groups', json={'users_id': users_id, 'group_name': 'Group'},
+                           headers=auth_header(token)).json['data']['id']
+    client.post('/api/v1/groups/{}/messages'.format(group_id), headers=auth_header(token), json={
+        'group_id': group_id, 'messages': [{'receiver_id': user_id, 'message': 'ciphertext'} for user_id in users_id]})
+    return group_id
+
+
+def count_rows(app, group_id):
+    with app.app_context():
+        return (Group.query.filter_by(id=group_id).count(), GroupUser.query.filter_by(group_id=group_id).count(),
+                GroupMessage.query.filter_by(group_id=group_id).count())
+
+
+def test_member_deletes_group(app, client, create_user):
+    (alice_id, alice_token), (bob_id, _) = create_user('alice'), create_user('bob')
+    group_id = create_group(client, alice_token, [alice_id, bob_id])
+    assert count_rows(app, group_id) == (1, 2, 2)
+
+    response = client.delete('/api/v1/groups/' + group_id, headers=auth_header(alice_token))
+    assert response.json['status'] is True
+    assert count_rows(app, group_id) == (0, 0, 0)
+
+
+def test_non_member_cannot_delete_group(app, client, create_user):
+    (alice_id, alice_token), (bob_id, _) = create_user('alice'), create_user('bob')
+    _, mallory_token = create_user('mallory')
+    group_id = create_group(client, alice_token, [alice_id, bob_id])
+
+    response = client.delete('/api/v1/groups/' + group_id, headers=auth_header(mallory_token))
+    assert response.json['status'] is False
+    assert response.json['message'] == 'Not found error!'
+    assert count_rows(app, group_id) == (1, 2, 2)
+
+
+def test_group_send_is_synced_to_the_sender(client, create_user):
+    (alice_id, alice_token), (bob_id, bob_token) = create_user('alice'), create_user('bob')
+    group_id = create_group(client, alice_token, [alice_id, bob_id])
+
+    def synced(token):
+        changes = client.get('/api/v1/sync', headers=auth_header(token)).json['data']['changes']
+        return [(change['message']['receiver_id'], change['message']['message'])
+                for change in changes if change['kind'] == 'group']
+
+    assert sorted(synced(alice_token)) == sorted([(alice_id, 'ciphertext'), (bob_id, 'ciphertext')])
+    assert synced(bob_token) == [(bob_id, 'ciphertext')]
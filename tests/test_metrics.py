@@ -0,0 +1,26 @@
+import gc
+import threading
+
+from app.metrics import Metrics
+
+
+def test_finished_threads_are_folded_into_the_retired_totals():
+    metrics = Metrics()
+
+    def work():
+        metrics.inc('jobs_total', ())
+        metrics.observe('job_duration_seconds', (), 0.02)
+
+    for _ in range(50):
+        thread = threading.Thread(target=work)
+        thread.start()
+        thread.join()
+    work()
+    gc.collect()
+
+    assert len(metrics._shards) == 1  # the shard of this thread
+    histograms, counters = metrics.collect()
+    assert counters[('jobs_total', ())] == 51
+    values = histograms[('job_duration_seconds', ())]
+    assert sum(values[:-1]) == 51
+    assert abs(values[-1] - 51 * 0.02) < 1e-9
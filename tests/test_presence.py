@@ -0,0 +1,39 @@
+import threading
+
+import eventlet
+
+from app.extensions import sio
+from app.presence import presence, online_users, user_sessions
+
+
+def test_concurrent_auths_under_eventlet(app, create_user):
+    """
+    Two sockets authenticating at once on the hub of a thread that is not monkey-patched, like python main.py:
+    starting the presence task yields to the hub, the second login must not block the thread on the presence lock
+    """
+    assert sio.server.async_mode == 'eventlet'
+    users = [create_user('alice'), create_user('bob')]
+    presence._task = None
+    presence._changes.clear()
+    results = []
+
+    def login(token):
+        socket = sio.test_client(app)
+        socket.emit('auth', token)
+        results.append(socket.sid)
+
+    def run():
+        pool = eventlet.GreenPool()
+        for _, token in users:
+            pool.spawn(login, token)
+        pool.waitall()
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    thread.join(10)
+    assert not thread.is_alive(), 'the logins are deadlocked on the presence lock'
+    assert len(results) == 2
+    assert {online_users[sid] for sid in results} == {user_id for user_id, _ in users}
+    assert set(presence._changes) == {user_id for user_id, _ in users}
+    for sid in results:
+        user_sessions.pop(online_users.pop(sid), None)
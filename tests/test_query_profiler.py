@@ -0,0 +1,20 @@
+import pytest
+from sqlalchemy import create_engine, event
+from sqlalchemy.exc import OperationalError
+
+from app.query_profiler import QueryProfiler
+
+
+def test_failed_statement_drops_its_start_time():
+    profiler = QueryProfiler()
+    engine = create_engine('sqlite://')
+    event.listen(engine, 'before_cursor_execute', profiler._before_cursor_execute)
+    event.listen(engine, 'after_cursor_execute', profiler._after_cursor_execute)
+    event.listen(engine, 'handle_error', profiler._handle_error)
+
+    with engine.connect() as conn:
+        for _ in range(3):
+            with pytest.raises(OperationalError):
+                conn.execute('SELECT * FROM missing_table')
+        assert conn.execute('SELECT 1').scalar() == 1
+        assert conn.info['query_start_time'] == []
@@ -0,0 +1,45 @@
+from engineio import payload
+
+from app.extensions import sio
+from app.presence import online_users, user_sessions
+from app.socket_auth import socket_auth
+
+
+def poll(client, query):
+    """
+    One long-polling request
+    Returns:
+        list of the Engine.IO packets, (type, data)
+    """
+    response = client.get('/socket.io/?EIO=3&transport=polling&' + query)
+    assert response.status_code == 200
+    return [(pkt.packet_type, pkt.data) for pkt in payload.Payload(encoded_payload=response.get_data()).packets]
+
+
+def test_handshake_auth_connects_before_login_events(app, client, create_user, monkeypatch):
+    """
+    With SOCKET_AUTH_ON_CONNECT the handshake logs the socket in, the presence and the pending messages follow the
+    CONNECT packet
+    """
+    monkeypatch.setattr(socket_auth, 'on_connect', True)
+    (alice_id, alice_token), (bob_id, bob_token) = create_user('alice'), create_user('bob')
+    client.post('/api/v1/chats/' + alice_id, json={'message': 'ciphertext'},
+                headers={'Authorization': 'Bearer ' + bob_token})
+
+    open_packet, *packets = poll(client, 'token=' + alice_token)
+    sid = open_packet[1]['sid']
+    assert packets[0] == (4, '0')  # Socket.IO CONNECT of the default namespace
+    assert online_users[sid] == alice_id
+
+    sio.sleep(0.05)
+    events = [data for packet_type, data in poll(client, 'sid=' + sid) if data.startswith('2')]
+    assert events[0].startswith('2["presence"')
+    assert '"new_private_msg_batch"' in events[1] and 'ciphertext' in events[1]
+
+    user_sessions.pop(online_users.pop(sid), None)
+
+
+def test_handshake_without_token_is_rejected(client, monkeypatch):
+    monkeypatch.setattr(socket_auth, 'on_connect', True)
+    response = client.get('/socket.io/?EIO=3&transport=polling')
+    assert response.status_code == 401
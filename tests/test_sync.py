@@ -0,0 +1,79 @@
+import threading
+
+from app.extensions import db
+from app.models import Change, SyncSequence
+
+
+def auth_header(token):
+    return {'Authorization': 'Bearer ' + token}
+
+
+def sync(client, token, since=0):
+    return client.get('/api/v1/sync?since={}'.format(since), headers=auth_header(token)).json['data']
+
+
+def test_sequences_follow_commit_order(app):
+    """
+    A transaction reserving a greater sequence waits for the commit of the transaction holding a smaller one,
+    a cursor read in between never moves past an uncommitted change
+    """
+    with app.app_context():
+        Change.record(['alice'], Change.PRIVATE, Change.NEW, '00000000-0000-0000-0000-000000000001', 'c')
+        db.session.commit()
+
+    first_reserved = threading.Event()
+    committed = []
+
+    def slow_writer():
+        with app.app_context():
+            Change.record(['alice'], Change.PRIVATE, Change.NEW, '00000000-0000-0000-0000-000000000002', 'c')
+            first_reserved.set()
+            threading.Event().wait(0.3)
+            db.session.commit()
+            committed.append('slow')
+
+    thread = threading.Thread(target=slow_writer)
+    thread.start()
+    first_reserved.wait(5)
+    with app.app_context():
+        # the sequence row is locked by the slow writer, this reservation waits for its commit
+        Change.record(['alice'], Change.PRIVATE, Change.NEW, '00000000-0000-0000-0000-000000000003', 'c')
+        db.session.commit()
+        committed.append('fast')
+    thread.join(5)
+
+    with app.app_context():
+        changes = Change.get_since('alice')
+        assert [change.seq for change in changes] == [1, 2, 3]
+        assert [change.message_id for change in changes][1:] == ['00000000-0000-0000-0000-000000000002',
+                                                                  '00000000-0000-0000-0000-000000000003']
+        assert SyncSequence.query.get('alice').seq == 3
+    assert committed == ['slow', 'fast']
+
+
+def test_sync_returns_messages_and_group_changes(client, create_user):
+    (alice_id, alice_token), (bob_id, bob_token) = create_user('alice'), create_user('bob')
+    carol_id, _ = create_user('carol')
+    client.post('/api/v1/chats/' + bob_id, json={'message': 'hi'}, headers=auth_header(alice_token))
+    group_id = client.post('/api/v1/groups', json={'users_id': [alice_id, bob_id], 'group_name': 'Team'},
+                           headers=auth_header(alice_token)).json['data']['id']
+    client.put('/api/v1/groups/' + group_id, json={'group_name': 'Core team'}, headers=auth_header(alice_token))
+    client.put('/api/v1/groups/{}/members'.format(group_id), json={'user_id': carol_id, 'status': 'add'},
+               headers=auth_header(alice_token))
+
+    data = sync(client, bob_token)
+    changes = data['changes']
+    assert [change['seq'] for change in changes] == [1, 2, 3, 4]
+    assert [(change['kind'], change['action']) for change in changes] == [
+        ('private', 'new'), ('group_info', 'new'), ('group_info', 'edited'), ('group_info', 'edited')]
+    assert changes[0]['message']['message'] == 'hi'
+    assert changes[-1]['group']['group_name'] == 'Core team'
+    assert sorted(changes[-1]['group']['members_id']) == sorted([alice_id, bob_id, carol_id])
+    assert data['cursor'] == 4
+    assert sync(client, bob_token, since=4)['changes'] == []
+
+    client.put('/api/v1/groups/{}/members'.format(group_id), json={'user_id': bob_id, 'status': 'remove'},
+               headers=auth_header(alice_token))
+    changes = sync(client, bob_token, since=4)['changes']
+    assert [(change['kind'], change['action'], change['group']) for change in changes] == [
+        ('group_info', 'deleted', None)]
@@ -0,0 +1,35 @@
+import json
+
+import pytest
+
+from app.tracing import SPAN_KIND_SERVER, FileExporter, Span, Tracer
+
+TRACE_ID = '4bf92f3577b34da6a3ce929d0e0e4736'
+PARENT_ID = '00f067aa0ba902b7'
+
+
+@pytest.mark.parametrize('flags, sampled', [('01', True), ('03', True), ('00', False), ('02', False)])
+def test_traceparent_sampled_flag(app, flags, sampled):
+    tracer = Tracer()
+    tracer.sample_rate = 0.0 if sampled else 1.0  # the header decides, not the local sample rate
+    with app.test_request_context():
+        span = tracer.start_trace('GET /', SPAN_KIND_SERVER, traceparent='00-{}-{}-{}'.format(TRACE_ID, PARENT_ID, flags))
+        assert (span is not None) == sampled
+        if sampled:
+            assert (span.trace_id, span.parent_id) == (TRACE_ID, PARENT_ID)
+
+
+def test_file_exporter_rotates(tmp_path):
+    path = str(tmp_path / 'traces.jsonl')
+    exporter = FileExporter(path, 'secure-chat', max_bytes=2000, backup_count=2)
+    for _ in range(50):
+        span = Span('GET /', TRACE_ID)
+        span.end = span.start
+        exporter.export([span])
+
+    files = sorted(p.name for p in tmp_path.iterdir())
+    assert files == ['traces.jsonl', 'traces.jsonl.1', 'traces.jsonl.2']
+    for name in files:
+        assert (tmp_path / name).stat().st_size <= 2000
+        for line in (tmp_path / name).read_text().splitlines():
+            assert json.loads(line)['resourceSpans'][0]['scopeSpans'][0]['spans'][0]['name'] == 'GET /'
@@ -0,0 +1,37 @@
+import eventlet
+import eventlet.wsgi
+import pytest
+
+from app.extensions import sio
+from app.transport import TransportPolicy
+
+
+def websocket_handshake(app):
+    """
+    WebSocket handshake of a client offering permessage-deflate against an eventlet server
+    Returns:
+        the response headers, lower case
+    """
+    listener = eventlet.listen(('127.0.0.1', 0))
+    server = eventlet.spawn(eventlet.wsgi.server, listener, app, log_output=False)
+    client = eventlet.connect(listener.getsockname())
+    client.sendall(b'\r\n'.join([
+        b'GET /socket.io/?EIO=3&transport=websocket HTTP/1.1', b'Host: localhost', b'Upgrade: websocket',
+        b'Connection: Upgrade', b'Sec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==', b'Sec-WebSocket-Version: 13',
+        b'Sec-WebSocket-Extensions: permessage-deflate; client_max_window_bits', b'', b'']))
+    response = b''
+    while b'\r\n\r\n' not in response:
+        response += client.recv(4096)
+    client.close()
+    server.kill()
+    listener.close()
+    return response.split(b'\r\n\r\n')[0].decode().lower()
+
+
+@pytest.mark.parametrize('enabled', [True, False])
+def test_websocket_compression(app, monkeypatch, enabled):
+    monkeypatch.setattr(sio.server.eio, '_async', dict(sio.server.eio._async))
+    TransportPolicy._websocket_compression(sio.server.eio, enabled)
+    headers = websocket_handshake(app)
+    assert headers.startswith('http/1.1 101')
+    assert ('sec-websocket-extensions: permessage-deflate' in headers) is enabled